@@ -16,6 +16,9 @@ from paho.mqtt import client as mqtt_client
 # --- Configuration ---
 BROKER = 'localhost'
 PORT = 1883
+# If the router hosts several spaces (main.py --space NAME), set this to
+# "NAME/" to join that space; every topic below is prefixed with it.
+SPACE = ""
 
 # Generate a unique client name to avoid collisions
 # In a real app, you might want a fixed name, but for testing, random is safer.
@@ -43,7 +46,7 @@ client = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION1, CLIENT_NAME
 # Last Will: if this client's connection drops uncleanly (crash, network loss,
 # power cut), the broker publishes this on our behalf so the router can
 # deregister us. Must be set before connect().
-client.will_set("YuxiSpace/leave", payload=CLIENT_NAME, qos=1)
+client.will_set(f"{SPACE}YuxiSpace/leave", payload=CLIENT_NAME, qos=1)
 
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
@@ -59,14 +62,18 @@ def on_connect(client, userdata, flags, rc):
         registration_msg = f"{CLIENT_NAME}, {DESCRIPTION}, pubs({pubs_str}), subs({subs_str})"
         
         print(f"📤 Sending Registration: {registration_msg}")
-        client.publish("YuxiSpace", registration_msg)
+        client.publish(f"{SPACE}YuxiSpace", registration_msg)
+
+        # The router may ask every client to re-announce itself (e.g. after
+        # it restarts); see on_message.
+        client.subscribe(f"{SPACE}YuxiSpace/reregister")
         
         # --- Subscribe to Input Topics ---
         # We need to subscribe to the topics we defined in SUBSCRIBERS.
         # The Spacebrew Router routes messages to: "ClientName/SubscriberName"
         for sub in SUBSCRIBERS:
             sub_name = sub.split(':')[0] # Extract name from "name:type"
-            topic = f"{CLIENT_NAME}/{sub_name}"
+            topic = f"{SPACE}{CLIENT_NAME}/{sub_name}"
             client.subscribe(topic)
             print(f"👂 Listening on topic: {topic}")
             
@@ -74,6 +81,12 @@ def on_connect(client, userdata, flags, rc):
         print(f"🔴 Failed to connect, return code {rc}")
 
 def on_message(client, userdata, msg):
+    if msg.topic == f"{SPACE}YuxiSpace/reregister":
+        pubs_str = ", ".join(PUBLISHERS)
+        subs_str = ", ".join(SUBSCRIBERS)
+        client.publish(f"{SPACE}YuxiSpace", f"{CLIENT_NAME}, {DESCRIPTION}, pubs({pubs_str}), subs({subs_str})")
+        return
+
     print(f"\n[RX] Received `{msg.payload.decode()}` on `{msg.topic}`")
     # Add your custom logic here to handle incoming messages
     # e.g., if msg.topic == f"{CLIENT_NAME}/led": turn_on_led()
@@ -91,13 +104,13 @@ def run():
         # Keep the script running and publish some example data
         while True:
             # Example: Simulate a button press every 5 seconds
-            print(f"📤 Publishing 'true' to {CLIENT_NAME}/button")
-            client.publish(f"{CLIENT_NAME}/button", "true")
+            print(f"📤 Publishing 'true' to {SPACE}{CLIENT_NAME}/button")
+            client.publish(f"{SPACE}{CLIENT_NAME}/button", "true")
             
             time.sleep(2.5)
             
-            print(f"📤 Publishing 'false' to {CLIENT_NAME}/button")
-            client.publish(f"{CLIENT_NAME}/button", "false")
+            print(f"📤 Publishing 'false' to {SPACE}{CLIENT_NAME}/button")
+            client.publish(f"{SPACE}{CLIENT_NAME}/button", "false")
             
             time.sleep(2.5)
             
@@ -105,7 +118,7 @@ def run():
         print("\nStopping client...")
         # A clean disconnect does NOT trigger the will message above, so
         # deregister explicitly here.
-        client.publish("YuxiSpace/leave", CLIENT_NAME).wait_for_publish()
+        client.publish(f"{SPACE}YuxiSpace/leave", CLIENT_NAME).wait_for_publish()
         client.loop_stop()
         client.disconnect()
 
@@ -0,0 +1,47 @@
+# Shared helpers for the benchmark scripts. Run them from the repo root,
+# e.g. `python3 benchmarks/registration_storm.py`; none of them need a
+# running MQTT broker.
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from paho.mqtt.client import MQTT_ERR_SUCCESS, MQTTMessage
+
+from mqtt_service import SpacebrewMQTT
+from router import SpacebrewRouter
+
+
+class PublishResult:
+    """What paho's publish() returns, minus the per-call cost of the real MQTTMessageInfo."""
+    rc = MQTT_ERR_SUCCESS
+
+
+class NullClient:
+    """Stands in for the router's paho client: publishes go nowhere."""
+
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self.published += 1
+        return PublishResult
+
+    def is_connected(self):
+        return True
+
+
+def make_router(**router_kwargs):
+    """A router and MQTT service wired to a NullClient, with a throwaway routes file."""
+    route_file = os.path.join(tempfile.mkdtemp(prefix="spacebrew-bench-"), "routes.txt")
+    router = SpacebrewRouter(route_file, **router_kwargs)
+    mqtt_service = SpacebrewMQTT(router)
+    mqtt_service.client = NullClient()
+    return router, mqtt_service
+
+
+def message(topic, payload):
+    msg = MQTTMessage(topic=topic.encode())
+    msg.payload = payload.encode() if isinstance(payload, str) else payload
+    return msg
@@ -0,0 +1,46 @@
+# Measures how long the router takes to absorb a registration storm: N
+# devices all publishing their registration to YuxiSpace at once, as happens
+# when a broker restarts. Reports how long the paho thread is tied up
+# delivering the storm and how long until every client is registered.
+import argparse
+import contextlib
+import io
+import time
+
+from common import make_router, message
+
+
+def run_storm(count, window):
+    router, mqtt_service = make_router()
+    mqtt_service.registrations.window = window
+    messages = [
+        message("YuxiSpace", f"Device_{i}, Storm test device, pubs(out:range), subs(in:range)")
+        for i in range(count)
+    ]
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for msg in messages:
+            mqtt_service.on_message(mqtt_service.client, None, msg)
+        delivered = time.perf_counter() - start
+        while len(router.clients) < count:
+            time.sleep(0.001)
+        absorbed = time.perf_counter() - start
+
+    return delivered, absorbed, mqtt_service.registrations.batches
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Registration storm benchmark')
+    parser.add_argument('--clients', type=int, default=1000, help='Number of clients registering at once')
+    parser.add_argument('--window', type=float, default=0.05, help='Registration batching window in seconds')
+    args = parser.parse_args()
+
+    for label, window in (("unbatched", 0), ("batched", args.window)):
+        delivered, absorbed, batches = run_storm(args.clients, window)
+        print(f"{label:>10}: {args.clients} registrations, paho thread busy {delivered * 1000:.1f} ms, "
+              f"all registered after {absorbed * 1000:.1f} ms ({batches} batches)")
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,55 @@
+# Measures the router's per-message cost on the routing path: N routes,
+# with traffic spread over their publisher topics (and some unrouted
+# topics), fed straight into on_message with publishing stubbed out.
+import argparse
+import contextlib
+import io
+import time
+
+from common import make_router, message
+
+
+class _NullWriter(io.TextIOBase):
+    # Swallows the per-message [RX] log line without buffering it
+    def write(self, s):
+        return len(s)
+
+
+def run_routing(routes, count, unrouted, conditional, repeat=3):
+    router, mqtt_service = make_router()
+    for i in range(routes):
+        router.add_route(f"Sender_{i}/out", f"Receiver_{i}/in", "value >= 0" if conditional else None)
+
+    messages = [message(f"Sender_{i % routes}/out", str(i)) for i in range(count)]
+    messages += [message(f"Unrouted_{i % routes}/out", str(i)) for i in range(int(count * unrouted))]
+
+    # Best of several runs, to keep GC pauses and noisy neighbours out of it
+    best = None
+    with contextlib.redirect_stdout(_NullWriter()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for msg in messages:
+                mqtt_service.on_message(mqtt_service.client, None, msg)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+    return len(messages), best, mqtt_service.client.published // repeat
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Routing throughput benchmark')
+    parser.add_argument('--routes', type=int, default=100, help='Number of routes')
+    parser.add_argument('--messages', type=int, default=200000, help='Number of routed messages')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per case (the fastest is reported)')
+    parser.add_argument('--unrouted', type=float, default=0.25,
+                        help='Extra unrouted messages, as a fraction of --messages')
+    args = parser.parse_args()
+
+    for label, conditional in (("plain", False), ("conditional", True)):
+        total, elapsed, published = run_routing(args.routes, args.messages, args.unrouted, conditional, args.repeat)
+        print(f"{label:>12}: {total} messages ({published} routed) in {elapsed:.2f}s, "
+              f"{total / elapsed:,.0f} msg/s, {elapsed / total * 1e6:.2f} µs/msg")
+
+
+if __name__ == '__main__':
+    run()
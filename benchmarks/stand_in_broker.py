@@ -0,0 +1,216 @@
+# A minimal MQTT 3.1.1 broker for the benchmarks that need real broker
+# round trips: CONNECT, SUBSCRIBE (with + and # wildcards), PUBLISH at QoS
+# 0/1 (always delivered at QoS 0), PINGREQ and DISCONNECT. MQTT 5 clients
+# get the same, plus topic aliases both ways and user properties passed
+# through. No retained messages, wills, sessions or auth; it's a stand-in,
+# not a broker.
+#
+#   python3 benchmarks/stand_in_broker.py [--port 1883]
+import argparse
+import asyncio
+import struct
+
+CONNECT, CONNACK, PUBLISH, PUBACK, SUBSCRIBE, SUBACK = 1, 2, 3, 4, 8, 9
+UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 10, 11, 12, 13, 14
+
+# MQTT 5 property IDs we act on, and the aliases we accept from each client
+TOPIC_ALIAS_MAXIMUM, TOPIC_ALIAS = 0x22, 0x23
+MAX_TOPIC_ALIASES = 64
+# Property ID -> encoding, for the properties that can appear on CONNECT and PUBLISH
+PROPERTY_TYPES = {0x01: "byte", 0x02: "int4", 0x03: "string", 0x08: "string", 0x09: "binary",
+                  0x0B: "varint", 0x11: "int4", 0x15: "string", 0x16: "binary", 0x17: "byte",
+                  0x19: "byte", 0x21: "int2", 0x22: "int2", 0x23: "int2", 0x26: "pair", 0x27: "int4"}
+
+
+def encode_length(n):
+    out = bytearray()
+    while True:
+        n, byte = divmod(n, 128)
+        out.append(byte | (0x80 if n else 0))
+        if not n:
+            return bytes(out)
+
+
+def decode_length(data, offset):
+    """A variable byte integer at offset: (value, offset after it)."""
+    value, multiplier = 0, 1
+    while True:
+        byte = data[offset]
+        offset += 1
+        value += (byte & 0x7F) * multiplier
+        multiplier *= 128
+        if not byte & 0x80:
+            return value, offset
+
+
+def split_properties(data):
+    """MQTT 5 properties as (property ID, raw bytes including the ID) pairs."""
+    properties, offset = [], 0
+    while offset < len(data):
+        start, kind = offset, PROPERTY_TYPES[data[offset]]
+        offset += 1
+        if kind == "varint":
+            _, offset = decode_length(data, offset)
+        elif kind == "pair":
+            for _ in range(2):
+                offset += 2 + struct.unpack(">H", data[offset:offset + 2])[0]
+        elif kind in ("string", "binary"):
+            offset += 2 + struct.unpack(">H", data[offset:offset + 2])[0]
+        else:
+            offset += {"byte": 1, "int2": 2, "int4": 4}[kind]
+        properties.append((data[start], data[start:offset]))
+    return properties
+
+
+def topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split("/")
+    levels = topic.split("/")
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(levels) or (level != "+" and level != levels[i]):
+            return False
+    return len(filter_levels) == len(levels)
+
+
+class StandInBroker:
+    def __init__(self):
+        # Writer -> topic filters it subscribed to
+        self.subscribers = {}
+        # Writer -> (topic -> alias, aliases it accepts) for MQTT 5 clients
+        self.mqtt5 = {}
+        self.published = 0
+        self.publish_bytes = 0  # Size of the PUBLISH packets received
+
+    async def read_packet(self, reader):
+        header = (await reader.readexactly(1))[0]
+        length, multiplier = 0, 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header, await reader.readexactly(length)
+
+    def deliver(self, topic, payload, properties=b""):
+        # Re-sent at QoS 0, minus any packet ID (and, for MQTT 3.1.1
+        # subscribers, any properties)
+        encoded = topic.encode()
+        body = struct.pack(">H", len(encoded)) + encoded + payload
+        packet = bytes([PUBLISH << 4]) + encode_length(len(body)) + body
+        for writer, filters in list(self.subscribers.items()):
+            if any(topic_matches(f, topic) for f in filters):
+                session = self.mqtt5.get(writer)
+                if session is None:
+                    writer.write(packet)
+                    continue
+                aliases, maximum = session
+                alias = aliases.get(topic)
+                name = encoded
+                extra = properties
+                if alias is not None:
+                    name = b""
+                elif len(aliases) < maximum:
+                    alias = aliases[topic] = len(aliases) + 1
+                if alias is not None:
+                    extra += struct.pack(">BH", TOPIC_ALIAS, alias)
+                body = struct.pack(">H", len(name)) + name + encode_length(len(extra)) + extra + payload
+                writer.write(bytes([PUBLISH << 4]) + encode_length(len(body)) + body)
+
+    async def handle(self, reader, writer):
+        self.subscribers[writer] = set()
+        mqtt5 = False
+        inbound_aliases = {}
+        try:
+            while True:
+                header, body = await self.read_packet(reader)
+                kind = header >> 4
+                if kind == CONNECT:
+                    name_length = struct.unpack(">H", body[:2])[0]
+                    mqtt5 = body[2 + name_length] == 5
+                    if not mqtt5:
+                        writer.write(bytes([CONNACK << 4, 2, 0, 0]))
+                    else:
+                        # Protocol name, level, flags and keep-alive, then properties
+                        length, offset = decode_length(body, 6 + name_length)
+                        accepts = 0
+                        for property_id, raw in split_properties(body[offset:offset + length]):
+                            if property_id == TOPIC_ALIAS_MAXIMUM:
+                                accepts = struct.unpack(">H", raw[1:])[0]
+                        self.mqtt5[writer] = ({}, accepts)
+                        writer.write(bytes([CONNACK << 4, 6, 0, 0, 3, TOPIC_ALIAS_MAXIMUM])
+                                     + struct.pack(">H", MAX_TOPIC_ALIASES))
+                elif kind == PUBLISH:
+                    qos = (header >> 1) & 3
+                    self.publish_bytes += len(body) + 1 + len(encode_length(len(body)))
+                    topic_length = struct.unpack(">H", body[:2])[0]
+                    topic = body[2:2 + topic_length].decode()
+                    offset = 2 + topic_length + (2 if qos else 0)
+                    if qos:
+                        packet_id = body[2 + topic_length:4 + topic_length]
+                        writer.write(bytes([PUBACK << 4, 2]) + packet_id)
+                    properties = b""
+                    if mqtt5:
+                        length, offset = decode_length(body, offset)
+                        for property_id, raw in split_properties(body[offset:offset + length]):
+                            if property_id != TOPIC_ALIAS:
+                                properties += raw
+                            elif topic:
+                                inbound_aliases[raw[1:]] = topic
+                            else:
+                                topic = inbound_aliases[raw[1:]]
+                        offset += length
+                    self.published += 1
+                    self.deliver(topic, body[offset:], properties)
+                elif kind in (SUBSCRIBE, UNSUBSCRIBE):
+                    packet_id, rest, filters = body[:2], body[2:], []
+                    if mqtt5:
+                        length, offset = decode_length(rest, 0)
+                        rest = rest[offset + length:]
+                    while rest:
+                        filter_length = struct.unpack(">H", rest[:2])[0]
+                        filters.append(rest[2:2 + filter_length].decode())
+                        rest = rest[2 + filter_length + (1 if kind == SUBSCRIBE else 0):]
+                    # MQTT 5 acks have an (empty) property list, and
+                    # UNSUBACK a reason code per filter
+                    properties = b"\x00" if mqtt5 else b""
+                    if kind == SUBSCRIBE:
+                        self.subscribers[writer].update(filters)
+                        ack = packet_id + properties + bytes(len(filters))
+                        writer.write(bytes([SUBACK << 4, len(ack)]) + ack)
+                    else:
+                        self.subscribers[writer].difference_update(filters)
+                        ack = packet_id + properties + (bytes(len(filters)) if mqtt5 else b"")
+                        writer.write(bytes([UNSUBACK << 4, len(ack)]) + ack)
+                elif kind == PINGREQ:
+                    writer.write(bytes([PINGRESP << 4, 0]))
+                elif kind == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.subscribers.pop(writer, None)
+            self.mqtt5.pop(writer, None)
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=1883):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Stand-in MQTT broker for benchmarks')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=1883, help='Port to listen on')
+    args = parser.parse_args()
+    try:
+        asyncio.run(StandInBroker().serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    run()
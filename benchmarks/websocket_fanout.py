@@ -0,0 +1,349 @@
+# Measures how the web server copes with many browsers: opens thousands of
+# simulated dashboards (/ws) and web clients (/ws/client) against a real
+# router, web server and stand-in broker, each in its own process, then
+# publishes timestamped messages over MQTT and reports delivery latency,
+# throughput, the server's event-loop lag and its memory per connection.
+# Web clients register and subscribe to a few of the load topics each, and
+# a fraction of all sockets are deliberately slow readers.
+#
+# Every socket is a file descriptor on both ends, so raise `ulimit -n` for
+# large runs (both processes raise their soft limit to the hard limit).
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from array import array
+from collections import Counter
+
+import common  # noqa: F401 (puts the repo root on sys.path)
+
+import paho.mqtt.client as mqtt
+import websockets
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOPIC_PREFIX = "Load/"
+
+
+def raise_file_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def rss_bytes(pid="self"):
+    """Current resident set size (this process's peak RSS where /proc isn't available)."""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """{"p50": ..., ..., "max": ...} of values, in milliseconds."""
+    values = sorted(values)
+    if not values:
+        return {**{f"p{p}": 0.0 for p in points}, "max": 0.0}
+    result = {f"p{p}": values[min(len(values) - 1, len(values) * p // 100)] * 1000 for p in points}
+    result["max"] = values[-1] * 1000
+    return result
+
+
+class LagProbe:
+    """How late the running event loop wakes from a short sleep, sample by sample."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = array("d")
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(loop.time() - start - self.interval)
+
+    def take(self):
+        samples, self.samples = self.samples, array("d")
+        return samples
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve(broker_port, web_port, gateways):
+    """The server process: router, MQTT service and web server (or gateways), plus a stats endpoint."""
+    import tempfile
+    from mqtt_service import SpacebrewMQTT
+    from router import SpacebrewRouter
+    from web_service import SpacebrewWebServer
+
+    raise_file_limit()
+    router = SpacebrewRouter(os.path.join(tempfile.mkdtemp(prefix="spacebrew-bench-"), "routes.txt"))
+    mqtt_service = SpacebrewMQTT(router, "127.0.0.1", broker_port)
+    web_service = SpacebrewWebServer(router, mqtt_service, host="127.0.0.1", port=web_port)
+    hub = None
+    if gateways:
+        from gateway import GatewayHub
+        hub = GatewayHub(web_service, os.path.join(os.path.dirname(router.route_file), "gateway.sock"))
+    probe = LagProbe()
+    probe_task = None
+
+    @web_service.app.get("/bench/stats")
+    async def stats():
+        # Lag since the previous call, so each phase is measured on its own
+        nonlocal probe_task
+        if probe_task is None:
+            probe_task = asyncio.create_task(probe.run())
+        # With gateways, this runs on the router process's feed loop and
+        # memory is the total across the router and its gateways.
+        return {
+            "rss": rss_bytes() + sum(rss_bytes(process.pid) for process in hub.processes) if hub else rss_bytes(),
+            "lag": percentiles(probe.take()),
+            "registered": len(router.clients),
+            "broker_connected": mqtt_service.client.is_connected(),
+        }
+
+    mqtt_service.connect()
+    mqtt_service.start()
+    if hub:
+        hub.start()
+        hub.spawn(gateways, "127.0.0.1", web_port)
+        try:
+            hub.supervise()
+        finally:
+            hub.stop()
+    else:
+        web_service.start()
+
+
+class Group:
+    """Latencies and counts for one kind of simulated socket."""
+
+    def __init__(self, name):
+        self.name = name
+        self.sockets = 0
+        self.expected = 0
+        self.latencies = array("d")
+        self.closed = 0
+
+
+async def read_events(ws, group, slow_delay):
+    try:
+        async for frame in ws:
+            event = json.loads(frame)
+            topic = event.get("topic")
+            if topic and topic.startswith(TOPIC_PREFIX):
+                group.latencies.append(time.perf_counter() - float(event["message"].split()[1]))
+            if slow_delay:
+                await asyncio.sleep(slow_delay)
+    except websockets.ConnectionClosed:
+        group.closed += 1
+
+
+def connect_publisher(broker_port):
+    # paho's loop uses select(), which can't watch descriptors above 1023,
+    # so this has to connect before the thousands of WebSockets are opened.
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id="fanout-publisher")
+    client.connect("127.0.0.1", broker_port)
+    client.loop_start()
+    return client
+
+
+def publish_load(client, topics, rate, duration, counts):
+    """Publish `rate` timestamped messages/s round-robin over topics (runs in a thread)."""
+    interval = 1.0 / rate
+    start = time.perf_counter()
+    sent = 0
+    while True:
+        now = time.perf_counter()
+        if now - start >= duration:
+            break
+        due = start + sent * interval
+        if now < due:
+            time.sleep(due - now)
+        topic = topics[sent % len(topics)]
+        client.publish(topic, f"{sent} {time.perf_counter()}")
+        counts[topic] += 1
+        sent += 1
+    elapsed = time.perf_counter() - start
+    client.disconnect()
+    client.loop_stop()
+    return sent, elapsed
+
+
+def get_stats(web_port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{web_port}/bench/stats", timeout=30) as response:
+        return json.load(response)
+
+
+async def wait_for(check, timeout, what):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if check():
+                return
+        except OSError:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Timed out waiting for {what}")
+        await asyncio.sleep(0.2)
+
+
+async def run_load(args, broker_port, web_port):
+    rng = random.Random(args.seed)
+    topics = [f"{TOPIC_PREFIX}t{i}" for i in range(args.topics)]
+    groups = {name: Group(name) for name in ("dashboards", "web clients", "slow readers")}
+    handshakes = asyncio.Semaphore(args.concurrency)
+    sockets = []
+    readers = []
+    subscriptions = []
+
+    async def open_socket(path):
+        async with handshakes:
+            ws = await websockets.connect(f"ws://127.0.0.1:{web_port}{path}", proxy=None,
+                                          open_timeout=120, ping_interval=None, max_size=None)
+        sockets.append(ws)
+        return ws
+
+    async def open_dashboard(slow):
+        group = groups["slow readers" if slow else "dashboards"]
+        ws = await open_socket("/ws")
+        group.sockets += 1
+        subscriptions.append((group, None))
+        readers.append(asyncio.create_task(read_events(ws, group, args.slow_delay if slow else 0)))
+
+    async def open_web_client(i, slow):
+        group = groups["slow readers" if slow else "web clients"]
+        ws = await open_socket("/ws/client")
+        group.sockets += 1
+        subs = rng.sample(topics, min(args.subscriptions, len(topics)))
+        subscriptions.append((group, subs))
+        await ws.send(json.dumps([
+            {"cmd": "register", "message": f"LoadClient_{i}, Fan-out load client, pubs(out:string), "
+                                           f"subs({', '.join(t[len(TOPIC_PREFIX):] + ':string' for t in subs)})"},
+            {"cmd": "subscribe", "topics": subs},
+        ]))
+        readers.append(asyncio.create_task(read_events(ws, group, args.slow_delay if slow else 0)))
+
+    await wait_for(lambda: get_stats(web_port)["broker_connected"], 30, "the server to connect to the broker")
+    publisher = connect_publisher(broker_port)
+    before = await asyncio.to_thread(get_stats, web_port)
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(open_dashboard(rng.random() < args.slow) for _ in range(args.dashboards)),
+        *(open_web_client(i, rng.random() < args.slow) for i in range(args.clients)),
+    )
+    connect_time = time.perf_counter() - start
+    await wait_for(lambda: get_stats(web_port)["registered"] >= args.clients, 60, "web clients to register")
+    await asyncio.sleep(1)
+    connected = await asyncio.to_thread(get_stats, web_port)
+
+    # Measure the load generator too: if its own loop lags, it's the bottleneck
+    probe = LagProbe()
+    probe_task = asyncio.create_task(probe.run())
+    counts = Counter()
+    sent, elapsed = await asyncio.to_thread(publish_load, publisher, topics, args.rate, args.duration, counts)
+    await asyncio.sleep(args.drain)
+    loaded = await asyncio.to_thread(get_stats, web_port)
+    probe_task.cancel()
+
+    for group, subs in subscriptions:
+        group.expected += sent if subs is None else sum(counts[topic] for topic in subs)
+    for task in readers:
+        task.cancel()
+
+    total_sockets = args.dashboards + args.clients
+    delivered = sum(len(group.latencies) for group in groups.values())
+    expected = sum(group.expected for group in groups.values())
+    per_connection = (connected["rss"] - before["rss"]) / max(1, total_sockets)
+    print(f"Connections: {args.dashboards} dashboards + {args.clients} web clients "
+          f"({groups['slow readers'].sockets} slow readers) opened in {connect_time:.1f}s")
+    server = f"Server ({args.gateways} gateways)" if args.gateways else "Server"
+    print(f"{server} memory: {before['rss'] / 2**20:.1f} MB before, {connected['rss'] / 2**20:.1f} MB connected, "
+          f"{loaded['rss'] / 2**20:.1f} MB after the load; {per_connection / 1024:.1f} KB per connection")
+    print(f"Published: {sent} messages over {len(topics)} topics in {elapsed:.1f}s ({sent / elapsed:,.0f} msg/s)")
+    print(f"Delivered: {delivered:,} of {expected:,} expected ({delivered / max(1, expected):.1%}) "
+          f"at {delivered / (elapsed + args.drain):,.0f} msg/s")
+    print(f"{'Latency (ms)':<28}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}   delivered")
+    for group in groups.values():
+        if group.sockets:
+            stats = percentiles(group.latencies)
+            print(f"  {group.name:<26}" + "".join(f"{stats[k]:>9.1f}" for k in ("p50", "p90", "p99", "max"))
+                  + f"   {len(group.latencies):,}/{group.expected:,}"
+                  + (f" ({group.closed} closed)" if group.closed else ""))
+    for label, lag in (("Server event-loop lag", loaded["lag"]), ("Load generator loop lag", percentiles(probe.take()))):
+        print(f"{label + ' (ms)':<28}" + "".join(f"{lag[k]:>9.1f}" for k in ("p50", "p90", "p99", "max")))
+
+    # The server goes first, so the sockets close by connection loss rather
+    # than thousands of close handshakes with slow readers.
+    return sockets
+
+
+def run():
+    parser = argparse.ArgumentParser(description='WebSocket fan-out load benchmark')
+    parser.add_argument('--dashboards', type=int, default=200, help='Simulated dashboards (/ws)')
+    parser.add_argument('--clients', type=int, default=1000, help='Simulated web clients (/ws/client)')
+    parser.add_argument('--slow', type=float, default=0.05, help='Fraction of sockets that are slow readers')
+    parser.add_argument('--slow-delay', type=float, default=0.1, help='Seconds a slow reader takes over each frame')
+    parser.add_argument('--topics', type=int, default=50, help='Topics the load is spread over')
+    parser.add_argument('--subscriptions', type=int, default=3, help='Topics each web client subscribes to')
+    parser.add_argument('--rate', type=float, default=200, help='Messages/second published')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to publish for')
+    parser.add_argument('--drain', type=float, default=2, help='Seconds to keep receiving after publishing stops')
+    parser.add_argument('--concurrency', type=int, default=100, help='WebSocket handshakes in flight at once')
+    parser.add_argument('--gateways', type=int, default=0,
+                        help='Serve WebSockets from this many gateway processes (as main.py --gateways)')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for topic mixes and slow reader choice')
+    parser.add_argument('--serve', nargs=3, type=int, metavar=('BROKER_PORT', 'WEB_PORT', 'GATEWAYS'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(*args.serve)
+        return
+
+    raise_file_limit()
+    broker_port, web_port = free_port(), free_port()
+    root = os.path.dirname(HERE)
+    broker = subprocess.Popen([sys.executable, os.path.join(HERE, "stand_in_broker.py"), "--port", str(broker_port)])
+    server = None
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", broker_port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        # The server's per-message logging goes to /dev/null, but is still paid for
+        server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", str(broker_port), str(web_port),
+                                   str(args.gateways)],
+                                  cwd=root, stdout=subprocess.DEVNULL)
+        asyncio.run(run_load(args, broker_port, web_port))
+    finally:
+        for process in (server, broker):
+            if process:
+                process.terminate()
+                process.wait()
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,158 @@
+import argparse
+import queue
+import struct
+import threading
+import time
+
+# Capture files are append-only: a magic header, then a stream of records.
+# Topics are written once, as a TOPIC record assigning them a numeric ID,
+# and every MESSAGE record after that refers to the ID instead of repeating
+# the topic string.
+MAGIC = b"SBCAP1\n"
+TOPIC = 0
+MESSAGE = 1
+
+_KIND = struct.Struct("<B")
+_TOPIC = struct.Struct("<IH")       # topic id, topic length
+_MESSAGE = struct.Struct("<dII")    # timestamp, topic id, payload length
+
+_STOP = object()
+
+
+class TrafficCapture:
+    """
+    Records inbound traffic to a capture file. record() only enqueues, so
+    the MQTT thread never waits on disk; a background thread does the
+    encoding and writing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._queue = queue.SimpleQueue()
+        self._topic_ids = {}
+        self._file = open(path, "wb")
+        self._file.write(MAGIC)
+        self._thread = threading.Thread(target=self._run, name="capture-writer", daemon=True)
+        self._thread.start()
+
+    def record(self, topic, payload, ts=None):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self._queue.put((time.time() if ts is None else ts, topic, payload))
+
+    def close(self):
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _run(self):
+        write = self._file.write
+        while True:
+            item = self._queue.get()
+            # Drain whatever has queued up before flushing, so bursts are
+            # written in one go.
+            while item is not _STOP:
+                ts, topic, payload = item
+                topic_id = self._topic_ids.get(topic)
+                if topic_id is None:
+                    topic_id = self._topic_ids[topic] = len(self._topic_ids)
+                    topic_bytes = topic.encode()
+                    write(_KIND.pack(TOPIC) + _TOPIC.pack(topic_id, len(topic_bytes)) + topic_bytes)
+                write(_KIND.pack(MESSAGE) + _MESSAGE.pack(ts, topic_id, len(payload)) + payload)
+                self.count += 1
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._file.flush()
+            if item is _STOP:
+                self._file.close()
+                return
+
+
+def read_capture(path):
+    """Yield (timestamp, topic, payload) for every message in a capture file."""
+    topics = {}
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"'{path}' is not a Spacebrew capture file")
+        while True:
+            kind = f.read(_KIND.size)
+            if not kind:
+                return
+            if kind[0] == TOPIC:
+                topic_id, length = _TOPIC.unpack(f.read(_TOPIC.size))
+                topics[topic_id] = f.read(length).decode()
+            elif kind[0] == MESSAGE:
+                header = f.read(_MESSAGE.size)
+                if len(header) < _MESSAGE.size:
+                    return  # Truncated final record (capture still being written)
+                ts, topic_id, length = _MESSAGE.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length:
+                    return
+                yield ts, topics[topic_id], payload
+            else:
+                raise ValueError(f"Corrupt capture file '{path}'")
+
+
+def replay(path, send, speed=1.0, stop_event=None):
+    """
+    Feed a capture to send(topic, payload), preserving the original timing
+    scaled by `speed` (2.0 = twice as fast). A speed of 0 replays as fast as
+    possible. Returns (messages sent, seconds taken).
+    """
+    count = 0
+    start = time.perf_counter()
+    first_ts = None
+    for ts, topic, payload in read_capture(path):
+        if stop_event is not None and stop_event.is_set():
+            break
+        if speed > 0:
+            if first_ts is None:
+                first_ts = ts
+            delay = start + (ts - first_ts) / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        send(topic, payload)
+        count += 1
+    return count, time.perf_counter() - start
+
+
+def direct_sender(mqtt_service):
+    """send() for replay() that bypasses the broker and calls on_message directly."""
+    from paho.mqtt.client import MQTTMessage
+
+    def send(topic, payload):
+        msg = MQTTMessage(topic=topic.encode())
+        msg.payload = payload
+        mqtt_service.on_message(mqtt_service.client, None, msg)
+
+    return send
+
+
+def run():
+    # Standalone replay against a broker, e.g. from a second machine while
+    # the router under test runs normally.
+    from paho.mqtt import client as mqtt_client
+
+    parser = argparse.ArgumentParser(description='Replay a Spacebrew 2.0 traffic capture')
+    parser.add_argument('file', help='Capture file written with main.py --capture')
+    parser.add_argument('--server', type=str, default='localhost', help='MQTT Broker address')
+    parser.add_argument('--port', type=int, default=1883, help='MQTT Broker port')
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay speed multiplier (0 = as fast as possible)')
+    args = parser.parse_args()
+
+    client = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION1, f'Spacebrew2_Replay_{int(time.time())}')
+    client.connect(args.server, args.port)
+    client.loop_start()
+    try:
+        count, elapsed = replay(args.file, lambda topic, payload: client.publish(topic, payload, qos=1), args.speed)
+        print(f"Replayed {count} messages in {elapsed:.2f}s ({count / elapsed if elapsed else 0:.0f} msg/s)")
+    finally:
+        client.disconnect()
+        client.loop_stop()
+
+
+if __name__ == '__main__':
+    run()
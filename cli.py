@@ -1,12 +1,22 @@
 import cmd
+import json
 import sys
 import os
+import time
+import threading
+from capture import replay, direct_sender
+import profiler
 
 class SpacebrewCLI(cmd.Cmd):
-    def __init__(self, router, mqtt_service):
+    def __init__(self, router, mqtt_service, spaces=None):
         super().__init__()
         self.router = router
         self.mqtt_service = mqtt_service
+        # The broker connection, whichever space the CLI is managing (see
+        # do_space); router and mqtt_service are the current space's.
+        self.connection = mqtt_service
+        # Space name -> (router, mqtt_service), with None for the default space
+        self.spaces = {None: (router, mqtt_service), **(spaces or {})}
         self.prompt = '>> '
         self.intro = 'Welcome to Spacebrew 2.0. Type "help" for available commands.'
 
@@ -17,7 +27,7 @@ class SpacebrewCLI(cmd.Cmd):
     def do_quit(self, line):
         """Exit the CLI and stop the MQTT loop."""
         print("Stopping MQTT loop and exiting.")
-        self.mqtt_service.stop()
+        self.connection.stop()
         # We might need to kill the web server too, but it runs in main thread usually.
         # If CLI is in a thread, we can't easily kill the main thread uvicorn.
         # Usually we just exit the process.
@@ -32,7 +42,14 @@ class SpacebrewCLI(cmd.Cmd):
 
         print("--- Current Routes ---")
         for pub, sub in self.router.routes.items():
-            print(f"  {pub} -> {sub}")
+            condition = self.router.route_conditions.get(pub)
+            policy = self.router.spool_policies.get(pub)
+            line = f"  {pub} -> {sub}"
+            if condition:
+                line += f"  [if {condition}]"
+            if policy:
+                line += f"  [spool: {policy}]"
+            print(line)
         print("----------------------")
         print(f"Total routes: {len(self.router.routes)}")
 
@@ -45,18 +62,21 @@ class SpacebrewCLI(cmd.Cmd):
             
     def do_addroute(self, line):
         """
-        Add a new route. Usage: addroute <publisher_topic> <subscriber_topic>
+        Add a new route. Usage: addroute <publisher_topic> <subscriber_topic> [condition]
+        The optional condition only forwards matching messages, e.g.
+        `value > 500`, `value == "true"` or `value.temp >= 21.5`.
         Note: Topics must not contain spaces. Automatically saves on success.
         """
         try:
-            parts = line.split()
-            if len(parts) != 2:
-                raise ValueError("Requires exactly two arguments: publisher and subscriber topic.")
+            parts = line.split(None, 2)
+            if len(parts) < 2:
+                raise ValueError("Requires at least two arguments: publisher and subscriber topic.")
 
             pub = parts[0].strip()
             sub = parts[1].strip()
+            condition = parts[2].strip() if len(parts) == 3 else None
             
-            success, msg = self.router.add_route(pub, sub)
+            success, msg = self.router.add_route(pub, sub, condition)
             if success:
                 print(f"✅ {msg}")
             else:
@@ -64,7 +84,7 @@ class SpacebrewCLI(cmd.Cmd):
         
         except ValueError as e:
             print(f"Error: {e}")
-            print("Usage: addroute <publisher_topic> <subscriber_topic>")
+            print("Usage: addroute <publisher_topic> <subscriber_topic> [condition]")
         except Exception as e:
             print(f"An unexpected error occurred: {e}")
 
@@ -84,9 +104,223 @@ class SpacebrewCLI(cmd.Cmd):
         else:
             print(f"❌ {msg}")
 
+    def do_top(self, line):
+        """
+        List clients by inbound traffic, busiest first. Usage: top [count]
+        Clients flagged ⚠️ have gone over their quota in the last few seconds.
+        """
+        try:
+            limit = int(line) if line.strip() else 20
+        except ValueError:
+            print("Usage: top [count]")
+            return
+        rows = self.router.traffic.top(limit)
+        if not rows:
+            print("No traffic from registered clients yet.")
+            return
+        print(f"  {'Client':<30} {'msg/s':>8} {'bytes/s':>10} {'messages':>10} {'dropped':>9}  quota")
+        for row in rows:
+            quota = ", ".join(filter(None, (
+                f"{row['message_quota']:g} msg/s" if row['message_quota'] else None,
+                f"{row['byte_quota']:g} B/s" if row['byte_quota'] else None,
+            ))) or "none"
+            flag = " ⚠️" if row["over_quota"] else ""
+            print(f"  {row['name']:<30} {row['messages_per_sec']:>8} {row['bytes_per_sec']:>10}"
+                  f" {row['messages']:>10} {row['dropped']:>9}  {quota}{flag}")
+
+    def do_loss(self, line):
+        """
+        Show where messages have been dropped: totals per stage, then each
+        route's counts from received to published. Usage: loss
+        """
+        report = self.router.loss.report(self.router.routes)
+        drops = [f"{stage}/{reason}: {count}" for stage, reasons in report["stages"].items()
+                 for reason, count in reasons.items() if count]
+        print(f"Drops: {', '.join(drops) if drops else 'none'}")
+        if not report["routes"]:
+            return
+        print(f"  {'Route':<50} {'received':>9} {'filtered':>9} {'forwarded':>9} {'published':>9}  dropped")
+        for route in report["routes"]:
+            dropped = ", ".join(f"{reason} {count}" for reason, count in route["dropped"].items()) or "-"
+            print(f"  {route['pub'] + ' -> ' + route['sub']:<50} {route['received']:>9} {route['filtered']:>9}"
+                  f" {route['forwarded']:>9} {route['published']:>9}  {dropped}")
+
+    def do_health(self, line):
+        """
+        Show whether the router's threads are holding each other up: event
+        loop lag and stalls (with the stack of the latest), how long work
+        handed between threads waits, GIL wait, and CPU time per thread.
+        Usage: health
+        """
+        health = self.router.health
+        if not health:
+            print("Health monitoring is off (--stall-threshold 0).")
+            return
+        report = health.report()
+        loop = report["loop"]
+
+        def line_for(name, stats):
+            print(f"  {name:<14} p50 {stats['p50_ms']:>8.2f} ms  p99 {stats['p99_ms']:>8.2f} ms"
+                  f"  max {stats['max_ms']:>8.2f} ms  ({stats['count']} samples)")
+
+        if loop["watched"]:
+            line_for("Loop lag", loop["lag"])
+            line_for("Loop handoff", loop["handoff"])
+        else:
+            print("  Event loop not watched (headless, or the web server hasn't started)")
+        line_for("Outbox wait", self.mqtt_service.outbox_wait.stats())
+        gil = report["gil"]
+        line_for("GIL wait", gil)
+        print(f"  GIL wait is {gil['wait_fraction']:.1%} of the watchdog's time"
+              f" (switch interval {gil['switch_interval_ms']:g} ms)")
+        if report["thread_cpu_seconds"]:
+            busiest = sorted(report["thread_cpu_seconds"].items(), key=lambda item: -item[1])
+            print("  CPU seconds: " + ", ".join(f"{name} {seconds:g}" for name, seconds in busiest[:6]))
+        print(f"Stalls over {report['threshold_ms']:g} ms: {loop['stalls']}")
+        if loop["recent_stalls"]:
+            stall = loop["recent_stalls"][0]
+            print(f"  Latest: {stall['duration_ms']:g} ms at {time.strftime('%H:%M:%S', time.localtime(stall['at']))}, in:")
+            for frame in stall["stack"][-8:]:
+                print(f"    {frame}")
+
+    def do_quota(self, line):
+        """
+        Set a client's traffic quota, overriding the default for it.
+        Usage: quota <client_name> <messages_per_sec|-> [bytes_per_sec|-]
+        Quotas must be positive; use - for no limit. Excess messages are dropped (or down-sampled
+        with --quota-mode sample).
+        """
+        parts = line.split()
+        try:
+            if len(parts) not in (2, 3):
+                raise ValueError
+            messages = None if parts[1] == '-' else float(parts[1])
+            size = None if len(parts) < 3 or parts[2] == '-' else float(parts[2])
+        except ValueError:
+            print("Usage: quota <client_name> <messages_per_sec|-> [bytes_per_sec|-]")
+            return
+        # 0 would read as "unlimited" rather than "nothing at all"
+        if any(value is not None and not value > 0 for value in (messages, size)):
+            print("⚠️  Quotas must be positive; use - for no limit")
+            return
+        self.router.traffic.set_quota(parts[0], messages, size)
+        print(f"✅ Quota for {parts[0]}: {f'{messages:g}' if messages else 'unlimited'} messages/s,"
+              f" {f'{size:g}' if size else 'unlimited'} bytes/s")
+
+    def do_profile(self, line):
+        """
+        Sample all threads' stacks to see where the router spends its time.
+        Usage: profile [seconds] [output_file] [rate]
+        Defaults to 10 seconds at 100 samples/s. Prints the busiest
+        functions; with an output file, also saves a flame graph profile
+        (speedscope JSON if it ends in .json, collapsed stacks otherwise).
+        """
+        parts = line.split()
+        try:
+            seconds = float(parts[0]) if parts else 10.0
+            path = parts[1] if len(parts) > 1 else None
+            rate = int(parts[2]) if len(parts) > 2 else 100
+        except ValueError:
+            print("Usage: profile [seconds] [output_file] [rate]")
+            return
+
+        print(f"🔬 Profiling for {seconds:g}s at {rate} samples/s...")
+        try:
+            profile = profiler.sample(seconds, rate)
+        except RuntimeError as e:
+            print(f"❌ {e}")
+            return
+
+        total = sum(profile.samples.values())
+        print(f"--- Busiest functions ({total} stack samples, {profile.overhead:.2%} sampling overhead) ---")
+        for (name, path_, line_no), count in profile.top():
+            print(f"  {count / total:6.1%}  {name} ({os.path.basename(path_)}:{line_no})")
+        if path:
+            try:
+                with open(path, 'w') as f:
+                    if path.endswith('.json'):
+                        json.dump(profile.speedscope(), f)
+                    else:
+                        f.write(profile.collapsed())
+                print(f"✅ Saved profile to '{path}' (open it at https://www.speedscope.app)")
+            except OSError as e:
+                print(f"❌ Could not save profile: {e}")
+
+    def do_history(self, line):
+        """
+        Show recent messages on a topic. Usage: history <topic> [seconds] [limit]
+        Example: history VirtualButton1/button 60
+        """
+        parts = line.split()
+        if not parts or len(parts) > 3:
+            print("Usage: history <topic> [seconds] [limit]")
+            return
+
+        try:
+            since = time.time() - float(parts[1]) if len(parts) > 1 else None
+            limit = int(parts[2]) if len(parts) > 2 else 20
+        except ValueError:
+            print("Usage: history <topic> [seconds] [limit]")
+            return
+
+        entries = self.router.history.query(parts[0], since=since, limit=limit)
+        if not entries:
+            print(f"No history for topic '{parts[0]}'.")
+            return
+
+        print(f"--- History: {parts[0]} ---")
+        for entry in entries:
+            stamp = time.strftime("%H:%M:%S", time.localtime(entry["ts"]))
+            print(f"  {stamp}.{int(entry['ts'] % 1 * 1000):03d}  {entry['message']}")
+        print("----------------------")
+        print(f"Shown: {len(entries)} messages")
+
+    def do_replay(self, line):
+        """
+        Replay a traffic capture in the background. Usage: replay <file> [speed] [direct]
+        speed is a multiplier (default 1, 0 = as fast as possible). With
+        `direct`, messages go straight into the router instead of via the broker.
+        Example: replay show.sbcap 10
+        """
+        parts = line.split()
+        if not parts or len(parts) > 3:
+            print("Usage: replay <file> [speed] [direct]")
+            return
+
+        path = parts[0]
+        try:
+            speed = float(parts[1]) if len(parts) > 1 else 1.0
+        except ValueError:
+            print("Usage: replay <file> [speed] [direct]")
+            return
+        direct = len(parts) > 2 and parts[2] == "direct"
+
+        if not os.path.exists(path):
+            print(f"❌ Error: '{path}' not found.")
+            return
+
+        if direct:
+            send = direct_sender(self.connection)
+        else:
+            send = self.connection.publish
+
+        def run_replay():
+            try:
+                count, elapsed = replay(path, send, speed)
+                rate = count / elapsed if elapsed else 0
+                print(f"✅ Replayed {count} messages from '{path}' in {elapsed:.2f}s ({rate:.0f} msg/s)")
+            except Exception as e:
+                print(f"❌ Error replaying '{path}': {e}")
+
+        print(f"▶️  Replaying '{path}' at {'max' if speed <= 0 else f'{speed:g}x'} speed"
+              f"{' directly into the router' if direct else ' through the broker'}...")
+        threading.Thread(target=run_replay, name="replay", daemon=True).start()
+
     def do_server(self,line):
         """Show the current broker and port."""
         print(f"Broker: {self.mqtt_service.broker}, Port: {self.mqtt_service.port}")
+        for bridge in self.mqtt_service.bridges:
+            print(f"Bridge {bridge.name}: {bridge.broker}, Port: {bridge.port} (topics as {bridge.name}:<topic>)")
     
     def do_clients(self,line):
         """Show the names of currently registered clients."""
@@ -102,10 +336,50 @@ class SpacebrewCLI(cmd.Cmd):
 
     def do_connection(self, line):
         """Check the current MQTT server connection status."""
-        if self.mqtt_service.client.is_connected():
-            print(f"🟢 **Connected** to MQTT Broker at {self.mqtt_service.broker}:{self.mqtt_service.port}")
+        if self.connection.client.is_connected():
+            print(f"🟢 **Connected** to MQTT Broker at {self.connection.broker}:{self.connection.port}")
         else:
-            print(f"🔴 **Disconnected** from MQTT Broker at {self.mqtt_service.broker}:{self.mqtt_service.port}")
+            print(f"🔴 **Disconnected** from MQTT Broker at {self.connection.broker}:{self.connection.port}"
+                  f" (reconnect attempt {self.connection.reconnect_attempts})")
+        spool = self.connection.spool.stats()
+        print(f"   Reconnects: {self.connection.reconnects}, spooled: {spool['depth']}"
+              f" ({spool['disk']} on disk), dropped from spool: {spool['dropped']}")
+        for bridge in self.connection.bridges:
+            state = "🟢 Connected" if bridge.client.is_connected() else "🔴 Disconnected"
+            print(f"   Bridge {bridge.name} ({bridge.broker}:{bridge.port}): {state},"
+                  f" {bridge.reconnects} reconnects, {len(bridge.spool)} spooled")
+
+    def do_space(self, line):
+        """
+        List the spaces this router hosts, or switch the space the other
+        commands manage. Usage: space [name|-]  (- for the default space)
+        """
+        name = line.strip()
+        if not name:
+            for space, (router, _) in self.spaces.items():
+                marker = "*" if router is self.router else " "
+                print(f" {marker} {space or '(default)':<30} {len(router.clients):>5} clients {len(router.routes):>5} routes")
+            return
+        key = None if name == '-' else name
+        if key not in self.spaces:
+            print(f"❌ No space named '{name}'. Type `space` to list them.")
+            return
+        self.router, self.mqtt_service = self.spaces[key]
+        self.prompt = f'{key}>> ' if key else '>> '
+        print(f"✅ Managing {f'space {key}' if key else 'the default space'}")
+
+    def do_spoolpolicy(self, line):
+        """
+        Set what a route drops if its output overflows the spool while the
+        broker is down. Usage: spoolpolicy <publisher_topic> <policy>
+        Policies: drop-oldest (default), drop-newest, latest-only.
+        """
+        parts = line.split()
+        if len(parts) != 2:
+            print("Usage: spoolpolicy <publisher_topic> <drop-oldest|drop-newest|latest-only>")
+            return
+        success, msg = self.router.set_spool_policy(parts[0], parts[1])
+        print(f"✅ {msg}" if success else f"❌ Error: {msg}")
 
     def do_testclient(self, line):
         """
@@ -139,6 +413,9 @@ class SpacebrewCLI(cmd.Cmd):
                 raise ValueError("Missing topic or message.")
             
             result = self.mqtt_service.publish(topic, message)
+            if result is None:
+                print(f"📦 Broker disconnected; '{message}' to topic '{topic}' spooled until reconnected")
+                return
             status = result[0]
             
             if status == 0:
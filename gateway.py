@@ -0,0 +1,376 @@
+"""
+Multi-process WebSocket gateways.
+
+With `main.py --gateways N`, the router process stops serving the web
+interface itself. It starts N gateway processes that share one listening
+socket and feeds them over a Unix-domain socket. The gateways own every
+WebSocket (the per-socket fan-out and encoding), and the router process
+only routes. The feed carries:
+
+    router -> gateway   {"hello": {"snapshot": [...], "violators": [...]}}
+                        {"dashboard": event}     (everything sent to /ws)
+                        {"topic": t, "message": m, "ts": ..., "client": ...}
+                                                 (data messages for /ws/client)
+                        {"id": n, "status": ..., "headers": [...], "body": b64}
+    gateway -> router   {"publish": [[topic, payload], ...]}
+                        (bytes payloads, from MessagePack clients, as
+                        [topic, base64 payload, "b64"])
+                        {"leave": client name}
+                        {"dropped": [stage, reason, topic, count]}
+                        {"id": n, "http": {...}} (an HTTP request to proxy)
+
+HTTP requests are proxied to the router's own FastAPI app, so the REST API
+behaves exactly as it does without gateways.
+
+Each frame is a 4-byte big-endian length followed by compact JSON.
+"""
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import os
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from ws_codec import dumps
+
+# A gateway that falls this far behind the feed is disconnected (and so
+# restarted) rather than buffering without bound in the router process.
+MAX_GATEWAY_BACKLOG = 32 * 1024 * 1024
+
+
+def encode_frame(message):
+    data = dumps(message).encode()
+    return struct.pack(">I", len(data)) + data
+
+
+async def read_frame(reader):
+    length = struct.unpack(">I", await reader.readexactly(4))[0]
+    return json.loads(await reader.readexactly(length))
+
+
+def encode_publishes(messages):
+    """(topic, payload) pairs as "publish" feed entries; JSON can't carry bytes, so those go as base64."""
+    return [[topic, base64.b64encode(payload).decode(), "b64"] if isinstance(payload, bytes) else [topic, payload]
+            for topic, payload in messages]
+
+
+def decode_publishes(entries):
+    """The (topic, payload) pairs back from encode_publishes() entries."""
+    return [(entry[0], base64.b64decode(entry[1])) if len(entry) > 2 else (entry[0], entry[1])
+            for entry in entries]
+
+
+class DashboardFeed:
+    """Stands in for the router process's ConnectionManager: broadcasts go to every gateway."""
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    async def broadcast(self, message: dict):
+        self.hub.send_all({"dashboard": message})
+
+
+class ClientFeed:
+    """Stands in for the router process's WebClientManager."""
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    async def broadcast(self, topic: str, message: str):
+        # Pass the cached timestamp and publisher along, so the gateways'
+        # last-value mirrors match the router's (no timestamp: not cached,
+        # e.g. a control topic).
+        entry = self.hub.web_service.router.last_values.get(topic)
+        ts, client = (entry[1], entry[2]) if entry else (None, None)
+        self.hub.send_all({"topic": topic, "message": message, "ts": ts, "client": client})
+
+
+class GatewayHub:
+    """
+    The router process's side of the gateway feed: a Unix-domain socket
+    server on its own event loop thread, plus the gateway processes it
+    starts and restarts. The web server's managers are swapped for feeds,
+    so its existing callbacks send to gateways instead of sockets.
+    """
+
+    def __init__(self, web_service, path):
+        self.web_service = web_service
+        self.path = path
+        self.gateways = []
+        self.processes = []
+        self.loop = asyncio.new_event_loop()
+        self.stopping = False
+        web_service.manager = DashboardFeed(self)
+        web_service.web_client_manager = ClientFeed(self)
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(asyncio.start_unix_server(self.handle_gateway, self.path))
+            self.web_service.loop = self.loop
+            self.loop.create_task(self.web_service.watch_traffic())
+            if self.web_service.router.health:
+                self.web_service.router.health.watch_loop(self.loop)
+            ready.set()
+            self.loop.run_forever()
+
+        threading.Thread(target=run, name="gateway-hub", daemon=True).start()
+        ready.wait()
+
+    def send_all(self, message):
+        # Encoded once, whatever the number of gateways. Runs on the hub loop.
+        frame = encode_frame(message)
+        for writer in list(self.gateways):
+            if writer.transport.get_write_buffer_size() > MAX_GATEWAY_BACKLOG:
+                print("⚠️  Gateway fell too far behind; disconnecting it")
+                self.web_service.router.loss.dropped("websocket", "gateway_evicted")
+                self.gateways.remove(writer)
+                writer.transport.abort()
+                continue
+            writer.write(frame)
+
+    async def handle_gateway(self, reader, writer):
+        router = self.web_service.router
+        writer.write(encode_frame({"hello": {
+            "snapshot": router.last_values.snapshot(),
+            "violators": self.web_service.violators,
+        }}))
+        self.gateways.append(writer)
+        try:
+            while True:
+                message = await read_frame(reader)
+                if "publish" in message:
+                    self.web_service.mqtt_service.publish_batch(decode_publishes(message["publish"]))
+                elif "leave" in message:
+                    router.remove_client(message["leave"])
+                elif "dropped" in message:
+                    router.loss.dropped(*message["dropped"])
+                elif "http" in message:
+                    asyncio.ensure_future(self.proxy_http(writer, message["id"], message["http"]))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if writer in self.gateways:
+                self.gateways.remove(writer)
+            writer.close()
+
+    async def proxy_http(self, writer, request_id, request):
+        """Run one proxied request through the router's FastAPI app (a minimal ASGI call)."""
+        body = base64.b64decode(request["body"])
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": request["method"],
+            "scheme": "http",
+            "path": request["path"],
+            "raw_path": request["path"].encode(),
+            "query_string": request["query"].encode(),
+            "root_path": "",
+            "headers": [(k.encode("latin-1"), v.encode("latin-1")) for k, v in request["headers"]],
+            "client": tuple(request["client"]) if request.get("client") else None,
+            "server": None,
+        }
+        response = {"id": request_id, "status": 500, "headers": [], "body": ""}
+        chunks = []
+
+        async def receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def send(event):
+            if event["type"] == "http.response.start":
+                response["status"] = event["status"]
+                response["headers"] = [(k.decode("latin-1"), v.decode("latin-1")) for k, v in event.get("headers", [])]
+            elif event["type"] == "http.response.body":
+                chunks.append(event.get("body", b""))
+
+        try:
+            await self.web_service.app(scope, receive, send)
+        except Exception as e:
+            print(f"[ERROR] Proxied {request['method']} {request['path']} failed: {e}")
+        response["body"] = base64.b64encode(b"".join(chunks)).decode()
+        if not writer.is_closing():
+            writer.write(encode_frame(response))
+
+    def spawn(self, count, host, port):
+        """Start `count` gateways sharing one listening socket on host:port."""
+        self.listener = socket.create_server((host, port), backlog=1024)
+        self.listener.set_inheritable(True)
+        self.command = [sys.executable, os.path.abspath(__file__),
+                        "--socket", self.path, "--fd", str(self.listener.fileno())]
+        for _ in range(count):
+            self.processes.append(self._spawn_one())
+        print(f"🚀 Serving the web interface from {count} gateway processes at http://{host}:{port}")
+
+    def _spawn_one(self):
+        return subprocess.Popen(self.command, pass_fds=(self.listener.fileno(),))
+
+    def supervise(self):
+        """Block, restarting gateways that exit, until stop() (or Ctrl+C)."""
+        while not self.stopping:
+            for i, process in enumerate(self.processes):
+                if process.poll() is not None and not self.stopping:
+                    print(f"⚠️  Gateway {process.pid} exited ({process.returncode}); restarting it")
+                    self.processes[i] = self._spawn_one()
+            time.sleep(1)
+
+    def stop(self):
+        self.stopping = True
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class RouterLink:
+    """
+    The gateway's view of the router process, standing in for both the
+    router and the MQTT service in SpacebrewWebServer: a mirror of the
+    last-value cache, plus publishes and deregistrations sent up the feed.
+    """
+
+    def __init__(self, writer):
+        from topic_cache import LastValueCache
+        self.writer = writer
+        self.last_values = LastValueCache()
+        # Gateway-side drops are reported to the router's LossTracker
+        self.loss = self
+
+    def publish_batch(self, messages):
+        self.writer.write(encode_frame({"publish": encode_publishes(messages)}))
+
+    def remove_client(self, name):
+        self.writer.write(encode_frame({"leave": name}))
+        return True
+
+    def dropped(self, stage, reason, topic=None, count=1):
+        self.writer.write(encode_frame({"dropped": [stage, reason, topic, count]}))
+
+
+def make_gateway_server(reader, writer, hello):
+    from fastapi import Request
+    from fastapi.responses import Response
+    from web_service import SpacebrewWebServer
+
+    class GatewayWebServer(SpacebrewWebServer):
+        """The WebSocket endpoints, fed by the router process; everything else is proxied to it."""
+
+        def setup_callbacks(self):
+            pass  # Events arrive over the feed instead
+
+        def setup_routes(self):
+            app = self.app
+            self.pending = {}
+            self.request_ids = itertools.count()
+
+            async def startup_event():
+                self.loop = asyncio.get_running_loop()
+                self.loop.create_task(self.read_feed())
+
+            app.router.add_event_handler("startup", startup_event)
+
+            self.setup_websockets()
+
+            @app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS", "HEAD"])
+            async def proxy(request: Request, path: str):
+                request_id = next(self.request_ids)
+                future = self.pending[request_id] = self.loop.create_future()
+                writer.write(encode_frame({"id": request_id, "http": {
+                    "method": request.method,
+                    "path": request.url.path,
+                    "query": request.url.query,
+                    "headers": [(k.decode("latin-1"), v.decode("latin-1")) for k, v in request.headers.raw],
+                    "client": [request.client.host, request.client.port] if request.client else None,
+                    "body": base64.b64encode(await request.body()).decode(),
+                }}))
+                reply = await future
+                response = Response(base64.b64decode(reply["body"]), status_code=reply["status"])
+                response.raw_headers = [(k.encode("latin-1"), v.encode("latin-1")) for k, v in reply["headers"]]
+                return response
+
+        async def read_feed(self):
+            try:
+                while True:
+                    message = await read_frame(reader)
+                    if "dashboard" in message:
+                        event = message["dashboard"]
+                        if "traffic" in event:
+                            self.violators = event["traffic"]["violators"]
+                        asyncio.ensure_future(self.manager.broadcast(event))
+                    elif "topic" in message:
+                        topic, payload = message["topic"], message["message"]
+                        if message["ts"] is not None:
+                            self.router.last_values.put(topic, payload, message["client"], message["ts"])
+                        asyncio.ensure_future(self.web_client_manager.broadcast(topic, payload))
+                    elif "id" in message:
+                        future = self.pending.pop(message["id"], None)
+                        if future and not future.done():
+                            future.set_result(message)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass
+            # Without the feed this gateway is useless; exit so the router
+            # process restarts it (or, if the router is gone, so it stops).
+            print("🔴 Lost the feed from the router process; gateway exiting")
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    link = RouterLink(writer)
+    for entry in hello["snapshot"]:
+        link.last_values.put(entry["topic"], entry["message"], entry["client"], entry["ts"])
+    server = GatewayWebServer(link, link)
+    server.violators = hello["violators"]
+    return server
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Spacebrew WebSocket gateway (started by main.py --gateways)')
+    parser.add_argument('--socket', type=str, required=True, help="The router process's gateway socket")
+    parser.add_argument('--fd', type=int, default=None, help='Inherited listening socket to serve on')
+    parser.add_argument('--host', type=str, default='0.0.0.0', help='Address to listen on, without --fd')
+    parser.add_argument('--port', type=int, default=8088, help='Port to listen on, without --fd')
+    args = parser.parse_args()
+
+    import uvicorn
+
+    if args.fd is not None:
+        listener = socket.socket(fileno=args.fd)
+    else:
+        # Started by hand: several gateways can share the port where the
+        # platform has SO_REUSEPORT.
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if hasattr(socket, "SO_REUSEPORT"):
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listener.bind((args.host, args.port))
+        listener.listen(1024)
+
+    async def serve():
+        reader, writer = await asyncio.open_unix_connection(args.socket)
+        hello = (await read_frame(reader))["hello"]
+        server = make_gateway_server(reader, writer, hello)
+        config = uvicorn.Config(server.app, log_level="error")
+        await uvicorn.Server(config).serve(sockets=[listener])
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,195 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+
+class WaitStats:
+    """
+    How long things wait somewhere (a queue, a thread handoff, the GIL):
+    totals since startup, and percentiles over the most recent waits.
+    """
+
+    def __init__(self, window=1024):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=window)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.recent.append(seconds)
+
+    def stats(self):
+        recent = sorted(self.recent)
+
+        def percentile(q):
+            return round(recent[min(len(recent) - 1, int(q * len(recent)))] * 1000, 3) if recent else 0.0
+
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            "p50_ms": percentile(0.5),
+            "p99_ms": percentile(0.99),
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+
+def format_stack(frame, limit=20):
+    """A thread's stack from the outermost call in, as "function (file:line)" strings, innermost `limit` only."""
+    stack = []
+    while frame is not None and len(stack) < limit:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def thread_cpu():
+    """CPU seconds used so far by each live thread, by name. Linux only; empty elsewhere."""
+    try:
+        ticks = os.sysconf("SC_CLK_TCK")
+    except (AttributeError, ValueError, OSError):
+        return {}
+    usage = {}
+    for thread in threading.enumerate():
+        try:
+            with open(f"/proc/self/task/{thread.native_id}/stat") as f:
+                # Fields after the ")" closing the command name start at the
+                # state (field 3); utime and stime are fields 14 and 15.
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        usage[thread.name] = round((int(fields[11]) + int(fields[12])) / ticks, 2)
+    return usage
+
+
+class HealthMonitor:
+    """
+    Watches for the router's threads getting in each other's way:
+    - loop lag: how late a task sleeping on the web event loop wakes up,
+      i.e. how long other callbacks kept it waiting;
+    - stalls: a callback holding the loop for longer than `threshold`
+      seconds, with its stack, taken by a watchdog thread while it runs;
+    - loop handoff: how long a callback scheduled onto the loop from
+      another thread (as paho's thread does for every broadcast) waits;
+    - GIL wait: how late the watchdog thread wakes from its own short
+      sleeps, which is mostly waiting for the GIL while other threads
+      hold it.
+    The watchdog wakes every `interval` seconds; the loop is only watched
+    once watch_loop() has been called on it.
+    """
+
+    def __init__(self, threshold=0.1, interval=0.02, handoff_interval=0.5, max_stalls=20):
+        self.threshold = threshold
+        self.interval = interval
+        self.handoff_interval = handoff_interval
+        self.lag = WaitStats()
+        self.handoff = WaitStats()
+        self.gil = WaitStats()
+        self.stalls = deque(maxlen=max_stalls)
+        self.stall_count = 0
+        self.loop = None
+        self._loop_thread = None
+        # When the loop last started its sleep, and the stall (if any)
+        # found since then
+        self._last_tick = None
+        self._stall = None
+        self._handoff_pending = False
+        self._stop = threading.Event()
+        self._thread = None
+        self._started = time.perf_counter()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="health-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    def watch_loop(self, loop):
+        """Start watching an event loop. Call from the thread running it."""
+        self.loop = loop
+        self._loop_thread = threading.get_ident()
+        loop.create_task(self._tick())
+
+    async def _tick(self):
+        interval = self.interval
+        while True:
+            start = self._last_tick = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.lag.add(max(0.0, time.perf_counter() - start - interval))
+
+    def _handoff_done(self, sent):
+        self.handoff.add(time.perf_counter() - sent)
+        self._handoff_pending = False
+
+    def _run(self):
+        interval = self.interval
+        next_handoff = time.perf_counter()
+        while not self._stop.is_set():
+            before = time.perf_counter()
+            time.sleep(interval)
+            now = time.perf_counter()
+            self.gil.add(max(0.0, now - before - interval))
+            if self.loop is None:
+                continue
+            self._check_loop(now)
+            # One handoff probe in flight at a time, so a blocked loop
+            # doesn't pile them up
+            if now >= next_handoff and not self._handoff_pending:
+                self._handoff_pending = True
+                next_handoff = now + self.handoff_interval
+                try:
+                    self.loop.call_soon_threadsafe(self._handoff_done, now)
+                except RuntimeError:
+                    self.loop = None  # Loop closed
+
+    def _check_loop(self, now):
+        last = self._last_tick
+        if last is None:
+            return
+        blocked = now - last - self.interval
+        if blocked <= self.threshold:
+            return
+        stall = self._stall
+        if stall is None or stall["tick"] != last:
+            # A new stall: whatever the loop thread is running now is what's
+            # holding it up
+            stack = format_stack(sys._current_frames().get(self._loop_thread))
+            stall = self._stall = {"tick": last, "at": time.time(), "duration_ms": 0.0, "stack": stack}
+            self.stall_count += 1
+            self.stalls.append(stall)
+            print(f"⚠️  Event loop blocked for over {self.threshold * 1000:.0f} ms"
+                  f"{f' in {stack[-1]}' if stack else ''}")
+        stall["duration_ms"] = round(blocked * 1000, 1)
+
+    def report(self):
+        elapsed = time.perf_counter() - self._started
+        return {
+            "threshold_ms": self.threshold * 1000,
+            "loop": {
+                "watched": self.loop is not None,
+                "lag": self.lag.stats(),
+                "handoff": self.handoff.stats(),
+                "stalls": self.stall_count,
+                # Newest first; durations of a stall still in progress keep growing
+                "recent_stalls": [{key: value for key, value in stall.items() if key != "tick"}
+                                  for stall in reversed(self.stalls)],
+            },
+            "gil": {
+                **self.gil.stats(),
+                "wait_fraction": round(self.gil.total / elapsed, 4) if elapsed else 0.0,
+                "switch_interval_ms": sys.getswitchinterval() * 1000,
+            },
+            "thread_cpu_seconds": thread_cpu(),
+        }
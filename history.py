@@ -0,0 +1,254 @@
+import mmap
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+# Same rough per-entry bookkeeping cost as the last-value cache.
+from topic_cache import ENTRY_OVERHEAD
+
+# On-disk record: timestamp, topic length, payload length, topic, payload.
+_RECORD_HEADER = struct.Struct("<dHI")
+
+# Rough fixed cost of a topic's ring (the ring, its array and list, and its
+# OrderedDict entry), and of each allocated slot (a double and a pointer).
+RING_OVERHEAD = 320
+SLOT_BYTES = 16
+
+
+class _Ring:
+    """
+    Ring of (timestamp, payload) for one topic, holding up to `capacity`
+    entries. Slots are allocated as it fills (doubling), so the many topics
+    that only ever see a few messages stay small. `size` counts the slots
+    and fixed overhead as well as the entries.
+    """
+
+    __slots__ = ("times", "payloads", "start", "count", "size", "capacity")
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array("d")
+        self.payloads = []
+        self.start = 0
+        self.count = 0
+        self.size = RING_OVERHEAD
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        # Logical (oldest-first) timestamp lookup, so bisect can search the
+        # ring directly.
+        return self.times[(self.start + i) % len(self.payloads)]
+
+    def _grow(self):
+        # Unroll oldest-first into twice the slots (up to capacity).
+        allocated = len(self.payloads)
+        slots = min(self.capacity, max(4, allocated * 2))
+        order = [(self.start + n) % allocated for n in range(self.count)]
+        self.times = array("d", [self.times[i] for i in order]) + array("d", bytes(8 * (slots - self.count)))
+        self.payloads = [self.payloads[i] for i in order] + [None] * (slots - self.count)
+        self.start = 0
+        self.size += (slots - allocated) * SLOT_BYTES
+
+    def append(self, ts, payload):
+        """Append an entry, returning the (ts, payload) it overwrote, if any."""
+        evicted = None
+        if self.count == len(self.payloads):
+            if self.count < self.capacity:
+                self._grow()
+            else:
+                evicted = self.pop()
+        capacity = len(self.payloads)
+        i = (self.start + self.count) % capacity
+        self.times[i] = ts
+        self.payloads[i] = payload
+        self.count += 1
+        self.size += len(payload) + ENTRY_OVERHEAD
+        return evicted
+
+    def pop(self):
+        """Remove and return the oldest (ts, payload)."""
+        i = self.start
+        entry = (self.times[i], self.payloads[i])
+        self.payloads[i] = None
+        self.start = (i + 1) % len(self.payloads)
+        self.count -= 1
+        self.size -= len(entry[1]) + ENTRY_OVERHEAD
+        return entry
+
+    def range(self, since, until):
+        lo = bisect_left(self, since)
+        hi = bisect_right(self, until)
+        capacity = len(self.payloads)
+        for n in range(lo, hi):
+            i = (self.start + n) % capacity
+            yield self.times[i], self.payloads[i]
+
+
+class _DiskSegment:
+    """
+    Fixed-size, memory-mapped overflow for entries evicted from memory. The
+    file is written as a ring: once full, new records overwrite the oldest.
+    Positions are tracked as absolute byte counts since startup, so a record
+    is still readable as long as fewer than `size` bytes have been written
+    after it.
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.file = open(path, "w+b")
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.head = 0
+        # topic -> (timestamps, absolute positions), both oldest first.
+        self.index = {}
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def append(self, topic, ts, payload):
+        topic_bytes = topic.encode()
+        length = _RECORD_HEADER.size + len(topic_bytes) + len(payload)
+        if length > self.size:
+            return
+
+        offset = self.head % self.size
+        # Records never straddle the end of the file; skip to the start.
+        if offset + length > self.size:
+            self.head += self.size - offset
+            offset = 0
+
+        _RECORD_HEADER.pack_into(self.map, offset, ts, len(topic_bytes), len(payload))
+        body = offset + _RECORD_HEADER.size
+        self.map[body:body + len(topic_bytes)] = topic_bytes
+        body += len(topic_bytes)
+        self.map[body:body + len(payload)] = payload
+
+        if topic in self.index:
+            self._prune(topic)
+        times, positions = self.index.setdefault(topic, (array("d"), array("Q")))
+        times.append(ts)
+        positions.append(self.head)
+        self.head += length
+
+    def _prune(self, topic):
+        # Overwritten records are always a prefix of a topic's index, since
+        # positions only grow.
+        times, positions = self.index[topic]
+        stale = bisect_left(positions, self.head - self.size)
+        if stale:
+            del times[:stale]
+            del positions[:stale]
+        if not times:
+            del self.index[topic]
+            return None
+        return times, positions
+
+    def range(self, topic, since, until):
+        if topic not in self.index:
+            return []
+        entry = self._prune(topic)
+        if entry is None:
+            return []
+        times, positions = entry
+        results = []
+        for n in range(bisect_left(times, since), bisect_right(times, until)):
+            offset = positions[n] % self.size
+            ts, topic_len, payload_len = _RECORD_HEADER.unpack_from(self.map, offset)
+            body = offset + _RECORD_HEADER.size + topic_len
+            results.append((ts, bytes(self.map[body:body + payload_len])))
+        return results
+
+
+class MessageHistory:
+    """
+    Recent messages per topic for time-range queries. Each topic gets a
+    ring of up to `per_topic` entries, and all rings together (entries,
+    slots and per-ring overhead) stay under `max_bytes`; when that's
+    exceeded, the oldest entries of the least recently active topics go
+    first. Entries pushed out of memory spill into
+    an optional memory-mapped file for longer retention.
+    """
+
+    def __init__(self, per_topic=256, max_bytes=16 * 1024 * 1024,
+                 segment_path=None, segment_bytes=64 * 1024 * 1024):
+        self.per_topic = per_topic
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._rings = OrderedDict()
+        self._lock = threading.Lock()
+        self.segment = _DiskSegment(segment_path, segment_bytes) if segment_path else None
+
+    def close(self):
+        if self.segment:
+            self.segment.close()
+
+    def append(self, topic, payload, ts=None):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        if ts is None:
+            ts = time.time()
+
+        with self._lock:
+            ring = self._rings.get(topic)
+            if ring is None:
+                ring = self._rings[topic] = _Ring(self.per_topic)
+                self.size += ring.size
+            else:
+                self._rings.move_to_end(topic)
+
+            before = ring.size
+            evicted = ring.append(ts, payload)
+            self.size += ring.size - before
+            if evicted and self.segment:
+                self.segment.append(topic, *evicted)
+
+            while self.size > self.max_bytes and self._rings:
+                old_topic, old_ring = next(iter(self._rings.items()))
+                before = old_ring.size
+                evicted = old_ring.pop()
+                self.size -= before - old_ring.size
+                if self.segment:
+                    self.segment.append(old_topic, *evicted)
+                if not old_ring.count:
+                    del self._rings[old_topic]
+                    self.size -= old_ring.size
+
+    def query(self, topic, since=None, until=None, limit=None):
+        """
+        Messages on `topic` with since <= ts <= until, oldest first. With a
+        limit, the most recent `limit` matches are returned.
+        """
+        since = float("-inf") if since is None else since
+        until = float("inf") if until is None else until
+
+        with self._lock:
+            entries = self.segment.range(topic, since, until) if self.segment else []
+            ring = self._rings.get(topic)
+            if ring is not None:
+                entries.extend(ring.range(since, until))
+
+        if limit is not None:
+            entries = entries[-limit:] if limit > 0 else []
+        return [
+            {"topic": topic, "message": payload.decode(errors="replace"), "ts": ts}
+            for ts, payload in entries
+        ]
+
+    def topics(self):
+        return list(self._rings)
+
+    def stats(self):
+        return {
+            "topics": len(self._rings),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "per_topic": self.per_topic,
+            "segment": self.segment.path if self.segment else None,
+        }
@@ -0,0 +1,145 @@
+import math
+import threading
+import time
+
+WHEEL_BITS = 6
+WHEEL_SIZE = 1 << WHEEL_BITS
+WHEEL_MASK = WHEEL_SIZE - 1
+WHEEL_LEVELS = 4
+
+
+class TimingWheel:
+    """
+    Hierarchical timing wheel (in the style of the classic Linux kernel
+    timers): WHEEL_LEVELS levels of WHEEL_SIZE slots, each level covering
+    WHEEL_SIZE times the span of the one below. Scheduling is O(1); entries
+    in higher levels are cascaded down as the lower level wraps, so each
+    entry is moved at most once per level. Deadlines are in whole ticks.
+    """
+
+    def __init__(self):
+        self.levels = [[set() for _ in range(WHEEL_SIZE)] for _ in range(WHEEL_LEVELS)]
+        self.deadlines = {}
+        # Next tick advance() will process
+        self.current = 0
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def schedule(self, key, deadline):
+        self.deadlines[key] = deadline
+        self._place(key, deadline)
+
+    def _place(self, key, deadline):
+        delta = deadline - self.current
+        if delta < 0:
+            # Already due: fire on the next tick processed.
+            self.levels[0][self.current & WHEEL_MASK].add(key)
+            return
+        for level in range(WHEEL_LEVELS):
+            if delta < 1 << (WHEEL_BITS * (level + 1)) or level == WHEEL_LEVELS - 1:
+                slot = (deadline >> (WHEEL_BITS * level)) & WHEEL_MASK
+                self.levels[level][slot].add(key)
+                return
+
+    def advance(self):
+        """Process the current tick, returning the keys that are due."""
+        tick = self.current
+        # When a level wraps, pull the next slot of the level above down.
+        level = 1
+        while level < WHEEL_LEVELS and (tick >> (WHEEL_BITS * (level - 1))) & WHEEL_MASK == 0:
+            slot = self.levels[level][(tick >> (WHEEL_BITS * level)) & WHEEL_MASK]
+            if slot:
+                self.levels[level][(tick >> (WHEEL_BITS * level)) & WHEEL_MASK] = set()
+                for key in slot:
+                    self._place(key, self.deadlines[key])
+            level += 1
+
+        due = self.levels[0][tick & WHEEL_MASK]
+        self.levels[0][tick & WHEEL_MASK] = set()
+        self.current = tick + 1
+
+        # Entries clamped into the top level's last slot may come round
+        # before they're due; put those back.
+        expired = []
+        for key in due:
+            if self.deadlines[key] > tick:
+                self._place(key, self.deadlines[key])
+            else:
+                del self.deadlines[key]
+                expired.append(key)
+        return expired
+
+
+class LivenessTracker:
+    """
+    Heartbeat-based expiry for registered clients that can't be relied on to
+    send a Last Will. touch() records activity in O(1) without moving the
+    client's wheel entry; when the entry fires, a client that has been
+    active since is simply rescheduled for its new deadline. Clients that
+    have gone quiet for `timeout` seconds are passed to on_expire(names) in
+    one batch per tick.
+    """
+
+    def __init__(self, timeout, on_expire, tick=1.0):
+        self.timeout_ticks = max(1, math.ceil(timeout / tick))
+        self.tick = tick
+        self.on_expire = on_expire
+        self.wheel = TimingWheel()
+        # name -> tick of its most recent heartbeat
+        self.last_seen = {}
+        self.expired_count = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="liveness", daemon=True)
+        self._thread.start()
+
+    def touch(self, name):
+        with self._lock:
+            now = self.wheel.current
+            self.last_seen[name] = now
+            if name not in self.wheel:
+                self.wheel.schedule(name, now + self.timeout_ticks)
+
+    def forget(self, name):
+        # The wheel entry is left to fire and be discarded.
+        with self._lock:
+            self.last_seen.pop(name, None)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=5)
+
+    def advance(self):
+        """Process one tick and return the names that expired on it."""
+        with self._lock:
+            expired = []
+            for name in self.wheel.advance():
+                seen = self.last_seen.get(name)
+                if seen is None:
+                    continue
+                deadline = seen + self.timeout_ticks
+                if deadline >= self.wheel.current:
+                    self.wheel.schedule(name, deadline)
+                else:
+                    del self.last_seen[name]
+                    expired.append(name)
+            self.expired_count += len(expired)
+            return expired
+
+    def _run(self):
+        start = time.monotonic()
+        while not self._stop.wait(self.tick):
+            # Catch up on any ticks missed while busy, batching their expiries.
+            target = int((time.monotonic() - start) / self.tick)
+            expired = []
+            while self.wheel.current < target:
+                expired.extend(self.advance())
+            if expired:
+                try:
+                    self.on_expire(expired)
+                except Exception as e:
+                    print(f"[ERROR] Error expiring clients: {e}")
@@ -0,0 +1,104 @@
+from collections import Counter
+
+# Where each kind of drop happens, for the per-stage loss report:
+#   upstream   lost before reaching the router (gaps in sequence stamps)
+#   router     quota (client over its traffic quota), loop_guard (route in a
+#              loop over its rate cap), hop_limit (routed too many times,
+#              going by its MQTT 5 routing metadata), error (a web client's
+#              message that failed with an exception)
+#   spool      overflow (spool full while the broker was down), superseded
+#              (replaced by a newer message under the latest-only policy)
+#   broker     publish_error (paho refused the publish)
+#   websocket  send_failed (a dashboard or web client socket), gateway_evicted
+#              (a gateway process too far behind; counts evictions, not
+#              messages)
+STAGES = ("upstream", "router", "spool", "broker", "websocket")
+
+# MQTT 5 user property carrying a per-topic sequence number on routed
+# messages, so whoever receives them (including another router) can spot gaps
+SEQUENCE_PROPERTY = "sb-seq"
+
+
+class LossTracker:
+    """
+    Per-topic message counts at each stage of the routing path, and every
+    internal drop with its stage and reason, so a subscriber missing
+    messages can be traced to where they went. Counts are plain dict
+    increments, made under the MQTT service's dispatch lock (a few per
+    routed message).
+    """
+
+    def __init__(self):
+        self.received = Counter()   # Inbound data messages, per publisher topic
+        self.filtered = Counter()   # Not forwarded by a route's condition (by design, not loss)
+        self.forwarded = Counter()  # Sent on by a route, per publisher topic
+        self.published = Counter()  # Handed to paho, per destination topic
+        # (stage, reason) -> topic -> messages
+        self.drops = {}
+        # Topic -> next sequence number to stamp / expected on receipt
+        self._next_out = Counter()
+        self._expected_in = {}
+
+    def dropped(self, stage, reason, topic=None, count=1):
+        topics = self.drops.get((stage, reason))
+        if topics is None:
+            topics = self.drops[(stage, reason)] = Counter()
+        topics[topic] += count
+
+    def next_sequence(self, topic):
+        """Sequence number to stamp on the next message published to topic."""
+        self._next_out[topic] += 1
+        return self._next_out[topic]
+
+    def check_sequence(self, topic, sequence):
+        """Note a sequence stamp seen on an inbound message, counting any gap before it as upstream loss."""
+        expected = self._expected_in.get(topic)
+        if expected is not None and sequence > expected:
+            self.dropped("upstream", "sequence_gap", topic, sequence - expected)
+        # Lower than expected: the sender restarted (or reordered); resync.
+        self._expected_in[topic] = sequence + 1
+
+    def _drops_for(self, topic, stages=STAGES):
+        return {reason: topics[topic] for (stage, reason), topics in list(self.drops.items())
+                if stage in stages and topics.get(topic)}
+
+    def report(self, routes, limit=None):
+        """
+        Loss per stage, per route, and for the topics with the most drops.
+        For each route, received = filtered + forwarded + router-stage drops
+        on the publisher topic; forwarded messages then reach the broker
+        unless the destination shows spool or broker drops.
+        """
+        stages = {stage: {} for stage in STAGES}
+        for (stage, reason), topics in list(self.drops.items()):
+            stages[stage][reason] = sum(topics.values())
+
+        route_reports = []
+        for pub, sub in list(routes.items()):
+            route_reports.append({
+                "pub": pub,
+                "sub": sub,
+                "received": self.received[pub],
+                "filtered": self.filtered[pub],
+                "forwarded": self.forwarded[pub],
+                "published": self.published[sub],
+                # Losses on the way in are counted against the publisher
+                # topic, and on the way out against the destination.
+                "dropped": {**self._drops_for(pub, ("upstream", "router")),
+                            **self._drops_for(sub, ("spool", "broker"))},
+            })
+
+        per_topic = Counter()
+        for topics in list(self.drops.values()):
+            for topic, count in list(topics.items()):
+                if topic is not None:
+                    per_topic[topic] += count
+        return {
+            "stages": stages,
+            "routes": route_reports,
+            "topics": [
+                {"topic": topic, "received": self.received[topic], "published": self.published[topic],
+                 "dropped": self._drops_for(topic)}
+                for topic, _ in per_topic.most_common(limit)
+            ],
+        }
@@ -1,53 +1,250 @@
+import time
+
+# Taken before anything else is imported, for --startup-report
+_START = time.perf_counter()
+
 import argparse
+import os
+import signal
 import threading
 import sys
 
-# Import modules
+# Import modules. Only the routing core is imported up front; the web UI
+# (FastAPI, uvicorn, Jinja2) and the CLI are imported in run() when enabled,
+# so --headless routing nodes never pay for them.
 from router import SpacebrewRouter
-from mqtt_service import SpacebrewMQTT
-from web_service import SpacebrewWebServer
-from cli import SpacebrewCLI
+from mqtt_service import SpacebrewMQTT, valid_space_name
+from capture import TrafficCapture
+from spool import OutboundSpool
+from traffic import QUOTA_MODES, TrafficAccounting
+from registry_snapshot import RegistrySnapshotter, load_registry
+from health import HealthMonitor
+
+HEAVY_MODULES = ("fastapi", "uvicorn", "jinja2", "starlette", "pydantic", "cmd")
+
+
+def startup_report():
+    """Print how long startup took and how much memory the process holds."""
+    elapsed = time.perf_counter() - _START
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS, kilobytes elsewhere
+        peak_mb = peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+        memory = f"{peak_mb:.1f} MB peak RSS"
+    except ImportError:
+        memory = "RSS unavailable on this platform"
+    loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+    print(f"⏱️  Startup: {elapsed * 1000:.0f} ms to ready, {memory}, {len(sys.modules)} modules loaded")
+    print(f"   Web/CLI modules loaded: {', '.join(loaded) if loaded else 'none'}")
+    print("   (run with `python3 -X importtime main.py ...` for a per-module import breakdown)")
+
 
 def run():
     # 1. Parse CLI arguments
     parser = argparse.ArgumentParser(description='Spacebrew 2.0 Router')
     parser.add_argument('--server', type=str, default='localhost', help='MQTT Broker address')
     parser.add_argument('--port', type=int, default=1883, help='MQTT Broker port')
+    parser.add_argument('--history-file', type=str, default=None,
+                        help='Memory-mapped file for extended message history (off by default)')
+    parser.add_argument('--capture', type=str, default=None,
+                        help='Record all inbound traffic to this capture file (replay with the CLI replay command or capture.py)')
+    parser.add_argument('--heartbeat-timeout', type=float, default=None,
+                        help='Deregister clients silent for this many seconds (off by default; relies on Last Will only)')
+    parser.add_argument('--registry-file', type=str, default='clients.json',
+                        help='Where to snapshot registered clients for warm restarts')
+    parser.add_argument('--presume-timeout', type=float, default=60.0,
+                        help='Seconds restored clients are kept without being seen before they are dropped')
+    parser.add_argument('--reregister', action='store_true',
+                        help='Ask clients to re-announce themselves (via YuxiSpace/reregister) on connecting to the broker')
+    parser.add_argument('--client-quota', type=float, default=None,
+                        help='Messages/second each client may publish before the excess is dropped (off by default)')
+    parser.add_argument('--client-byte-quota', type=float, default=None,
+                        help='Bytes/second each client may publish before the excess is dropped (off by default)')
+    parser.add_argument('--quota-mode', choices=QUOTA_MODES, default='drop',
+                        help='Drop all messages over quota, or forward one in ten of them (sample)')
+    parser.add_argument('--bridge', action='append', default=[], metavar='NAME=HOST[:PORT]',
+                        help='Also route via another broker; its topics are addressed as NAME:topic (repeatable)')
+    parser.add_argument('--mqtt5', action='store_true',
+                        help='Speak MQTT 5 to the broker(s): topic aliases for busy topics, and routing metadata on routed messages')
+    parser.add_argument('--sequence-stamps', action='store_true',
+                        help='Stamp routed messages with per-topic sequence numbers so receivers can spot gaps (needs --mqtt5)')
+    parser.add_argument('--no-routing-metadata', action='store_true',
+                        help='With --mqtt5, leave the source client and hop count off routed messages to save bytes')
+    parser.add_argument('--space', action='append', default=[], metavar='NAME',
+                        help='Also host an isolated space whose clients use topics under NAME/ (repeatable)')
+    parser.add_argument('--spaces-dir', type=str, default='spaces',
+                        help="Where each extra space keeps its routes and client registry (in a NAME subdirectory)")
+    parser.add_argument('--allow-route-loops', action='store_true',
+                        help='Accept routes that feed back into their own publisher (rate-capped) instead of rejecting them')
+    parser.add_argument('--loop-rate', type=float, default=10.0,
+                        help='Messages/second allowed through each route that is part of a loop')
+    parser.add_argument('--spool-size', type=int, default=10000,
+                        help='Outbound messages held in memory while the broker is unreachable')
+    parser.add_argument('--spool-file', type=str, default=None,
+                        help='Spill spooled messages beyond --spool-size to this file (off by default)')
+    parser.add_argument('--headless', action='store_true',
+                        help='Route only: no web interface or CLI (e.g. for Raspberry Pi routing nodes)')
+    parser.add_argument('--web-port', type=int, default=8088, help='Web interface port')
+    parser.add_argument('--gateways', type=int, default=0,
+                        help='Serve the web interface and WebSockets from this many separate gateway processes, '
+                             'leaving this process to route (0, the default, serves them in-process)')
+    parser.add_argument('--gateway-socket', type=str, default='spacebrew-gateway.sock',
+                        help='Unix-domain socket the router process feeds its gateways over')
+    parser.add_argument('--stall-threshold', type=float, default=0.1,
+                        help='Report event-loop callbacks blocking for longer than this many seconds, with their stacks '
+                             '(0 turns health monitoring off)')
+    parser.add_argument('--startup-report', action='store_true',
+                        help='Print startup time and memory use once the router is ready')
     args = parser.parse_args()
-    
+    if args.gateways and args.headless:
+        parser.error("--gateways serves the web interface, so it can't be combined with --headless")
+    if args.sequence_stamps and not args.mqtt5:
+        parser.error("--sequence-stamps are MQTT 5 user properties, so they need --mqtt5")
+    if args.gateways and args.space:
+        parser.error("--gateways only serve the default space, so they can't be combined with --space")
+    for name in args.space:
+        if not valid_space_name(name):
+            parser.error(f"Invalid space name '{name}' (it can't contain / + # : $ \\ or .)")
+    for flag, value in (('--client-quota', args.client_quota), ('--client-byte-quota', args.client_byte_quota)):
+        if value is not None and not value > 0:
+            parser.error(f"{flag} must be positive (leave it out for no limit)")
+    if args.gateways and os.name == 'nt':
+        parser.error("--gateways needs Unix-domain sockets, which aren't available on Windows")
+
     broker = args.server
     port = args.port
 
     # 2. Initialize Components
-    router = SpacebrewRouter()
-    mqtt_service = SpacebrewMQTT(router, broker, port)
-    web_service = SpacebrewWebServer(router, mqtt_service, port=8088)
-    cli = SpacebrewCLI(router, mqtt_service)
+    def make_router(route_file='routes.txt', history_file=args.history_file):
+        space_router = SpacebrewRouter(route_file, history_file=history_file, heartbeat_timeout=args.heartbeat_timeout,
+                                       allow_loops=args.allow_route_loops, loop_rate=args.loop_rate)
+        space_router.traffic = TrafficAccounting(args.client_quota, args.client_byte_quota, args.quota_mode)
+        return space_router
+
+    router = make_router()
+    spool = OutboundSpool(args.spool_size, overflow_path=args.spool_file)
+    if args.stall_threshold > 0:
+        router.health = HealthMonitor(args.stall_threshold)
+        router.health.start()
+    mqtt_service = SpacebrewMQTT(router, broker, port, spool=spool, mqtt5=args.mqtt5)
+    mqtt_service.stamp_sequences = args.sequence_stamps
+    mqtt_service.routing_metadata = not args.no_routing_metadata
+    for spec in args.bridge:
+        name, sep, address = spec.partition('=')
+        host, _, bridge_port = address.partition(':')
+        if not sep or not name or not host or (bridge_port and not bridge_port.isdigit()):
+            parser.error(f"--bridge expects NAME=HOST[:PORT], got '{spec}'")
+        try:
+            mqtt_service.add_bridge(name, host, int(bridge_port or 1883),
+                                    spool=OutboundSpool(args.spool_size,
+                                                        overflow_path=f"{args.spool_file}.{name}" if args.spool_file else None))
+        except ValueError as e:
+            parser.error(str(e))
+    # Traffic under a space's name goes to the space, so it can't also be
+    # a default-space client's name or the first level of a routed topic
+    registry = load_registry(args.registry_file)
+    taken = ({entry.get("name") for entry in registry}
+             | {topic.split('/', 1)[0] for route in router.routes.items() for topic in route})
+    for name in args.space:
+        if name in taken:
+            parser.error(f"Space name '{name}' is already used by a client or route in the default space")
+    # Space name -> (router, mqtt_service, registry file) for each space
+    # hosted besides the default one
+    spaces = {}
+    for name in args.space:
+        directory = os.path.join(args.spaces_dir, name)
+        os.makedirs(directory, exist_ok=True)
+        space_router = make_router(os.path.join(directory, 'routes.txt'),
+                                   os.path.join(directory, 'history') if args.history_file else None)
+        try:
+            space_service = mqtt_service.add_space(name, space_router, spool=OutboundSpool(
+                args.spool_size, overflow_path=os.path.join(directory, 'spool') if args.spool_file else None))
+        except ValueError as e:
+            parser.error(str(e))
+        spaces[name] = (space_router, space_service, os.path.join(directory, 'clients.json'))
+    web_service = None
+    cli = None
+    if not args.headless:
+        from web_service import SpacebrewWebServer
+        from cli import SpacebrewCLI
+        web_service = SpacebrewWebServer(router, mqtt_service, port=args.web_port)
+        for name, (space_router, space_service, _) in spaces.items():
+            web_service.add_space(name, SpacebrewWebServer(space_router, space_service))
+        cli = SpacebrewCLI(router, mqtt_service,
+                           {name: (space_router, space_service) for name, (space_router, space_service, _) in spaces.items()})
+    gateways = None
+    if args.gateways:
+        from gateway import GatewayHub
+        gateways = GatewayHub(web_service, args.gateway_socket)
+    router.restore_clients(registry, args.presume_timeout)
+    snapshotters = [RegistrySnapshotter(router, args.registry_file)]
+    for space_router, _, registry_file in spaces.values():
+        space_router.restore_clients(load_registry(registry_file), args.presume_timeout)
+        snapshotters.append(RegistrySnapshotter(space_router, registry_file))
+    if spaces:
+        print(f"🗂️  Hosting {len(spaces)} spaces besides the default one: {', '.join(spaces)}")
+    capture = TrafficCapture(args.capture) if args.capture else None
+    for service in mqtt_service.brokers():
+        service.reregister_on_connect = args.reregister
+        service.capture = capture
+    if capture:
+        print(f"⏺️  Capturing inbound traffic to '{args.capture}'")
 
-    # 3. Start MQTT Service
-    mqtt_service.connect()
+    # 3. Start MQTT Service (an unreachable broker is retried in the
+    # background rather than being fatal)
+    if not mqtt_service.connect():
+        print(f"⏳ Broker {broker}:{port} unreachable; will keep retrying in the background")
     mqtt_service.start()
 
     # 4. Start CLI in a separate thread
-    def run_cli():
-        try:
-            cli.cmdloop()
-        except KeyboardInterrupt:
-            pass
-            
-    cli_thread = threading.Thread(target=run_cli, daemon=True)
-    cli_thread.start()
+    if cli:
+        def run_cli():
+            try:
+                cli.cmdloop()
+            except KeyboardInterrupt:
+                pass
+
+        cli_thread = threading.Thread(target=run_cli, name="cli", daemon=True)
+        cli_thread.start()
+
+    if args.startup_report:
+        startup_report()
 
     # 5. Start Web Service (Main Thread)
     # Uvicorn needs to run in the main thread for signal handling usually, 
-    # or at least it blocks.
+    # or at least it blocks. Headless, the main thread just waits for
+    # Ctrl+C or SIGTERM (e.g. from systemd) while paho routes; with
+    # --gateways, it watches over the gateway processes.
     try:
-        web_service.start()
-    except KeyboardInterrupt:
+        if gateways:
+            gateways.start()
+            gateways.spawn(args.gateways, web_service.host, args.web_port)
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            gateways.supervise()
+        elif web_service:
+            web_service.start()
+        else:
+            print(f"🚀 Routing headless via {broker}:{port} (Ctrl+C to stop)")
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            threading.Event().wait()
+    except (KeyboardInterrupt, SystemExit):
         pass
     finally:
         print("Shutting down...")
+        if gateways:
+            gateways.stop()
         mqtt_service.stop()
+        for snapshotter in snapshotters:
+            snapshotter.stop()
+        if router.health:
+            router.health.stop()
+        for space_router in [router] + [space[0] for space in spaces.values()]:
+            space_router.history.close()
+            if space_router.liveness:
+                space_router.liveness.stop()
+        if mqtt_service.capture:
+            mqtt_service.capture.close()
 
 if __name__ == '__main__':
-    run()
\ No newline at end of file
+    run()
@@ -1,116 +1,849 @@
-import sys
 import random
+from collections import Counter, deque
 from paho.mqtt import client as mqtt_client
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 import re
-import asyncio
+import queue
+import threading
+import time
+from health import WaitStats
+from loss import SEQUENCE_PROPERTY
+from router import client_topics
+from spool import OutboundSpool
+
+# Format: name, desc, pubs(p1:t,p2:t), subs(s1:t,s2:t)
+REGISTRATION_RE = re.compile(r'^([^,]+),\s*([^,]+),\s*pubs\((.*)\),\s*subs\((.*)\)$')
+
+# Router control topics; never routed or cached as data.
+CONTROL_TOPICS = ("YuxiSpace", "YuxiSpace/leave", "YuxiSpace/heartbeat", "YuxiSpace/reregister")
+
+# MQTT 5 user properties carrying routing metadata on routed messages: the
+# client the message originally came from, and how many routes it has been
+# through (so routers forwarding to each other can't loop it forever).
+SOURCE_PROPERTY = "sb-src"
+HOPS_PROPERTY = "sb-hops"
+MAX_HOPS = 8
+
+# Topic aliases the broker may use on messages it sends us (MQTT 5)
+INBOUND_TOPIC_ALIASES = 256
+
+
+def valid_space_name(name):
+    """Space names become a topic level and a directory name, so no separators or wildcards."""
+    return bool(name) and not any(c in name for c in '/+#:$\\.') and name not in CONTROL_TOPICS
+
+
+def valid_topic(topic):
+    """A topic clients may publish on: non-empty, no wildcards and no empty levels."""
+    return (isinstance(topic, str) and bool(topic) and '#' not in topic and '+' not in topic
+            and '' not in topic.split('/'))
+
+
+def valid_subscription(topic):
+    """
+    A topic filter clients may subscribe to: like valid_topic(), but "+" may
+    stand for one whole level and "#" for the whole last level.
+    """
+    if not (isinstance(topic, str) and topic):
+        return False
+    levels = topic.split('/')
+    for i, level in enumerate(levels):
+        if level == '+' or (level == '#' and i == len(levels) - 1):
+            continue
+        if not level or '+' in level or '#' in level:
+            return False
+    return True
+
+
+def parse_registration(msg_str):
+    """Parse a registration message into (name, desc, pubs, subs), or None if it's invalid."""
+    match = REGISTRATION_RE.match(msg_str)
+
+    if match:
+        name = match.group(1).strip()
+        desc = match.group(2).strip()
+        pubs_str = match.group(3).strip()
+        subs_str = match.group(4).strip()
+
+        pubs = [p.strip() for p in pubs_str.split(',')] if pubs_str else []
+        subs = [s.strip() for s in subs_str.split(',')] if subs_str else []
+        return name, desc, pubs, subs
+
+    # Fallback to old split
+    p = msg_str.split(',')
+    if len(p) >= 4:
+        return p[0].strip(), p[1].strip(), [p[2].strip()], [p[3].strip()]
+    return None
+
+
+class RegistrationBatcher:
+    """
+    Coalesces registrations arriving within `window` seconds of each other
+    (e.g. hundreds of devices reconnecting after a broker restart) and
+    applies them to the router in one operation on a background thread, so
+    the paho thread goes straight back to routing data. Identical
+    registrations within a batch are only applied once. A window of 0
+    applies each registration immediately on the caller's thread.
+    """
+
+    def __init__(self, mqtt_service, window=0.05):
+        self.mqtt_service = mqtt_service
+        self.window = window
+        self.batches = 0
+        self._pending = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        if window > 0:
+            threading.Thread(target=self._run, name="registrations", daemon=True).start()
+
+    def add(self, msg_str):
+        with self._lock:
+            self._pending.append(msg_str)
+        if self.window > 0:
+            self._wakeup.set()
+        else:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if batch:
+            self.batches += 1
+            self.mqtt_service.apply_registrations(batch)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            # Let the rest of a burst arrive before applying it.
+            time.sleep(self.window)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"[ERROR] Error processing registrations: {e}")
+
+
+class EchoFilter:
+    """
+    Messages the router has published and already handled in-process, whose
+    copies coming back through its "#" subscription must be ignored. An
+    expectation lapses after `ttl` seconds in case its copy never arrives
+    (dropped at QoS 0, or spooled through a long outage).
+    """
+
+    def __init__(self, ttl=10.0, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.suppressed = 0
+        self._counts = {}
+        # (expiry, key) in the order expected. Entries consumed early stay
+        # here until they expire; at worst that lapses a later duplicate's
+        # expectation a little early.
+        self._order = deque()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._counts)
+
+    def _lapse(self, now):
+        order = self._order
+        while order and (order[0][0] <= now or len(order) > self.max_entries):
+            _, key = order.popleft()
+            count = self._counts.get(key)
+            if count == 1:
+                del self._counts[key]
+            elif count:
+                self._counts[key] = count - 1
+
+    def expect(self, topic, payload):
+        key = (topic, payload)
+        now = time.monotonic()
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + 1
+            self._order.append((now + self.ttl, key))
+            self._lapse(now)
+
+    def consume(self, topic, payload):
+        """True (and forget it) if this message is an expected echo."""
+        key = (topic, payload)
+        with self._lock:
+            self._lapse(time.monotonic())
+            count = self._counts.get(key)
+            if not count:
+                return False
+            if count == 1:
+                del self._counts[key]
+            else:
+                self._counts[key] = count - 1
+            self.suppressed += 1
+            return True
+
+
+class TopicAliases:
+    """
+    Outbound MQTT 5 topic aliases for one broker connection. A destination
+    topic published `hot_after` times gets the next free alias, up to the
+    broker's Topic Alias Maximum; the publish that takes it carries the
+    topic to bind it, and later ones carry only the two-byte alias. Aliases
+    last as long as the connection. Callers hold `lock` from assign() until
+    the publish is queued, so a topic is always bound before its alias is
+    used alone.
+    """
+
+    def __init__(self, hot_after=3, max_tracked=10000):
+        self.hot_after = hot_after
+        self.max_tracked = max_tracked
+        self.maximum = 0  # 0 until a broker allows aliases
+        self.aliases = {}
+        self.hits = 0
+        self.lock = threading.Lock()
+        self._uses = Counter()
+
+    def reset(self, maximum=0):
+        self.maximum = maximum
+        self.aliases = {}
+        self._uses.clear()
+
+    def assign(self, topic):
+        """(alias, topic to send) for one publish; alias is None if it goes out unaliased."""
+        alias = self.aliases.get(topic)
+        if alias is not None:
+            self.hits += 1
+            return alias, ""
+        if len(self.aliases) >= self.maximum:
+            return None, topic
+        uses = self._uses[topic] + 1
+        if uses < self.hot_after:
+            if len(self._uses) >= self.max_tracked:
+                self._uses.clear()
+            self._uses[topic] = uses
+            return None, topic
+        del self._uses[topic]
+        alias = self.aliases[topic] = len(self.aliases) + 1
+        if len(self.aliases) >= self.maximum:
+            self._uses.clear()  # No more to hand out
+        return alias, topic
+
 
 class SpacebrewMQTT:
-    def __init__(self, router, broker='localhost', port=1883):
+    def __init__(self, router, broker='localhost', port=1883, spool=None,
+                 reconnect_min_delay=1.0, reconnect_max_delay=60.0, name=None, mqtt5=False,
+                 space=None, client=None):
         self.router = router
         self.broker = broker
         self.port = port
+        # Bridged brokers (see add_bridge()) have a name, and their topics
+        # and client names are qualified with it ("floor2:Lamp/bgcolor") so
+        # one routing table and client registry span every broker. The
+        # primary broker's are left as they are.
+        self.name = name
+        self.prefix = f"{name}:" if name else ""
+        self.bridges = []
+        # Broker name -> connection (None for the primary), shared by the
+        # primary and its bridges; empty with a single broker.
+        self.peers = {}
+        # Spaces (see add_space()) share this connection, each with a router
+        # of its own, and their clients' topics are under "space/" on the
+        # broker. A space's connection is handed its parent's paho client.
+        self.space = space
+        self.root = f"{space}/" if space else ""
+        self.spaces = {}
         self.client_id = f'Spacebrew2_Router_{random.randint(0, 100000)}'
-        self.client = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION1, self.client_id)
-        self.client.on_connect = self.on_connect
-        self.client.on_message = self.on_message
+        # MQTT 5 adds outbound topic aliases for hot destination topics and
+        # routing metadata (source client, hop count) in user properties.
+        self.mqtt5 = mqtt5
+        self.aliases = TopicAliases()
+        # Alias -> topic, for messages the broker sends us with aliases
+        self._inbound_aliases = {}
+        self.client = client
+        if client is None:
+            self.client = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION1, self.client_id,
+                                             protocol=mqtt_client.MQTTv5 if mqtt5 else mqtt_client.MQTTv311)
+            self.client.on_connect = self.on_connect
+            self.client.on_disconnect = self.on_disconnect
+            self.client.on_connect_fail = self.on_connect_fail
+            self.client.on_message = self.on_message
+        # Aliased QoS 1/2 publishes can only be undone for resending (see
+        # _reset_aliases()) through paho internals; without them (a paho
+        # other than 2.x), only QoS 0 publishes use aliases.
+        self._pending_rewritable = (hasattr(self.client, "_out_message_mutex")
+                                    and hasattr(self.client, "_out_messages"))
+
+        # Outbound messages produced while the broker is unreachable are
+        # held here (bounded, per-route drop policies) and flushed on
+        # reconnect, rather than piling up in paho's unbounded queue.
+        self.spool = spool or OutboundSpool()
+        self.spool.on_drop = self._spool_dropped
+
+        # paho's loop thread reconnects for us; we only pick the delays.
+        self.reconnect_min_delay = reconnect_min_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.reconnect_attempts = 0
+        self.reconnects = 0
+        self._connected_once = False
         
         # Callbacks for external services (e.g., WebService broadcasting)
         self.on_route_activity = None 
         self.on_client_message = None
 
+        # Optional TrafficCapture recording all inbound traffic
+        self.capture = None
+
+        # Stamp published messages with a per-topic sequence number (an MQTT
+        # 5 user property), so receivers can detect gaps. Needs MQTT 5.
+        self.stamp_sequences = False
+
+        # Tag routed messages with their source client and hop count (MQTT
+        # 5 user properties, about 25 bytes a message)
+        self.routing_metadata = True
+
+        # Registrations are coalesced and applied in batches
+        self.registrations = RegistrationBatcher(self)
+
+        # Ask all clients to re-announce themselves (on YuxiSpace/reregister)
+        # whenever the router (re)connects to the broker
+        self.reregister_on_connect = False
+
+        # Copies of messages already routed in-process (web client
+        # publishes; see publish_batch()), shared with any bridges
+        self.echoes = EchoFilter()
+        # Inbound messages (on paho's threads, one per broker), web client
+        # publishes (on the outbox thread) and every other publish (spool
+        # flushes, last-value replays, the API and CLI) happen one at a
+        # time under this lock, also shared with bridges: the router's loop
+        # guards, quotas and counters aren't thread-safe. Reentrant, as
+        # some of those run inside others (with no registration window,
+        # a registration's last-value replay runs inside its message's
+        # handling).
+        self.dispatch_lock = threading.RLock()
+
+        # Batches of (topic, payload) queued by publish_batch() for the
+        # outbound thread, so callers on the web event loop never block on
+        # paho's publish. Each is queued with the time, for outbox_wait.
+        self._outbox = queue.SimpleQueue()
+        self.outbox_wait = WaitStats()
+        self._outbox_thread = None
+
+    def add_bridge(self, name, broker, port=1883, spool=None):
+        """
+        Connect to another broker as well, sharing this router. Routes can
+        then use its topics as "name:topic", and messages crossing brokers
+        are published straight to the destination broker. Bridges are
+        connected, started and stopped along with this connection.
+        """
+        if ':' in name or '/' in name:
+            raise ValueError(f"Broker name '{name}' can't contain ':' or '/'")
+        if name in self.peers:
+            raise ValueError(f"Duplicate broker name '{name}'")
+        bridge = SpacebrewMQTT(self.router, broker, port, spool=spool,
+                               reconnect_min_delay=self.reconnect_min_delay,
+                               reconnect_max_delay=self.reconnect_max_delay, name=name, mqtt5=self.mqtt5)
+        bridge.stamp_sequences = self.stamp_sequences
+        bridge.routing_metadata = self.routing_metadata
+        self.peers.setdefault(None, self)
+        self.peers[name] = bridge
+        bridge.peers = self.peers
+        bridge.echoes = self.echoes
+        bridge.dispatch_lock = self.dispatch_lock
+        self.bridges.append(bridge)
+        return bridge
+
+    def add_space(self, name, router, spool=None):
+        """
+        Host another space on this connection: its own router (routes,
+        clients, persistence), isolated from this one's. Its clients use
+        the same topics as usual under "name/" ("gallery/YuxiSpace" to
+        register, "gallery/Lamp/bgcolor" for data), and inbound messages are
+        handed to it by their first topic level. Spaces are started and
+        stopped along with this connection.
+        """
+        if not valid_space_name(name):
+            raise ValueError(f"Invalid space name '{name}'")
+        if name in self.spaces:
+            raise ValueError(f"Duplicate space name '{name}'")
+        space = SpacebrewMQTT(router, self.broker, self.port, spool=spool, mqtt5=self.mqtt5,
+                              space=name, client=self.client)
+        # Aliases belong to the connection, whichever space publishes
+        space.aliases = self.aliases
+        space.stamp_sequences = self.stamp_sequences
+        space.routing_metadata = self.routing_metadata
+        self.spaces[name] = space
+        # A client here by that name would have its topics taken for the space's
+        self.router.reserved_names.add(name)
+        return space
+
+    def brokers(self):
+        """This connection and its bridges."""
+        return [self] + self.bridges
+
     def connect(self):
+        """
+        Try to connect to the broker (and any bridges). Returns False if the
+        primary broker is unreachable; start() then keeps retrying in the
+        background.
+        """
+        for bridge in self.bridges:
+            bridge.connect()
         try:
-            self.client.connect(self.broker, self.port)
+            self.client.connect(self.broker, self.port, properties=self._connect_properties())
             return True
         except Exception as e:
-            print(f"Error connecting to broker: {e}")
-            sys.exit(1)
+            print(f"Error connecting to broker{f' {self.name}' if self.name else ''}: {e}")
+            self._schedule_retry()
+            return False
 
     def start(self):
+        if not self.client.is_connected() and self.client.socket() is None:
+            # Never connected (or connect() failed): let the loop thread
+            # make the first attempt and keep retrying from there.
+            self.client.connect_async(self.broker, self.port, properties=self._connect_properties())
         self.client.loop_start()
-        self.client.subscribe("#") # Subscribe to all topics
+        self._start_outbox()
+        for bridge in self.bridges:
+            bridge.start()
+        for space in self.spaces.values():
+            space._start_outbox()
+
+    def _start_outbox(self):
+        self._outbox_thread = threading.Thread(target=self._run_outbox,
+                                               name=f"mqtt-outbox {self.space or self.name or 'main'}", daemon=True)
+        self._outbox_thread.start()
+
+    def _stop_outbox(self):
+        if self._outbox_thread:
+            self._outbox.put(None)
+            self._outbox_thread.join(timeout=5)
+            self._outbox_thread = None
+
+    def _connect_properties(self):
+        if not self.mqtt5:
+            return None
+        properties = Properties(PacketTypes.CONNECT)
+        properties.TopicAliasMaximum = INBOUND_TOPIC_ALIASES
+        return properties
 
     def stop(self):
+        for bridge in self.bridges:
+            bridge.stop()
+        for space in self.spaces.values():
+            space._stop_outbox()
+            space.spool.close()
+        self._stop_outbox()
         self.client.disconnect()
         self.client.loop_stop()
+        self.spool.close()
 
     def publish(self, topic, message):
-        return self.client.publish(topic, message, qos=1)
+        """Publish now, or spool until reconnected (returning None) if the broker is down."""
+        with self.dispatch_lock:
+            return self._send(topic, message)
+
+    def _send(self, topic, payload, route=None, qos=1, origin=None, echo=False):
+        # With echo=True, the copy the broker sends back to us is ignored,
+        # for messages already handled here. Only when published now: a
+        # spooled message could outlast the expectation.
+        service = self
+        if self.peers:
+            service, topic = self.resolve(topic)
+        if service.client.is_connected():
+            if echo:
+                self.echoes.expect(service.prefix + topic if service.prefix else topic, payload)
+            return service._publish(topic, payload, qos, origin)
+        # Spooled messages go out later without routing metadata
+        service.spool.put(topic, payload, self.router.spool_policy(route))
+        return None
+
+    def _publish(self, topic, payload, qos=1, origin=None):
+        # Counted under the topic as routes name it (broker-qualified for bridges)
+        loss = self.router.loss
+        name = self.prefix + topic if self.prefix else topic
+        if self.root:
+            topic = self.root + topic
+        if not self.mqtt5:
+            info = self.client.publish(topic, payload, qos=qos)
+        else:
+            properties = Properties(PacketTypes.PUBLISH)
+            if self.stamp_sequences:
+                properties.UserProperty = (SEQUENCE_PROPERTY, str(loss.next_sequence(name)))
+            if origin is not None:
+                # (source client, hops so far), for a routed message
+                properties.UserProperty = (SOURCE_PROPERTY, origin[0])
+                properties.UserProperty = (HOPS_PROPERTY, str(origin[1]))
+            aliases = self.aliases
+            with aliases.lock:
+                if qos == 0 or self._pending_rewritable:
+                    alias, topic = aliases.assign(topic)
+                    if alias is not None:
+                        properties.TopicAlias = alias
+                info = self.client.publish(topic, payload, qos=qos, properties=properties)
+        if info.rc == mqtt_client.MQTT_ERR_SUCCESS:
+            loss.published[name] += 1
+        else:
+            loss.dropped("broker", "publish_error", name)
+        return info
+
+    def _spool_dropped(self, topic, reason):
+        self.router.loss.dropped("spool", reason, self.prefix + topic if self.prefix else topic)
+
+    def resolve(self, topic):
+        """The connection a (possibly broker-qualified) topic belongs to, and the topic on that broker."""
+        name, sep, local = topic.partition(':')
+        if sep:
+            service = self.peers.get(name)
+            if service is not None:
+                return service, local
+        return self.peers.get(None, self), topic
 
-    def on_connect(self, client, userdata, flags, reason_code):
+    def publish_batch(self, messages):
+        """
+        Queue a list of (topic, payload) pairs from web clients for
+        publishing, in order. Never blocks. Messages on routed topics are
+        also routed in-process (see _publish_local()).
+        """
+        self._outbox.put((time.perf_counter(), messages))
+
+    def _publish_local(self, topic, payload):
+        # A web client publishing on a routed topic is routed here and now,
+        # instead of after a round trip through the broker and back; routed
+        # copies then reach other web clients without a second one. The
+        # broker still gets each message once, for MQTT subscribers, and
+        # the copies it sends back to us are ignored.
+        if self.router.dispatch.get(topic) is None:
+            self._send(topic, payload)
+            return
+        if isinstance(payload, str):
+            payload = payload.encode()
+        if self._send(topic, payload, echo=True) is None:
+            # Spooled while the broker is down: it's routed when the broker
+            # sends it back, as the echo expectation may be gone by then
+            return
+        if self.router.record_value(topic, payload):
+            payload_str = payload.decode(errors="replace")
+            print(f"\n[RX] Received `{payload_str}` from `{topic}` topic (web client)")
+            self._dispatch(topic, payload, payload_str, local=True)
+
+    def _run_outbox(self):
+        while True:
+            item = self._outbox.get()
+            # Pick up everything else that's queued in the meantime too.
+            while item is not None:
+                queued, batch = item
+                self.outbox_wait.add(time.perf_counter() - queued)
+                for topic, payload in batch:
+                    # One bad message mustn't stop this thread, and with it
+                    # every web client publish after it
+                    try:
+                        with self.dispatch_lock:
+                            self._publish_local(topic, payload)
+                    except Exception as e:
+                        print(f"[ERROR] Error publishing web client message on {topic!r}: {e}")
+                        self.router.loss.dropped("router", "error", topic)
+                try:
+                    item = self._outbox.get_nowait()
+                except queue.Empty:
+                    break
+            if item is None:
+                return
+
+    def on_connect(self, client, userdata, flags, reason_code, properties=None):
         if reason_code != 0:
             print(f"🔴 Failed to connect to MQTT Broker, return code {reason_code}")
         else:
-            print(f"✅ Connected to MQTT Broker at {self.broker}:{self.port}")
+            print(f"✅ Connected to MQTT Broker at {self.broker}:{self.port}{f' ({self.name})' if self.name else ''}")
+            if self._connected_once:
+                self.reconnects += 1
+            self._connected_once = True
+            self.reconnect_attempts = 0
+            if self.mqtt5:
+                # Aliases don't outlive a connection, in either direction
+                self._reset_aliases(getattr(properties, "TopicAliasMaximum", 0))
+                self._inbound_aliases = {}
+            # Subscriptions don't survive a clean-session reconnect, so
+            # (re)subscribe on every connect.
+            self.client.subscribe("#") # Subscribe to all topics
+            self.flush_spool()
+            for space in self.spaces.values():
+                space.flush_spool()
+            if self.reregister_on_connect:
+                self.request_reregistration()
+                for space in self.spaces.values():
+                    space.request_reregistration()
+
+    def on_disconnect(self, client, userdata, reason_code, properties=None):
+        if reason_code == 0:
+            return  # Clean disconnect from stop()
+        if self.mqtt5:
+            self._reset_aliases()
+        print(f"🔴 Lost connection to MQTT Broker at {self.broker}:{self.port} ({reason_code}); reconnecting...")
+        self._schedule_retry()
+
+    def _reset_aliases(self, maximum=0):
+        # paho resends unacknowledged QoS 1/2 publishes as they were after a
+        # reconnect, but the new connection has none of the old aliases, so
+        # they get their full topics back first.
+        aliases = self.aliases
+        with aliases.lock:
+            if aliases.aliases and self._pending_rewritable:
+                topics = {alias: topic.encode() for topic, alias in aliases.aliases.items()}
+                with self.client._out_message_mutex:
+                    for message in self.client._out_messages.values():
+                        alias = getattr(message.properties, "TopicAlias", None)
+                        if alias is not None:
+                            message.topic = topics.get(alias, message.topic.encode())
+                            del message.properties.TopicAlias
+            aliases.reset(maximum)
+
+    def on_connect_fail(self, client, userdata):
+        self._schedule_retry()
+
+    def _schedule_retry(self):
+        # Exponential backoff with full jitter, so a room full of routers and
+        # clients don't all hammer a restarting broker in lockstep. paho
+        # waits exactly min_delay before its next attempt when both are set.
+        self.reconnect_attempts += 1
+        ceiling = min(self.reconnect_max_delay, self.reconnect_min_delay * 2 ** (self.reconnect_attempts - 1))
+        delay = random.uniform(self.reconnect_min_delay, max(self.reconnect_min_delay, ceiling))
+        self.client.reconnect_delay_set(delay, delay)
+        if self.reconnect_attempts > 1:
+            print(f"⏳ Broker still unreachable (attempt {self.reconnect_attempts}); "
+                  f"retrying in {delay:.1f}s, {len(self.spool)} messages spooled")
+
+    def flush_spool(self):
+        # Runs on the paho thread before any newly routed traffic, so spooled
+        # messages go out first and in order.
+        messages = self.spool.drain()
+        if messages:
+            print(f"📤 Flushing {len(messages)} messages spooled while disconnected")
+            with self.dispatch_lock:
+                for topic, payload in messages:
+                    self._publish(topic, payload)
+
+    def metrics(self):
+        metrics = {
+            "broker": f"{self.broker}:{self.port}",
+            "connected": self.client.is_connected(),
+            "reconnects": self.reconnects,
+            "reconnect_attempts": self.reconnect_attempts,
+            "spool": self.spool.stats(),
+            "echoes": {"pending": len(self.echoes), "suppressed": self.echoes.suppressed},
+            "outbox_wait": self.outbox_wait.stats(),
+        }
+        if self.mqtt5:
+            metrics["topic_aliases"] = {"assigned": len(self.aliases.aliases), "maximum": self.aliases.maximum,
+                                        "hits": self.aliases.hits, "inbound": len(self._inbound_aliases)}
+        if self.bridges:
+            metrics["bridges"] = {bridge.name: bridge.metrics() for bridge in self.bridges}
+        if self.spaces:
+            metrics["spaces"] = sorted(self.spaces)
+        return metrics
+
+    def request_reregistration(self):
+        self.client.publish(self.root + "YuxiSpace/reregister", "", qos=1)
 
     def on_message(self, client, userdata, msg):
+        # paho decodes msg.topic on every access; do it once.
+        local_topic = msg.topic
+        properties = None
+        if self.mqtt5:
+            # paho leaves inbound topic aliases to us: a message carrying
+            # a topic and an alias binds them, and one carrying only the
+            # alias uses the topic last bound to it.
+            properties = msg.properties
+            alias = getattr(properties, "TopicAlias", None)
+            if alias is not None:
+                if local_topic:
+                    self._inbound_aliases[alias] = local_topic
+                else:
+                    local_topic = self._inbound_aliases.get(alias)
+                    if local_topic is None:
+                        print(f"⚠️  Message with unknown topic alias {alias} from {self.broker}:{self.port}; ignored")
+                        return
+        payload = msg.payload
+        service, topic = self, local_topic
+        if self.spaces:
+            # A topic's first level picks out the space it belongs to, if any
+            root, sep, rest = local_topic.partition('/')
+            space = self.spaces.get(root) if sep else None
+            if space is not None:
+                service, topic = space, rest
+        if self.capture:
+            # Only what clients sent: replaying the router's own routed
+            # output as well would deliver every routed message twice.
+            name = self.prefix + local_topic if self.prefix else local_topic
+            if (self.prefix + topic if self.prefix else topic) not in service.router.route_outputs:
+                self.capture.record(name, payload)
+        service.handle_message(topic, payload, properties)
+
+    def handle_message(self, local_topic, payload, properties=None):
+        """Handle one inbound message, its topic as seen by this connection's (or space's) clients."""
+        with self.dispatch_lock:
+            self._handle_message(local_topic, payload, properties)
+
+    def _handle_message(self, local_topic, payload, properties=None):
+        topic = self.prefix + local_topic if self.prefix else local_topic
+
         # Print received message
         try:
-            payload_str = msg.payload.decode()
+            payload_str = payload.decode()
         except:
-            payload_str = str(msg.payload)
-            
-        print(f"\n[RX] Received `{payload_str}` from `{msg.topic}` topic")
-        
-        # 1. Registration Logic
-        if msg.topic == "YuxiSpace":
-            self.handle_registration(payload_str)
-
-        # 1b. Deregistration Logic (explicit leave, or a broker-fired Last Will
-        # message when a client's connection drops uncleanly)
-        if msg.topic == "YuxiSpace/leave":
-            self.handle_deregistration(payload_str)
-
-        # 2. Routing Logic
-        if msg.topic in self.router.routes:
-            sub_topic = self.router.routes[msg.topic]
-            self.client.publish(sub_topic, payload_str, qos=1)
+            payload_str = str(payload)
             
-            # Notify listener (WebService) about route activity
-            if self.on_route_activity:
-                self.on_route_activity(msg.topic, sub_topic, payload_str)
+        if local_topic in CONTROL_TOPICS:
+            # 1. Registration Logic (reported once per batch instead of here)
+            if local_topic == "YuxiSpace":
+                self.handle_registration(payload_str)
+            else:
+                print(f"\n[RX] Received `{payload_str}` from `{topic}` topic")
+
+            # 1b. Deregistration Logic (explicit leave, or a broker-fired Last
+            # Will message when a client's connection drops uncleanly)
+            if local_topic == "YuxiSpace/leave":
+                self.handle_deregistration(payload_str)
+
+            # Explicit keep-alive for clients that only subscribe (when
+            # heartbeat expiry is enabled; publishing on any of a client's
+            # own topics counts too)
+            elif local_topic == "YuxiSpace/heartbeat":
+                self.router.heartbeat(self.prefix + payload_str.strip())
+        else:
+            # Our own publish of a message already routed in-process
+            if self.echoes and self.echoes.consume(topic, payload):
+                return
+            # 1c. Remember the latest value on data topics so dashboards and
+            # late-registering clients can be brought up to date immediately.
+            # Messages from a client over its quota stop here, before they
+            # cost any logging, routing or forwarding.
+            if not self.router.record_value(topic, payload):
+                return
+            # Sequence stamps reveal messages lost upstream, and routing
+            # metadata says where a message already routed elsewhere began
+            origin = None
+            if properties is not None and hasattr(properties, "UserProperty"):
+                source = hops = None
+                for key, value in properties.UserProperty:
+                    if key == SEQUENCE_PROPERTY and value.isdigit():
+                        self.router.loss.check_sequence(topic, int(value))
+                    elif key == SOURCE_PROPERTY:
+                        source = value
+                    elif key == HOPS_PROPERTY and value.isdigit():
+                        hops = int(value)
+                if hops is not None:
+                    origin = (source, hops)
+            print(f"\n[RX] Received `{payload_str}` from `{topic}` topic")
+            self._dispatch(topic, payload, payload_str, origin=origin)
+            return
+
+        self._dispatch(topic, payload, payload_str)
+
+    def _dispatch(self, topic, payload, payload_str, local=False, origin=None):
+        """
+        Route one message and pass it on to web clients. With local=True
+        (routing a web client's publish in-process), routed copies are
+        handled in-process too rather than when they come back from the
+        broker. origin is (source client, hops) from the message's routing
+        metadata, if it has been routed before.
+        """
+        # 2. Routing Logic, via the router's compiled dispatch table
+        routed_to = None
+        route = self.router.dispatch.get(topic)
+        if route is not None:
+            # Conditional routes only forward matching payloads; the rest are
+            # dropped here rather than costing a broker round trip.
+            route_filter = route.route_filter
+            if route_filter is None or route_filter(payload_str):
+                # Routes in a loop are rate-capped so they can't storm
+                guard = route.guard
+                if origin is not None and origin[1] >= MAX_HOPS:
+                    self.router.loss.dropped("router", "hop_limit", topic)
+                elif guard is None or guard.allow():
+                    if self.mqtt5 and self.routing_metadata:
+                        if origin is None:
+                            origin = (self.router.client_for_topic(topic) or topic, 1)
+                        else:
+                            origin = (origin[0] or topic, origin[1] + 1)
+                    # Forward the payload bytes as received; no re-encoding
+                    self.router.loss.forwarded[topic] += 1
+                    # A local copy is handled here only if it went out now
+                    # (see _publish_local())
+                    if self._send(route.sub, payload, topic, route.qos, origin, echo=local) is not None:
+                        routed_to = route.sub
+
+                    # Notify listener (WebService) about route activity
+                    if self.on_route_activity:
+                        self.on_route_activity(topic, route.sub, payload_str)
+                else:
+                    self.router.loss.dropped("router", "loop_guard", topic)
+                    if guard.dropped == 1:
+                        print(f"⚠️  Loop guard dropping messages on {topic} -> {route.sub}"
+                              f" (over {self.router.loop_rate:g} messages/s)")
+            else:
+                self.router.loss.filtered[topic] += 1
 
         # 3. Forward to Web Clients (if applicable)
         if self.on_client_message:
-            self.on_client_message(msg.topic, payload_str)
+            self.on_client_message(topic, payload_str)
+
+        # The routed copy of a local message, as if it had come back from
+        # the broker (loops recurse only as far as their guard allows)
+        if local and routed_to is not None and self.router.record_value(routed_to, payload):
+            self._dispatch(routed_to, payload, payload_str, local=True, origin=origin)
 
         # Restore CLI prompt (if running CLI in same process, though CLI handles its own prompt usually)
         # sys.stdout.write(">> ")
         # sys.stdout.flush()
 
     def handle_registration(self, msg_str):
-        try:
-            # Format: name, desc, pubs(p1:t,p2:t), subs(s1:t,s2:t)
-            match = re.match(r'^([^,]+),\s*([^,]+),\s*pubs\((.*)\),\s*subs\((.*)\)$', msg_str)
-            
-            if match:
-                name = match.group(1).strip()
-                desc = match.group(2).strip()
-                pubs_str = match.group(3).strip()
-                subs_str = match.group(4).strip()
-                
-                pubs = [p.strip() for p in pubs_str.split(',')] if pubs_str else []
-                subs = [s.strip() for s in subs_str.split(',')] if subs_str else []
-            else:
-                 # Fallback to old split
-                 p = msg_str.split(',')
-                 if len(p) >= 4:
-                     name = p[0].strip()
-                     desc = p[1].strip()
-                     pubs = [p[2].strip()]
-                     subs = [p[3].strip()]
-                 else:
-                     return # Invalid format
-
-            success, message = self.router.register_client(name, desc, pubs, subs)
-            if success:
-                print(f"✅ {message}")
+        self.registrations.add(msg_str)
+
+    def apply_registrations(self, messages):
+        """Parse and register a batch of registration messages in one go."""
+        registrations = []
+        invalid = 0
+        for msg_str in dict.fromkeys(messages):
+            try:
+                parsed = parse_registration(msg_str)
+            except Exception as e:
+                print(f"[ERROR] Error processing registration: {e}")
+                parsed = None
+            if parsed:
+                name, desc, pubs, subs = parsed
+                registrations.append((self.prefix + name, desc, pubs, subs))
             else:
+                invalid += 1
+
+        results = self.router.register_clients(registrations)
+        registered = [reg for reg, (success, _) in zip(registrations, results) if success]
+        rejected = [message for success, message in results if not success]
+
+        if len(messages) == 1:
+            for success, message in results:
+                print(f"✅ {message}" if success else f"⚠️  {message}")
+        else:
+            print(f"✅ Registered {len(registered)} clients from {len(messages)} registration messages"
+                  f" ({len(rejected)} rejected, {invalid} invalid,"
+                  f" {len(messages) - len(registrations) - invalid} duplicates)")
+            for message in rejected[:5]:
                 print(f"⚠️  {message}")
+            if len(rejected) > 5:
+                print(f"⚠️  ...and {len(rejected) - 5} more rejected")
 
-        except Exception as e:
-            print(f"[ERROR] Error processing registration: {e}")
+        for name, _, _, subs in registered:
+            self.send_last_values(client_topics(name, subs))
 
     def handle_deregistration(self, name):
-        if self.router.remove_client(name.strip()):
-            print(f"👋 Client disconnected: {name.strip()}")
+        name = self.prefix + name.strip()
+        if self.router.remove_client(name):
+            print(f"👋 Client disconnected: {name}")
+
+    def send_last_values(self, topics):
+        # Stand-in for broker retain flags: a newly registered client gets the
+        # last value seen on each of its subscriber topics straight away.
+        # Runs on the registration thread, hence the lock.
+        with self.dispatch_lock:
+            for topic in topics:
+                entry = self.router.last_values.get(topic)
+                if entry:
+                    # Only the new client needs it; its copy coming back
+                    # through "#" isn't new traffic.
+                    self._send(topic, entry[0], echo=True)
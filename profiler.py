@@ -0,0 +1,128 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# One profile at a time; overlapping ones would sample each other.
+_running = threading.Lock()
+
+
+class Profile:
+    """
+    Stack samples from every thread: a Counter of (thread name, frames)
+    -> samples, where frames run from the outermost call to the innermost
+    and each frame is (function, file, first line).
+    """
+
+    def __init__(self, samples, rate, elapsed, sampling_time):
+        self.samples = samples
+        self.rate = rate
+        self.elapsed = elapsed
+        # Time spent taking samples, for judging the profiler's own overhead
+        self.sampling_time = sampling_time
+
+    @property
+    def overhead(self):
+        return self.sampling_time / self.elapsed if self.elapsed else 0.0
+
+    def collapsed(self):
+        """Brendan Gregg's collapsed-stack format, as read by flamegraph.pl and speedscope."""
+        lines = []
+        for (thread, frames), count in self.samples.most_common():
+            stack = ";".join([thread] + [f"{name} ({os.path.basename(path)}:{line})" for name, path, line in frames])
+            lines.append(f"{stack} {count}")
+        return "\n".join(lines) + "\n"
+
+    def speedscope(self, name="Spacebrew router"):
+        """A speedscope (https://www.speedscope.app) document with one sampled profile per thread."""
+        frame_index = {}
+        frames = []
+        profiles = {}
+        interval = 1.0 / self.rate
+        for (thread, stack), count in self.samples.items():
+            indexes = []
+            for frame in stack:
+                index = frame_index.get(frame)
+                if index is None:
+                    index = frame_index[frame] = len(frames)
+                    frames.append({"name": frame[0], "file": frame[1], "line": frame[2]})
+                indexes.append(index)
+            profile = profiles.setdefault(thread, {
+                "type": "sampled",
+                "name": thread,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": 0,
+                "samples": [],
+                "weights": [],
+            })
+            profile["samples"].append(indexes)
+            profile["weights"].append(count * interval)
+            profile["endValue"] += count * interval
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "spacebrew-router",
+            "shared": {"frames": frames},
+            "profiles": list(profiles.values()),
+        }
+
+    def top(self, limit=10):
+        """The (function, file, line) frames most often found executing, with sample counts."""
+        leaves = Counter()
+        for (thread, frames), count in self.samples.items():
+            if frames:
+                leaves[frames[-1]] += count
+        return leaves.most_common(limit)
+
+
+def sample(seconds, rate=100):
+    """
+    Sample the stack of every thread (paho's network thread, the web event
+    loop, the CLI...) `rate` times a second for `seconds`, using only
+    sys._current_frames(), so it can run against live traffic on machines
+    where external profilers can't be attached. Raises RuntimeError if a
+    profile is already running.
+    """
+    if not _running.acquire(blocking=False):
+        raise RuntimeError("A profile is already running")
+    try:
+        own_id = threading.get_ident()
+        interval = 1.0 / rate
+        samples = Counter()
+        sampling_time = 0.0
+        # Cache frame tuples per code object; building them dominates
+        # otherwise.
+        code_frames = {}
+        start = time.perf_counter()
+        deadline = start + seconds
+        next_sample = start
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            if now < next_sample:
+                time.sleep(next_sample - now)
+            next_sample += interval
+
+            taken = time.perf_counter()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    entry = code_frames.get(code)
+                    if entry is None:
+                        entry = code_frames[code] = (code.co_name, code.co_filename, code.co_firstlineno)
+                    stack.append(entry)
+                    frame = frame.f_back
+                stack.reverse()
+                samples[(names.get(thread_id, f"thread-{thread_id}"), tuple(stack))] += 1
+            del frame
+            sampling_time += time.perf_counter() - taken
+        return Profile(samples, rate, time.perf_counter() - start, sampling_time)
+    finally:
+        _running.release()
@@ -0,0 +1,33 @@
+import time
+
+
+class TokenBucket:
+    """
+    Allows `rate` events (or units of `cost`, e.g. bytes) per second on
+    average, with bursts of up to `burst`. Not thread-safe; callers using
+    a bucket from several threads must serialize access (SpacebrewMQTT does
+    so with its dispatch lock).
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated", "allowed", "dropped")
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.allowed = 0
+        self.dropped = 0
+
+    def allow(self, now=None, cost=1):
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # A single event costing more than the burst is let through once
+        # the bucket is full, rather than never.
+        if self.tokens >= min(cost, self.burst):
+            self.tokens -= cost
+            self.allowed += 1
+            return True
+        self.dropped += 1
+        return False
@@ -0,0 +1,60 @@
+import json
+import os
+import threading
+
+
+def load_registry(path):
+    """Read a registry snapshot, returning [] if there isn't a usable one."""
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Error loading client registry snapshot: {e}. Starting with no clients.")
+        return []
+
+
+def save_registry(path, clients):
+    # Write to a temp file and swap it in, so a crash mid-write never
+    # leaves a truncated snapshot behind.
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(clients, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+
+class RegistrySnapshotter:
+    """
+    Periodically snapshots the router's client registry to disk, skipping
+    the write when nothing has changed since the last one (tracked by the
+    router's state version).
+    """
+
+    def __init__(self, router, path, interval=10.0):
+        self.router = router
+        self.path = path
+        self.interval = interval
+        self.saved_version = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="registry-snapshot", daemon=True)
+        self._thread.start()
+
+    def save(self):
+        version = self.router.version
+        if version == self.saved_version:
+            return
+        try:
+            save_registry(self.path, self.router.get_registry_data())
+            self.saved_version = version
+        except Exception as e:
+            print(f"Error saving client registry snapshot: {e}")
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=5)
+        self.save()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.save()
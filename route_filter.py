@@ -0,0 +1,116 @@
+import json
+import operator
+import re
+
+# Conditions are compiled once, when a route is added, into a plain closure so
+# the MQTT thread never has to parse them again per message. The grammar is
+# deliberately tiny -- a single comparison against the payload or a field of
+# a JSON payload -- so nothing from a routes file or the API is ever eval'd.
+#
+#   value > 500
+#   value == "true"
+#   value.sensor.temp >= 21.5
+#   value.readings[0] != null
+
+OPERATORS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    ">=": operator.ge,
+    "<=": operator.le,
+    ">": operator.gt,
+    "<": operator.lt,
+}
+
+_CONDITION_RE = re.compile(
+    r'^\s*value((?:\.[A-Za-z_]\w*|\[\d+\])*)\s*(==|!=|>=|<=|>|<)\s*(.+?)\s*$'
+)
+_PATH_PART_RE = re.compile(r'\.([A-Za-z_]\w*)|\[(\d+)\]')
+
+_MISSING = object()
+
+
+def _parse_literal(text):
+    # Anything JSON understands (numbers, "strings", true/false/null) is taken
+    # as-is; a bare word is treated as a string so `value == on` also works.
+    try:
+        return json.loads(text)
+    except ValueError:
+        if re.match(r'^[\w.:-]+$', text):
+            return text
+        raise ValueError(f"Invalid literal in condition: {text}")
+
+
+def _parse_path(text):
+    path = []
+    for key, index in _PATH_PART_RE.findall(text):
+        path.append(key if key else int(index))
+    return tuple(path)
+
+
+def _coerce(value, literal):
+    """Coerce a payload value to the literal's type, or _MISSING if it can't be."""
+    if isinstance(literal, bool) or literal is None:
+        if isinstance(value, str):
+            try:
+                return json.loads(value)
+            except ValueError:
+                return _MISSING
+        return value
+    if isinstance(literal, (int, float)):
+        if isinstance(value, bool):
+            return _MISSING
+        if isinstance(value, (int, float)):
+            return value
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return _MISSING
+    if isinstance(literal, str):
+        if isinstance(value, str):
+            return value
+        return json.dumps(value)
+    return value
+
+
+def compile_condition(expr):
+    """
+    Compile a route condition into a predicate taking the payload string.
+    Raises ValueError if the condition can't be parsed.
+    """
+    match = _CONDITION_RE.match(expr)
+    if not match:
+        raise ValueError(f"Invalid condition: {expr}")
+
+    path = _parse_path(match.group(1))
+    op_name = match.group(2)
+    op = OPERATORS[op_name]
+    literal = _parse_literal(match.group(3))
+
+    numeric = isinstance(literal, (int, float)) and not isinstance(literal, bool)
+    if op_name not in ("==", "!=") and not numeric:
+        raise ValueError(f"Operator '{op_name}' needs a numeric value: {expr}")
+
+    def lookup(payload):
+        if not path:
+            return payload
+        try:
+            value = json.loads(payload)
+            for part in path:
+                value = value[part]
+            return value
+        except (ValueError, KeyError, IndexError, TypeError):
+            return _MISSING
+
+    def predicate(payload):
+        value = lookup(payload)
+        if value is _MISSING:
+            return False
+        value = _coerce(value, literal)
+        if value is _MISSING:
+            return False
+        try:
+            return op(value, literal)
+        except TypeError:
+            return False
+
+    return predicate
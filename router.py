@@ -1,11 +1,110 @@
 import os
+import threading
+import time
+from collections import deque
+from itertools import islice
 import Spacebrew2Client as sb2
+from history import MessageHistory
+from liveness import LivenessTracker
+from loss import LossTracker
+from rate_limit import TokenBucket
+from route_filter import compile_condition
+from search_index import MAX_SCAN, SearchIndex
+from spool import DEFAULT_POLICY, POLICIES
+from topic_cache import LastValueCache
+from traffic import TrafficAccounting
+
+
+def client_topics(name, entries):
+    """A client's pub/sub entries are "name:type"; its topics are "clientName/name"."""
+    return [f"{name}/{entry.split(':')[0].strip()}" for entry in entries]
+
+
+class CompiledRoute:
+    """Everything the MQTT thread needs to forward a message on one route."""
+
+    __slots__ = ("sub", "qos", "route_filter", "guard")
+
+    def __init__(self, sub, qos=1, route_filter=None, guard=None):
+        self.sub = sub
+        self.qos = qos
+        self.route_filter = route_filter
+        self.guard = guard
+
 
 class SpacebrewRouter:
-    def __init__(self, route_file='routes.txt'):
+    def __init__(self, route_file='routes.txt', history_file=None, heartbeat_timeout=None,
+                 allow_loops=False, loop_rate=10.0):
         self.route_file = route_file
         self.routes = {}
+        # The router hears its own output (it subscribes to #), so routes
+        # that lead back to their own publisher topic would republish
+        # forever. New ones are rejected unless allow_loops is set; any that
+        # exist anyway (from routes.txt, or allowed) are rate-capped to
+        # loop_rate messages/second by a guard keyed by publisher topic.
+        self.allow_loops = allow_loops
+        self.loop_rate = loop_rate
+        self.loop_guards = {}
+        # Publisher topic -> CompiledRoute, rebuilt (and swapped in whole)
+        # whenever routes, conditions or loop guards change, so the MQTT
+        # thread does one lookup per message and never sees a half-updated
+        # route.
+        self.dispatch = {}
+        # Subscriber topics of every route, i.e. topics the router itself
+        # publishes on, so captures can leave its output out.
+        self.route_outputs = frozenset()
+        # Optional per-route conditions, keyed by publisher topic like routes.
+        # route_filters holds the compiled predicates the MQTT thread calls.
+        self.route_conditions = {}
+        self.route_filters = {}
+        # Per-route policy for what to drop when output spooled during a
+        # broker outage overflows (see spool.py); routes without one use
+        # DEFAULT_POLICY.
+        self.spool_policies = {}
         self.clients = []
+        # Name -> client, for O(1) duplicate checks and lookups
+        self.clients_by_name = {}
+        # Names no client may register under: those of spaces hosted
+        # alongside this one, whose first topic level they'd share
+        self.reserved_names = set()
+        # Names of clients restored from a registry snapshot that haven't
+        # been confirmed (by traffic or re-registering) since startup.
+        self.presumed = set()
+        # Publisher topic -> name of the registered client that owns it, so
+        # inbound traffic can be attributed without scanning every client.
+        self.publisher_index = {}
+        # Sorted/trigram/tag indexes behind the paginated, searchable
+        # client and route queries, kept up to date on every change.
+        self.client_index = SearchIndex()
+        self.route_index = SearchIndex()
+        # Topic -> data type ("range", "boolean"...) from client registrations
+        self.topic_types = {}
+        self.last_values = LastValueCache()
+        # Per-client message/byte rates and (optional) quotas, attributed
+        # via publisher_index
+        self.traffic = TrafficAccounting()
+        # Per-topic counts at each stage and every internal drop, for
+        # tracing where missing messages went
+        self.loss = LossTracker()
+        # Optional HealthMonitor (event-loop stalls, GIL wait), set up by
+        # main.py for a running router
+        self.health = None
+        self.history = MessageHistory(segment_path=history_file)
+        # Optional heartbeat-based expiry for clients that never send a Last
+        # Will; any publish on a client's topics counts as a heartbeat.
+        self.liveness = None
+        if heartbeat_timeout:
+            self.liveness = LivenessTracker(heartbeat_timeout, self.expire_clients)
+        # Monotonic state version, bumped on every client/route change, with
+        # a bounded log of recent changes so API consumers can fetch deltas
+        # instead of whole tables. on_change(delta) is called after each
+        # change (e.g. to push it to the dashboard).
+        # Versions start from the startup time in ms so they keep increasing
+        # across restarts and stale ETags/versions never match by accident.
+        self.version = int(time.time() * 1000)
+        self.changes = deque(maxlen=1000)
+        self.on_change = None
+        self._change_lock = threading.RLock()
         self.default_routes = {
             "VirtualButton1/button": "VirtualButton2/bgcolor",
             "VirtualButton2/button": "VirtualButton1/bgcolor"
@@ -17,24 +116,59 @@ class SpacebrewRouter:
         if not os.path.exists(self.route_file):
             print(f"File '{self.route_file}' not found. Creating file with default routes.")
             self.routes = self.default_routes.copy()
+            self._compile_routes()
+            self._index_routes()
             self.save_routes()
             return
 
         loaded_routes = {}
+        loaded_conditions = {}
+        loaded_policies = {}
         try:
             with open(self.route_file, 'r') as f:
                 for line in f:
                     line = line.strip()
                     if not line or line.startswith('#'):
                         continue
+
+                    # "@spool <publisher> <policy>" directive lines (older
+                    # versions skip them, having no comma)
+                    if line.startswith('@spool '):
+                        parts = line.split()
+                        if len(parts) == 3 and parts[2] in POLICIES:
+                            loaded_policies[parts[1]] = parts[2]
+                        else:
+                            print(f"Ignoring invalid spool policy line: {line}")
+                        continue
                     
-                    parts = line.split(',', 1)
-                    if len(parts) == 2:
+                    # Optional third column is the route condition, which
+                    # may itself contain commas (e.g. a quoted string).
+                    parts = line.split(',', 2)
+                    if len(parts) >= 2:
                         pub_topic = parts[0].strip()
                         sub_topic = parts[1].strip()
                         loaded_routes[pub_topic] = sub_topic
-            
+                        if len(parts) == 3 and parts[2].strip():
+                            loaded_conditions[pub_topic] = parts[2].strip()
+
+            filters = {}
+            for pub_topic, condition in list(loaded_conditions.items()):
+                try:
+                    filters[pub_topic] = compile_condition(condition)
+                except ValueError as e:
+                    print(f"Ignoring condition on route '{pub_topic}': {e}")
+                    del loaded_conditions[pub_topic]
+
             self.routes = loaded_routes
+            self.route_conditions = loaded_conditions
+            self.route_filters = filters
+            self.spool_policies = {pub: policy for pub, policy in loaded_policies.items() if pub in loaded_routes}
+            self._update_loop_guards()
+            self._compile_routes()
+            self._index_routes()
+            for pub in self.loop_guards:
+                print(f"⚠️  Route {pub} -> {self.routes[pub]} is part of a loop; "
+                      f"capped at {self.loop_rate:g} messages/s")
             print(f"Routes loaded successfully from '{self.route_file}'. Total routes: {len(self.routes)}")
 
         except Exception as e:
@@ -44,43 +178,371 @@ class SpacebrewRouter:
         """Save current routes to file."""
         try:
             with open(self.route_file, 'w') as f:
-                f.write("# Spacebrew2 Router Routes: Publisher, Subscriber\n")
+                f.write("# Spacebrew2 Router Routes: Publisher, Subscriber[, Condition]\n")
                 for pub, sub in self.routes.items():
-                    f.write(f"{pub},{sub}\n")
+                    condition = self.route_conditions.get(pub)
+                    if condition:
+                        f.write(f"{pub},{sub},{condition}\n")
+                    else:
+                        f.write(f"{pub},{sub}\n")
+                for pub, policy in self.spool_policies.items():
+                    f.write(f"@spool {pub} {policy}\n")
             return True
         except Exception as e:
             print(f"Error saving routes to file: {e}")
             return False
 
-    def add_route(self, pub, sub):
-        if pub in self.routes and self.routes[pub] == sub:
+    def add_route(self, pub, sub, condition=None):
+        condition = condition.strip() if condition else None
+        if (pub in self.routes and self.routes[pub] == sub
+                and self.route_conditions.get(pub) == condition):
             return False, "Route already exists"
+
+        # Traffic under a hosted space's name goes to that space, so such a
+        # route could never fire here
+        for topic in (pub, sub):
+            root = topic.split('/', 1)[0]
+            if root in self.reserved_names:
+                return False, f"'{topic}' is in space '{root}', not this one"
+
+        # Compile before touching the table so a bad condition leaves the
+        # existing route (if any) untouched.
+        route_filter = None
+        if condition:
+            try:
+                route_filter = compile_condition(condition)
+            except ValueError as e:
+                return False, str(e)
+
+        loop = self.find_loop(pub, sub)
+        if loop and not self.allow_loops:
+            return False, f"Route would create a loop: {' -> '.join(loop)}"
+
+        replaced = pub in self.routes
         self.routes[pub] = sub
+        if replaced:
+            # Repointing a route may also break an existing loop
+            self._update_loop_guards()
+        elif loop:
+            for topic in loop[:-1]:
+                self.loop_guards.setdefault(topic, TokenBucket(self.loop_rate))
+        self._record_change("routes", "added", pub, self._route_data(pub, sub, condition))
+        if route_filter:
+            self.route_conditions[pub] = condition
+            self.route_filters[pub] = route_filter
+        else:
+            self.route_conditions.pop(pub, None)
+            self.route_filters.pop(pub, None)
+        self._compile_routes()
+        with self._change_lock:
+            self.route_index.add(pub, (sub,))
         self.save_routes()
-        return True, f"Route added: {pub} -> {sub}"
+        message = f"Route added: {pub} -> {sub}"
+        if condition:
+            message += f" if {condition}"
+        if loop:
+            message += f" (loop, capped at {self.loop_rate:g} messages/s: {' -> '.join(loop)})"
+        return True, message
 
     def delete_route(self, pub):
         if pub in self.routes:
             sub = self.routes.pop(pub)
+            self.route_conditions.pop(pub, None)
+            self.route_filters.pop(pub, None)
+            self.spool_policies.pop(pub, None)
+            if pub in self.loop_guards:
+                self._update_loop_guards()
+            self._compile_routes()
+            with self._change_lock:
+                self.route_index.remove(pub)
+            self._record_change("routes", "removed", pub)
             self.save_routes()
             return True, f"Route deleted: {pub} -> {sub}"
         return False, "Route not found"
 
+    def find_loop(self, pub, sub):
+        """
+        The topics a pub -> sub route would cycle through (starting and ending
+        at pub), or None. Each publisher has at most one route, so this just
+        follows the chain from sub: O(chain length) per added route.
+        """
+        path = [pub]
+        seen = {pub}
+        topic = sub
+        while topic not in seen:
+            path.append(topic)
+            seen.add(topic)
+            topic = self.routes.get(topic)
+            if topic is None:
+                return None
+        # Running into some other, pre-existing loop doesn't count
+        return path + [pub] if topic == pub else None
+
+    def _update_loop_guards(self):
+        # Full recompute for the rarer changes that can break loops; keeps
+        # the guards (and their counts) of routes still in a loop.
+        guards = {}
+        for pub, sub in self.routes.items():
+            if self.find_loop(pub, sub):
+                guards[pub] = self.loop_guards.get(pub) or TokenBucket(self.loop_rate)
+        self.loop_guards = guards
+
+    def _index_routes(self):
+        index = SearchIndex()
+        # In key order, so every insertion into the sorted lists is an append
+        for pub, sub in sorted(self.routes.items()):
+            index.add(pub, (sub,))
+        with self._change_lock:
+            self.route_index = index
+
+    def query_clients(self, prefix=None, search=None, data_type=None, role=None, cursor=None, limit=100):
+        """
+        One page of clients, sorted by name: those whose name starts with
+        prefix, whose name or topics contain search, with an endpoint of
+        data_type and/or role ("pub" or "sub"). Pass the returned
+        next_cursor back as cursor for the next page.
+        """
+        tags = []
+        if data_type:
+            tags.append(f"type:{data_type.lower()}")
+        if role:
+            tags.append(f"role:{role}")
+        with self._change_lock:
+            names, next_cursor = self.client_index.search(prefix, search, tags, cursor, limit)
+            return {
+                "items": [self._client_data(self.clients_by_name[name]) for name in names],
+                "next_cursor": next_cursor,
+                "version": self.version,
+            }
+
+    def query_routes(self, prefix=None, search=None, data_type=None, cursor=None, limit=100):
+        """
+        One page of routes, sorted by publisher topic: those whose publisher
+        starts with prefix, whose publisher or subscriber contains search,
+        and (with data_type) whose publisher or subscriber endpoint has that
+        type.
+        """
+        with self._change_lock:
+            if not data_type:
+                pubs, next_cursor = self.route_index.search(prefix, search, (), cursor, limit)
+            else:
+                # Route endpoints may belong to clients that aren't
+                # registered yet, so types are looked up as the page is
+                # filled rather than indexed. Like the index's own scans,
+                # that stops after MAX_SCAN routes, with a short page.
+                data_type = data_type.lower()
+                pubs = []
+                next_cursor = cursor
+                examined = 0
+                while limit is None or len(pubs) < limit:
+                    page, next_cursor = self.route_index.search(prefix, search, (), next_cursor,
+                                                                None if limit is None else limit - len(pubs))
+                    examined += len(page)
+                    pubs.extend(pub for pub in page
+                                if data_type in (self.topic_types.get(pub), self.topic_types.get(self.routes.get(pub))))
+                    if next_cursor is None or (limit is not None and examined >= MAX_SCAN):
+                        break
+            # The route table itself is updated outside the lock, so a route
+            # deleted a moment ago may still be in the index.
+            routes = [(pub, self.routes.get(pub)) for pub in pubs]
+            return {
+                "items": [self._route_data(pub, sub, self.route_conditions.get(pub)) for pub, sub in routes if sub],
+                "next_cursor": next_cursor,
+                "version": self.version,
+            }
+
+    def _compile_routes(self):
+        self.dispatch = {
+            pub: CompiledRoute(sub, 1, self.route_filters.get(pub), self.loop_guards.get(pub))
+            for pub, sub in self.routes.items()
+        }
+        self.route_outputs = frozenset(self.routes.values())
+
+    def loop_stats(self):
+        return {
+            "looping_routes": len(self.loop_guards),
+            "dropped": sum(guard.dropped for guard in self.loop_guards.values()),
+        }
+
+    def set_spool_policy(self, pub, policy):
+        if pub not in self.routes:
+            return False, "Route not found"
+        if policy not in POLICIES:
+            return False, f"Unknown spool policy '{policy}' (expected one of: {', '.join(POLICIES)})"
+        if policy == DEFAULT_POLICY:
+            self.spool_policies.pop(pub, None)
+        else:
+            self.spool_policies[pub] = policy
+        self.save_routes()
+        return True, f"Spool policy for {pub}: {policy}"
+
+    def spool_policy(self, pub):
+        return self.spool_policies.get(pub, DEFAULT_POLICY)
+
     def register_client(self, name, desc, pubs, subs):
-        # Check for duplicate name
-        if any(c.clientName == name for c in self.clients):
-            return False, f"Client rejected: Name '{name}' already exists."
+        return self.register_clients([(name, desc, pubs, subs)])[0]
+
+    def register_clients(self, registrations):
+        """
+        Register a batch of (name, desc, pubs, subs) in one operation, with a
+        single change notification for the whole batch. Returns a
+        (success, message) pair per registration.
+        """
+        results = []
+        changes = []
+        with self._change_lock:
+            for name, desc, pubs, subs in registrations:
+                # A client restored from the last run re-announcing itself
+                # replaces its presumed entry rather than being rejected.
+                if name in self.presumed:
+                    changes.extend(self._remove_clients([name]))
+
+                if name in self.reserved_names:
+                    results.append((False, f"Client rejected: Name '{name}' belongs to a space."))
+                    continue
+
+                # Check for duplicate name
+                if name in self.clients_by_name:
+                    results.append((False, f"Client rejected: Name '{name}' already exists."))
+                    continue
 
+                changes.append(self._add_client(name, desc, pubs, subs))
+                results.append((True, f"Registered new client: {name}"))
+        self._notify(changes)
+        return results
+
+    def _add_client(self, name, desc, pubs, subs, presumed=False):
         new_client = sb2.Spacebrew2Client(name, desc, pubs, subs)
+        if presumed:
+            self.presumed.add(name)
         self.clients.append(new_client)
-        return True, f"Registered new client: {name}"
+        self.clients_by_name[name] = new_client
+        for topic in client_topics(name, pubs):
+            self.publisher_index[topic] = name
+        tags = set()
+        for role, entries in (("pub", pubs), ("sub", subs)):
+            for entry, topic in zip(entries, client_topics(name, entries)):
+                data_type = entry.split(':', 1)[1].strip().lower() if ':' in entry else ""
+                self.topic_types[topic] = data_type
+                tags.update((f"role:{role}", f"type:{data_type}"))
+        self.client_index.add(name, client_topics(name, pubs + subs), tags)
+        if self.liveness:
+            self.liveness.touch(name)
+        return self._record_change("clients", "added", name, self._client_data(new_client), notify=False)
 
     def remove_client(self, name):
-        before = len(self.clients)
-        self.clients = [c for c in self.clients if c.clientName != name]
-        return len(self.clients) < before
+        return bool(self.remove_clients([name]))
 
-    def get_clients_data(self):
+    def remove_clients(self, names):
+        """Deregister several clients in one pass, returning the names removed."""
+        with self._change_lock:
+            changes = self._remove_clients(names)
+        self._notify(changes)
+        return [change[3] for change in changes]
+
+    def _remove_clients(self, names):
+        names = {name for name in names if name in self.clients_by_name}
+        if not names:
+            return []
+        self.clients = [c for c in self.clients if c.clientName not in names]
+        changes = []
+        for name in names:
+            c = self.clients_by_name.pop(name)
+            for topic in client_topics(name, c.clientPubs):
+                if self.publisher_index.get(topic) == name:
+                    del self.publisher_index[topic]
+            for topic in client_topics(name, c.clientPubs + c.clientSubs):
+                self.topic_types.pop(topic, None)
+            self.client_index.remove(name)
+            if self.liveness:
+                self.liveness.forget(name)
+            self.presumed.discard(name)
+            self.traffic.forget(name)
+            changes.append(self._record_change("clients", "removed", name, notify=False))
+        return changes
+
+    def restore_clients(self, entries, presume_timeout=60.0):
+        """
+        Re-add clients from a registry snapshot as "presumed alive". Any that
+        haven't been confirmed by traffic or re-registration within
+        presume_timeout seconds are removed in one batch.
+        """
+        changes = []
+        with self._change_lock:
+            for entry in entries:
+                name = entry.get("name")
+                if not name or name in self.clients_by_name:
+                    continue
+                changes.append(self._add_client(name, entry.get("description", ""), entry.get("publishers", []),
+                                                entry.get("subscribers", []), presumed=True))
+        self._notify(changes)
+
+        if changes:
+            print(f"♻️  Restored {len(changes)} clients from the last run (presumed alive for {presume_timeout:g}s)")
+            timer = threading.Timer(presume_timeout, self.expire_presumed)
+            timer.daemon = True
+            timer.start()
+        return len(changes)
+
+    def confirm_client(self, name):
+        if name in self.presumed:
+            self.presumed.discard(name)
+            c = self.clients_by_name.get(name)
+            if c:
+                self._record_change("clients", "added", name, self._client_data(c))
+
+    def expire_presumed(self):
+        names = list(self.presumed)
+        self.presumed.clear()
+        removed = self.remove_clients(names)
+        if removed:
+            print(f"⌛ Restored clients never reappeared: {', '.join(removed)}")
+
+    def expire_clients(self, names):
+        removed = self.remove_clients(names)
+        if removed:
+            print(f"⌛ Clients timed out: {', '.join(removed)}")
+
+    def heartbeat(self, name):
+        if self.liveness and name in self.clients_by_name:
+            self.liveness.touch(name)
+
+    def client_for_topic(self, topic):
+        return self.publisher_index.get(topic)
+
+    def record_value(self, topic, payload):
+        """
+        Account for, cache and log one inbound data message. Returns False if
+        it's from a client over its traffic quota, in which case it isn't
+        recorded and shouldn't be routed either.
+        """
+        ts = time.time()
+        self.loss.received[topic] += 1
+        client = self.client_for_topic(topic)
+        if client:
+            if self.liveness:
+                self.liveness.touch(client)
+            if self.presumed and client in self.presumed:
+                self.confirm_client(client)
+            if not self.traffic.record(client, len(payload)):
+                self.loss.dropped("router", "quota", topic)
+                return False
+        self.last_values.put(topic, payload, client, ts)
+        self.history.append(topic, payload, ts)
+        return True
+
+    def _client_data(self, c):
+        return {
+            "name": c.clientName,
+            "description": c.clientDesc,
+            "publishers": c.clientPubs,
+            "subscribers": c.clientSubs,
+            "presumed": c.clientName in self.presumed
+        }
+
+    def get_registry_data(self):
+        # What a registry snapshot persists: the registration itself, not
+        # whether it's been confirmed this run.
         return [
             {
                 "name": c.clientName,
@@ -88,5 +550,70 @@ class SpacebrewRouter:
                 "publishers": c.clientPubs,
                 "subscribers": c.clientSubs
             }
-            for c in self.clients
+            for c in list(self.clients)
         ]
+
+    @staticmethod
+    def _route_data(pub, sub, condition=None):
+        return {"pub": pub, "sub": sub, "condition": condition}
+
+    def get_clients_data(self):
+        return [self._client_data(c) for c in self.clients]
+
+    def _record_change(self, table, op, key, data=None, notify=True):
+        with self._change_lock:
+            self.version += 1
+            change = (self.version, table, op, key, data)
+            self.changes.append(change)
+        if notify:
+            self._notify([change])
+        return change
+
+    def _notify(self, changes):
+        # One notification per batch: a delta covering versions since+1 up
+        # to version. Batches are recorded under _change_lock, so no other
+        # change can land in the middle of that range.
+        if self.on_change and changes:
+            delta = self._delta(changes)
+            delta["since"] = changes[0][0] - 1
+            delta["version"] = changes[-1][0]
+            self.on_change(delta)
+
+    @staticmethod
+    def _delta(changes):
+        # Collapse a run of changes into the net added/removed entries per
+        # table. Consumers apply "removed" before "added", so a client that
+        # left and re-registered shows up in both.
+        delta = {
+            "clients": {"added": {}, "removed": set()},
+            "routes": {"added": {}, "removed": set()},
+        }
+        for _, table, op, key, data in changes:
+            entry = delta[table]
+            if op == "added":
+                entry["added"][key] = data
+            else:
+                entry["added"].pop(key, None)
+                entry["removed"].add(key)
+        return {
+            table: {"added": list(entry["added"].values()), "removed": sorted(entry["removed"])}
+            for table, entry in delta.items()
+        }
+
+    def changes_since(self, version):
+        """
+        Net client/route changes after `version`, or None if the change log no
+        longer reaches back that far and the caller must refetch everything.
+        """
+        with self._change_lock:
+            current = self.version
+            # Versions in the log are consecutive, so the first change after
+            # `version` can be found by offset rather than by scanning.
+            oldest = self.changes[0][0] if self.changes else current + 1
+            if version > current or version < oldest - 1:
+                return None
+            changes = list(islice(self.changes, max(0, version - oldest + 1), None))
+        delta = self._delta(changes)
+        delta["since"] = version
+        delta["version"] = current
+        return delta
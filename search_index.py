@@ -0,0 +1,118 @@
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+# Most keys a paged search examines per call. Filters that can't narrow
+# the walk to a posting list (1-2 character substrings, or a long list
+# with few matches) would otherwise cost a scan of every key per page;
+# instead the page comes back short, with a cursor to carry on from.
+MAX_SCAN = 10000
+
+
+def _contains(keys, key):
+    i = bisect_left(keys, key)
+    return i < len(keys) and keys[i] == key
+
+
+def _discard(postings, posting, key):
+    keys = postings[posting]
+    i = bisect_left(keys, key)
+    if i < len(keys) and keys[i] == key:
+        del keys[i]
+    if not keys:
+        del postings[posting]
+
+
+class SearchIndex:
+    """
+    Keys kept in sorted order (for prefix search and cursor pagination),
+    with a trigram index over each key's searchable text (for substring
+    search) and a tag index (for filters), all updated incrementally.
+    Each trigram and tag keeps its keys as a sorted list, so a query walks
+    the shortest list that applies from the cursor on, checking the rest
+    by bisection, and stops once the page is full: O(log n) per key
+    examined, never a sort of all matches. Substring search is
+    case-insensitive; prefixes match the key exactly.
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.texts = {}
+        self.tags = {}
+        self._trigram_keys = defaultdict(list)
+        self._tag_keys = defaultdict(list)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.texts
+
+    def add(self, key, texts=(), tags=()):
+        """Index key, searchable by its own text plus any extra texts (e.g. a route's subscriber topic)."""
+        if key in self.texts:
+            self.remove(key)
+        insort(self.keys, key)
+        text = "\n".join((key,) + tuple(texts)).lower()
+        self.texts[key] = text
+        for trigram in _trigrams(text):
+            insort(self._trigram_keys[trigram], key)
+        self.tags[key] = tags = frozenset(tags)
+        for tag in tags:
+            insort(self._tag_keys[tag], key)
+
+    def remove(self, key):
+        text = self.texts.pop(key, None)
+        if text is None:
+            return
+        del self.keys[bisect_left(self.keys, key)]
+        for trigram in _trigrams(text):
+            _discard(self._trigram_keys, trigram, key)
+        for tag in self.tags.pop(key):
+            _discard(self._tag_keys, tag, key)
+
+    def search(self, prefix=None, substring=None, tags=(), after=None, limit=None):
+        """
+        Keys starting with prefix, containing substring and carrying every
+        tag, in sorted order, starting after the key `after` (the previous
+        page's cursor). Returns (keys, next cursor or None). With a limit,
+        at most MAX_SCAN keys are examined, so a page can hold fewer than
+        `limit` keys and still have a next cursor.
+        """
+        substring = substring.lower() if substring else None
+        postings = []
+        if substring and len(substring) >= 3:
+            # Every trigram of the query must appear in a match
+            postings.extend(self._trigram_keys.get(t, ()) for t in _trigrams(substring))
+        postings.extend(self._tag_keys.get(tag, ()) for tag in tags)
+        if postings:
+            postings.sort(key=len)
+            keys, others = postings[0], postings[1:]
+        else:
+            keys, others = self.keys, ()
+
+        start = bisect_left(keys, prefix) if prefix else 0
+        if after is not None:
+            start = max(start, bisect_right(keys, after))
+
+        results = []
+        end = len(keys) if limit is None else min(len(keys), start + MAX_SCAN)
+        for i in range(start, end):
+            key = keys[i]
+            if prefix and not key.startswith(prefix):
+                return results, None  # Sorted, so nothing further can match
+            if others and not all(_contains(other, key) for other in others):
+                continue
+            if substring and substring not in self.texts[key]:
+                continue
+            if limit is not None and len(results) == limit:
+                return results, results[-1]
+            results.append(key)
+        if end < len(keys):
+            # Scan budget used up: carry on after the last key examined
+            return results, keys[end - 1]
+        return results, None
@@ -0,0 +1,161 @@
+import os
+import struct
+import threading
+from collections import OrderedDict, deque
+
+# What to do with a message when the spool is full:
+#   drop-oldest  discard the oldest spooled message to make room (default)
+#   drop-newest  discard the incoming message
+#   latest-only  keep just the most recent message per destination topic
+#                (for state such as colours or toggles, where only the
+#                current value matters); never counts towards the limit
+POLICIES = ("drop-oldest", "drop-newest", "latest-only")
+DEFAULT_POLICY = "drop-oldest"
+
+_RECORD_HEADER = struct.Struct("<HI")  # topic length, payload length
+
+
+class OutboundSpool:
+    """
+    Bounded holding area for outbound messages produced while the broker is
+    unreachable, flushed in order on reconnect. Up to `max_messages` are
+    kept in memory; with an overflow path, further messages spill to an
+    append-only file of up to `max_overflow_bytes` before the drop policy
+    kicks in.
+    """
+
+    def __init__(self, max_messages=10000, overflow_path=None, max_overflow_bytes=64 * 1024 * 1024):
+        self.max_messages = max(1, max_messages)
+        self.overflow_path = overflow_path
+        self.max_overflow_bytes = max_overflow_bytes
+        self.dropped = 0
+        # Called with (topic, reason) for each message dropped, under the
+        # spool's lock, so it must be quick
+        self.on_drop = None
+        self.spilled = 0
+        self._memory = deque()
+        self._latest = OrderedDict()
+        self._file = None
+        self._disk_count = 0
+        self._disk_read = 0
+        self._disk_write = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._memory) + self._disk_count + len(self._latest)
+
+    def put(self, topic, payload, policy=DEFAULT_POLICY):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        with self._lock:
+            if policy == "latest-only":
+                if self._latest.pop(topic, None) is not None and self.on_drop:
+                    self.on_drop(topic, "superseded")
+                self._latest[topic] = payload
+                return
+
+            # Once anything has spilled to disk, newer messages must follow
+            # it there to keep the spool in order.
+            if not self._disk_count and len(self._memory) < self.max_messages:
+                self._memory.append((topic, payload))
+                return
+            if self._spill(topic, payload):
+                return
+
+            if policy == "drop-newest":
+                self.dropped += 1
+                if self.on_drop:
+                    self.on_drop(topic, "overflow")
+                return
+            # drop-oldest: discard from the front until the new message fits
+            # at the back.
+            while True:
+                dropped_topic = self._drop_oldest()
+                self.dropped += 1
+                if self.on_drop:
+                    self.on_drop(dropped_topic, "overflow")
+                if self._disk_count:
+                    if self._spill(topic, payload):
+                        return
+                elif len(self._memory) < self.max_messages:
+                    self._memory.append((topic, payload))
+                    return
+
+    def _spill(self, topic, payload):
+        if not self.overflow_path:
+            return False
+        topic_bytes = topic.encode()
+        record = _RECORD_HEADER.pack(len(topic_bytes), len(payload)) + topic_bytes + payload
+        if self._disk_write - self._disk_read + len(record) > self.max_overflow_bytes:
+            return False
+        if self._file is None:
+            self._file = open(self.overflow_path, "w+b")
+        if self._disk_write + len(record) > 2 * self.max_overflow_bytes:
+            self._compact()
+        self._file.seek(self._disk_write)
+        self._file.write(record)
+        self._disk_write += len(record)
+        self._disk_count += 1
+        self.spilled += 1
+        return True
+
+    def _compact(self):
+        # Records dropped from the front leave dead space; move the live
+        # region back to the start so the file stays bounded.
+        self._file.seek(self._disk_read)
+        live = self._file.read(self._disk_write - self._disk_read)
+        self._file.seek(0)
+        self._file.write(live)
+        self._file.truncate()
+        self._disk_read, self._disk_write = 0, len(live)
+
+    def _read_disk_head(self):
+        self._file.seek(self._disk_read)
+        topic_len, payload_len = _RECORD_HEADER.unpack(self._file.read(_RECORD_HEADER.size))
+        topic = self._file.read(topic_len).decode()
+        payload = self._file.read(payload_len)
+        self._disk_read += _RECORD_HEADER.size + topic_len + payload_len
+        self._disk_count -= 1
+        if not self._disk_count:
+            self._disk_read = self._disk_write = 0
+        return topic, payload
+
+    def _drop_oldest(self):
+        """Drop the oldest message, returning its topic."""
+        if self._memory:
+            topic, _ = self._memory.popleft()
+            # Pull the oldest spilled message forward, keeping memory full
+            # and the whole spool in order.
+            if self._disk_count:
+                self._memory.append(self._read_disk_head())
+            return topic
+        return self._read_disk_head()[0]
+
+    def drain(self):
+        """Remove and return everything spooled, oldest first, as (topic, payload) pairs."""
+        with self._lock:
+            messages = list(self._memory)
+            self._memory.clear()
+            while self._disk_count:
+                messages.append(self._read_disk_head())
+            if self._file:
+                self._file.truncate(0)
+            messages.extend(self._latest.items())
+            self._latest.clear()
+            return messages
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+            os.remove(self.overflow_path)
+
+    def stats(self):
+        return {
+            "depth": len(self),
+            "memory": len(self._memory),
+            "disk": self._disk_count,
+            "latest_only": len(self._latest),
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+        }
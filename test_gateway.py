@@ -0,0 +1,43 @@
+import asyncio
+import os
+import tempfile
+import threading
+
+from gateway import GatewayHub, RouterLink, read_frame
+from mqtt_service import SpacebrewMQTT
+from router import SpacebrewRouter
+from web_service import SpacebrewWebServer
+
+
+def test_bytes_payload_through_gateway():
+    # A MessagePack web client's publish arrives at the gateway with a bytes
+    # payload; it has to reach the router process's MQTT side unchanged.
+    directory = tempfile.mkdtemp()
+    router = SpacebrewRouter(os.path.join(directory, 'routes.txt'))
+    mqtt_service = SpacebrewMQTT(router)
+    published = []
+    received = threading.Event()
+
+    def publish_batch(messages):
+        published.extend(messages)
+        received.set()
+
+    mqtt_service.publish_batch = publish_batch
+    hub = GatewayHub(SpacebrewWebServer(router, mqtt_service), os.path.join(directory, 'gateway.sock'))
+    hub.start()
+
+    async def gateway():
+        reader, writer = await asyncio.open_unix_connection(hub.path)
+        assert "hello" in await read_frame(reader)
+        RouterLink(writer).publish_batch([("Sensor/raw", b"\x00\xff\x81"), ("Sensor/text", "hello")])
+        await writer.drain()
+        writer.close()
+
+    asyncio.run(gateway())
+    assert received.wait(5)
+    assert published == [("Sensor/raw", b"\x00\xff\x81"), ("Sensor/text", "hello")]
+
+
+if __name__ == '__main__':
+    test_bytes_payload_through_gateway()
+    print("OK")
@@ -0,0 +1,48 @@
+import os
+import tempfile
+
+from fastapi.testclient import TestClient
+
+from mqtt_service import SpacebrewMQTT
+from router import SpacebrewRouter
+from web_service import SpacebrewWebServer
+
+
+def make_router(directory, name='routes.txt'):
+    return SpacebrewRouter(os.path.join(directory, name))
+
+
+def test_routes_into_a_space_are_rejected():
+    # Topics under a hosted space's name are handed to that space, so a
+    # default-space route on them could never fire.
+    directory = tempfile.mkdtemp()
+    router = make_router(directory)
+    mqtt_service = SpacebrewMQTT(router)
+    mqtt_service.add_space("gal", make_router(directory, 'gal.txt'))
+
+    assert not router.add_route("gal/foo", "A/in")[0]
+    assert not router.add_route("A/out", "gal/foo")[0]
+    assert "gal/foo" not in router.routes
+    # Only the whole first level counts
+    assert router.add_route("gallery/foo", "A/in")[0]
+
+    client = TestClient(SpacebrewWebServer(router, mqtt_service).app)
+    response = client.post("/api/routes", json={"pub": "gal/bar", "sub": "A/in"})
+    assert response.status_code == 400
+    assert "gal" in response.json()["detail"]
+    assert client.post("/api/routes", json={"pub": "B/out", "sub": "A/in"}).status_code == 200
+
+
+def test_registration_under_a_space_name_is_rejected():
+    directory = tempfile.mkdtemp()
+    router = make_router(directory)
+    SpacebrewMQTT(router).add_space("gal", make_router(directory, 'gal.txt'))
+    assert router.register_clients([("gal", "", [], [])]) == [
+        (False, "Client rejected: Name 'gal' belongs to a space.")]
+    assert router.register_clients([("Lamp", "", [], [])])[0][0]
+
+
+if __name__ == '__main__':
+    test_routes_into_a_space_are_rejected()
+    test_registration_under_a_space_name_is_rejected()
+    print("OK")
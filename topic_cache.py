@@ -0,0 +1,94 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Rough per-entry bookkeeping cost (dict slot, tuple, float, key object) on
+# top of the topic and payload bytes themselves, so the byte budget tracks
+# real memory use even for tiny payloads.
+ENTRY_OVERHEAD = 120
+
+
+class LastValueCache:
+    """
+    Last payload seen on each topic, with when and from whom, so newly
+    connected dashboards and clients get current state without waiting for
+    the next publish. Bounded by total bytes and topic count; the least
+    recently updated topics are evicted first.
+    """
+
+    def __init__(self, max_bytes=4 * 1024 * 1024, max_topics=10000):
+        self.max_bytes = max_bytes
+        self.max_topics = max_topics
+        self.size = 0
+        self.evictions = 0
+        # topic -> (payload bytes, timestamp, publishing client name or None).
+        # Written from the MQTT threads (paho's, the outbox's), read from the web event loop.
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _entry_size(topic, payload):
+        return len(topic) + len(payload) + ENTRY_OVERHEAD
+
+    def put(self, topic, payload, client=None, ts=None):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        size = self._entry_size(topic, payload)
+        # A single payload larger than the whole budget isn't worth keeping.
+        if size > self.max_bytes:
+            self.discard(topic)
+            return
+
+        with self._lock:
+            old = self._entries.pop(topic, None)
+            if old is not None:
+                self.size -= self._entry_size(topic, old[0])
+            self._entries[topic] = (payload, ts if ts is not None else time.time(), client)
+            self.size += size
+
+            while self.size > self.max_bytes or len(self._entries) > self.max_topics:
+                old_topic, old_entry = self._entries.popitem(last=False)
+                self.size -= self._entry_size(old_topic, old_entry[0])
+                self.evictions += 1
+
+    def discard(self, topic):
+        with self._lock:
+            old = self._entries.pop(topic, None)
+            if old is not None:
+                self.size -= self._entry_size(topic, old[0])
+
+    def get(self, topic):
+        return self._entries.get(topic)
+
+    def snapshot(self, topics=None):
+        """
+        Return cached values as JSON-ready dicts, for all topics or just the
+        given ones (topics that have never been seen are skipped).
+        """
+        with self._lock:
+            if topics is None:
+                items = list(self._entries.items())
+            else:
+                items = [(t, self._entries[t]) for t in topics if t in self._entries]
+
+        return [
+            {
+                "topic": topic,
+                "message": payload.decode(errors="replace"),
+                "ts": ts,
+                "client": client,
+            }
+            for topic, (payload, ts, client) in items
+        ]
+
+    def stats(self):
+        return {
+            "topics": len(self._entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "max_topics": self.max_topics,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,143 @@
+import time
+
+from rate_limit import TokenBucket
+
+# What happens to a client's messages beyond its quota:
+#   drop    discard them all
+#   sample  forward one in every `sample_every` of them (down-sampling a
+#           flood rather than silencing it)
+QUOTA_MODES = ("drop", "sample")
+
+# How long a client stays flagged after it last went over quota
+VIOLATION_HOLD = 10.0
+
+
+class ClientTraffic:
+    """Running totals, last-second rates and quota buckets for one client."""
+
+    __slots__ = ("messages", "bytes", "dropped", "last_violation", "message_bucket", "byte_bucket",
+                 "_second", "_second_messages", "_second_bytes", "_rate_messages", "_rate_bytes", "_excess")
+
+    def __init__(self, message_quota=None, byte_quota=None):
+        self.messages = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.last_violation = None
+        self.message_bucket = TokenBucket(message_quota) if message_quota else None
+        self.byte_bucket = TokenBucket(byte_quota) if byte_quota else None
+        # Counts for the second in progress, and for the one before it
+        self._second = 0
+        self._second_messages = 0
+        self._second_bytes = 0
+        self._rate_messages = 0
+        self._rate_bytes = 0
+        self._excess = 0
+
+    def count(self, size, now):
+        second = int(now)
+        if second != self._second:
+            if second == self._second + 1:
+                self._rate_messages, self._rate_bytes = self._second_messages, self._second_bytes
+            else:
+                self._rate_messages = self._rate_bytes = 0
+            self._second = second
+            self._second_messages = self._second_bytes = 0
+        self._second_messages += 1
+        self._second_bytes += size
+        self.messages += 1
+        self.bytes += size
+
+    def rates(self, now):
+        """(messages/s, bytes/s) over the last complete second."""
+        second = int(now)
+        if second == self._second:
+            return self._rate_messages, self._rate_bytes
+        if second == self._second + 1:
+            return self._second_messages, self._second_bytes
+        return 0, 0
+
+
+class TrafficAccounting:
+    """
+    Attributes inbound traffic to registered clients and enforces optional
+    per-client quotas (messages/s and/or bytes/s), all O(1) per message.
+    Default quotas apply to every client; set_quota() overrides them for one.
+    """
+
+    def __init__(self, message_quota=None, byte_quota=None, mode="drop", sample_every=10):
+        if mode not in QUOTA_MODES:
+            raise ValueError(f"Unknown quota mode '{mode}' (expected one of: {', '.join(QUOTA_MODES)})")
+        self.message_quota = message_quota
+        self.byte_quota = byte_quota
+        self.mode = mode
+        self.sample_every = sample_every
+        self.clients = {}
+        # Name -> (message quota, byte quota) for clients with their own
+        self.quotas = {}
+
+    def record(self, name, size):
+        """Count one message from a client; returns False if it's over quota and should be dropped."""
+        now = time.monotonic()
+        traffic = self.clients.get(name)
+        if traffic is None:
+            traffic = self.clients[name] = ClientTraffic(*self.quotas.get(name, (self.message_quota, self.byte_quota)))
+        traffic.count(size, now)
+
+        bucket = traffic.message_bucket
+        within = bucket is None or bucket.allow(now)
+        bucket = traffic.byte_bucket
+        if within and bucket is not None:
+            within = bucket.allow(now, size)
+        if within:
+            return True
+
+        traffic.last_violation = now
+        if self.mode == "sample":
+            traffic._excess += 1
+            if traffic._excess % self.sample_every == 0:
+                return True
+        traffic.dropped += 1
+        return False
+
+    def set_quota(self, name, message_quota=None, byte_quota=None):
+        self.quotas[name] = (message_quota, byte_quota)
+        traffic = self.clients.get(name)
+        if traffic is not None:
+            traffic.message_bucket = TokenBucket(message_quota) if message_quota else None
+            traffic.byte_bucket = TokenBucket(byte_quota) if byte_quota else None
+
+    def forget(self, name):
+        self.clients.pop(name, None)
+
+    def quota(self, name):
+        return self.quotas.get(name, (self.message_quota, self.byte_quota))
+
+    def violators(self):
+        """Names of clients that have gone over quota within the last VIOLATION_HOLD seconds."""
+        cutoff = time.monotonic() - VIOLATION_HOLD
+        return sorted(
+            name for name, traffic in list(self.clients.items())
+            if traffic.last_violation is not None and traffic.last_violation >= cutoff
+        )
+
+    def top(self, limit=None):
+        """Per-client traffic, busiest (by messages/s, then total) first."""
+        now = time.monotonic()
+        cutoff = now - VIOLATION_HOLD
+        rows = []
+        for name, traffic in list(self.clients.items()):
+            message_rate, byte_rate = traffic.rates(now)
+            message_quota, byte_quota = self.quota(name)
+            rows.append({
+                "name": name,
+                "messages_per_sec": message_rate,
+                "bytes_per_sec": byte_rate,
+                "messages": traffic.messages,
+                "bytes": traffic.bytes,
+                "dropped": traffic.dropped,
+                "message_quota": message_quota,
+                "byte_quota": byte_quota,
+                "over_quota": traffic.last_violation is not None and traffic.last_violation >= cutoff,
+            })
+        rows.sort(key=lambda row: (row["messages_per_sec"], row["messages"]), reverse=True)
+        return rows[:limit] if limit else rows
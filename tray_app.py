@@ -78,14 +78,10 @@ class SpacebrewTrayApp:
         self.mqtt_service = SpacebrewMQTT(self.router, self.config["broker"], self.config["broker_port"])
         self.web_service = SpacebrewWebServer(self.router, self.mqtt_service, port=self.config["web_port"])
 
-        # Connect directly rather than via mqtt_service.connect(), which calls
-        # sys.exit(1) on failure -- fine for the CLI app, fatal for a tray app.
-        try:
-            self.mqtt_service.client.connect(self.mqtt_service.broker, self.mqtt_service.port)
-        except Exception as e:
-            self._notify(f"Could not connect to MQTT broker at {self.mqtt_service.broker}:{self.mqtt_service.port}")
-            print(f"Error connecting to broker: {e}")
-            return
+        # An unreachable broker isn't fatal: start() keeps retrying in the
+        # background and the router picks up once it appears.
+        if not self.mqtt_service.connect():
+            self._notify(f"Could not connect to MQTT broker at {self.mqtt_service.broker}:{self.mqtt_service.port}; retrying")
 
         self.mqtt_service.start()
 
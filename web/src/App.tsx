@@ -8,9 +8,10 @@ import { TestingTools } from "./components/TestingTools";
 import { ClientsSidebar } from "./components/ClientsSidebar";
 import { PatchBay } from "./rete/PatchBay";
 import type { ClientLayout } from "./rete/PatchBay";
-import { addRoute, getClients, getRoutes, getStatus } from "./api";
+import { addRoute, getChanges, getClients, getRoutes, getStatus } from "./api";
 import { useSpacebrewSocket } from "./useSpacebrewSocket";
-import type { Client, RoutesMap, StatusResponse } from "./types";
+import type { Client, RoutesMap, StateDelta, StatusResponse } from "./types";
+import { applyClientsDelta, applyRoutesDelta } from "./lib";
 import type { TopicMessage } from "./lib";
 
 const POLL_INTERVAL_MS = 5000;
@@ -22,30 +23,56 @@ function App() {
   const [routes, setRoutes] = useState<RoutesMap>({});
   const [topicMessages, setTopicMessages] = useState<Record<string, TopicMessage>>({});
   const [activeTopics, setActiveTopics] = useState<Set<string>>(new Set());
+  const [violators, setViolators] = useState<Set<string>>(new Set());
   const [clientLayouts, setClientLayouts] = useState<ClientLayout[]>([]);
   const [totalHeight, setTotalHeight] = useState(0);
 
-  const refreshClients = useCallback(() => {
-    getClients().then(setClients).catch(console.error);
+  // State version the client/route tables are current as of. The tables are
+  // fetched in full once, then kept up to date from deltas pushed over the
+  // WebSocket (or fetched via /api/changes if we miss one).
+  const versionRef = useRef<number | null>(null);
+
+  const refreshTables = useCallback(() => {
+    Promise.all([getClients(), getRoutes()])
+      .then(([clientsRes, routesRes]) => {
+        setClients(clientsRes.data);
+        setRoutes(routesRes.data);
+        versionRef.current = Math.min(clientsRes.version, routesRes.version);
+      })
+      .catch(console.error);
   }, []);
   const refreshRoutes = useCallback(() => {
-    getRoutes().then(setRoutes).catch(console.error);
+    getRoutes()
+      .then((res) => setRoutes(res.data))
+      .catch(console.error);
   }, []);
   const refreshStatus = useCallback(() => {
     getStatus().then(setStatus).catch(console.error);
   }, []);
 
+  const applyDelta = useCallback((delta: StateDelta) => {
+    setClients((prev) => applyClientsDelta(prev, delta));
+    setRoutes((prev) => applyRoutesDelta(prev, delta));
+    versionRef.current = delta.version;
+  }, []);
+
+  const catchUp = useCallback(() => {
+    const since = versionRef.current;
+    if (since === null) return;
+    getChanges(since)
+      .then((delta) => (delta.reset ? refreshTables() : applyDelta(delta)))
+      .catch(console.error);
+  }, [refreshTables, applyDelta]);
+
   useEffect(() => {
     refreshStatus();
-    refreshClients();
-    refreshRoutes();
+    refreshTables();
     const id = setInterval(() => {
       refreshStatus();
-      refreshClients();
-      refreshRoutes();
+      catchUp();
     }, POLL_INTERVAL_MS);
     return () => clearInterval(id);
-  }, [refreshStatus, refreshClients, refreshRoutes]);
+  }, [refreshStatus, refreshTables, catchUp]);
 
   const blinkTimers = useRef<Record<string, ReturnType<typeof setTimeout>>>({});
   const blink = useCallback((topic: string) => {
@@ -61,6 +88,28 @@ function App() {
   }, []);
 
   useSpacebrewSocket((event) => {
+    if (event.delta) {
+      const current = versionRef.current;
+      if (current === null || event.delta.version <= current) return;
+      if (event.delta.since === current) applyDelta(event.delta);
+      else catchUp(); // Missed one; fetch everything since our version.
+      return;
+    }
+    if (event.traffic) {
+      setViolators(new Set(event.traffic.violators));
+      return;
+    }
+    if (event.snapshot) {
+      const snapshot = event.snapshot;
+      setTopicMessages((prev) => {
+        const next = { ...prev };
+        for (const entry of snapshot) {
+          next[entry.topic] = { message: entry.message, ts: entry.ts * 1000 };
+        }
+        return next;
+      });
+      return;
+    }
     if (event.pub) blink(event.pub);
     if (event.sub) blink(event.sub);
     if (event.topic) {
@@ -100,6 +149,7 @@ function App() {
               totalHeight={totalHeight}
               topicMessages={topicMessages}
               activeTopics={activeTopics}
+              violators={violators}
             />
           </div>
           <div className="patchbay__graph">
@@ -1,4 +1,11 @@
-import type { Client, RoutesMap, StatusResponse } from "./types";
+import type {
+  Client,
+  RouteConditionsMap,
+  RoutesMap,
+  StateDelta,
+  StatusResponse,
+  TopicSnapshotEntry,
+} from "./types";
 
 async function json<T>(res: Response): Promise<T> {
   return (await res.json()) as T;
@@ -8,19 +15,43 @@ export function getStatus(): Promise<StatusResponse> {
   return fetch("/api/status").then((res) => json<StatusResponse>(res));
 }
 
-export function getClients(): Promise<Client[]> {
-  return fetch("/api/clients").then((res) => json<Client[]>(res));
+// Full tables come tagged with the router's state version (as the ETag),
+// which is the starting point for fetching deltas afterwards.
+export interface Versioned<T> {
+  data: T;
+  version: number;
 }
 
-export function getRoutes(): Promise<RoutesMap> {
-  return fetch("/api/routes").then((res) => json<RoutesMap>(res));
+async function versioned<T>(res: Response): Promise<Versioned<T>> {
+  const etag = res.headers.get("ETag") ?? "";
+  return { data: await json<T>(res), version: Number(etag.replace(/"/g, "")) || 0 };
 }
 
-export function addRoute(pub: string, sub: string): Promise<{ message: string }> {
+export function getClients(): Promise<Versioned<Client[]>> {
+  return fetch("/api/clients").then((res) => versioned<Client[]>(res));
+}
+
+export function getRoutes(): Promise<Versioned<RoutesMap>> {
+  return fetch("/api/routes").then((res) => versioned<RoutesMap>(res));
+}
+
+export function getChanges(since: number): Promise<StateDelta> {
+  return fetch(`/api/changes?since=${since}`).then((res) => json<StateDelta>(res));
+}
+
+export function getRouteConditions(): Promise<RouteConditionsMap> {
+  return fetch("/api/routes/conditions").then((res) => json<RouteConditionsMap>(res));
+}
+
+export function getSnapshot(): Promise<TopicSnapshotEntry[]> {
+  return fetch("/api/snapshot").then((res) => json<TopicSnapshotEntry[]>(res));
+}
+
+export function addRoute(pub: string, sub: string, condition?: string): Promise<{ message: string }> {
   return fetch("/api/routes", {
     method: "POST",
     headers: { "Content-Type": "application/json" },
-    body: JSON.stringify({ pub, sub }),
+    body: JSON.stringify({ pub, sub, condition }),
   }).then((res) => json<{ message: string }>(res));
 }
 
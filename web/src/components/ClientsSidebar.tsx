@@ -7,11 +7,13 @@ export function ClientsSidebar({
   totalHeight,
   topicMessages,
   activeTopics,
+  violators,
 }: {
   clientLayouts: ClientLayout[];
   totalHeight: number;
   topicMessages: Record<string, TopicMessage>;
   activeTopics: Set<string>;
+  violators: Set<string>;
 }) {
   return (
     <div className="clients-sidebar" style={{ height: totalHeight }}>
@@ -23,7 +25,17 @@ export function ClientsSidebar({
           <div key={client.name} className="client-row" style={{ top: y, height }}>
             <span className={`client-row__led ${isActive ? "client-row__led--active" : ""}`} />
             <div className="client-row__body">
-              <div className="client-row__name">{client.name}</div>
+              <div className="client-row__name">
+                {client.name}
+                {violators.has(client.name) && (
+                  <span
+                    className="client-row__quota"
+                    title="Over its traffic quota; excess messages are being dropped"
+                  >
+                    Over quota
+                  </span>
+                )}
+              </div>
               <div className="client-row__desc">{client.description}</div>
               <div className="client-row__message">{message}</div>
             </div>
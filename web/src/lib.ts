@@ -1,4 +1,4 @@
-import type { Client } from "./types";
+import type { Client, RoutesMap, StateDelta } from "./types";
 
 export interface TopicMessage {
   message: string;
@@ -25,3 +25,19 @@ export function latestMessageForTopics(
   }
   return latest ? latest.message : "—";
 }
+
+// Apply a state delta to the client/route tables. Removals go first, so an
+// entry that was removed and re-added since the last version ends up added.
+export function applyClientsDelta(clients: Client[], delta: StateDelta): Client[] {
+  if (!delta.clients) return clients;
+  const gone = new Set([...delta.clients.removed, ...delta.clients.added.map((c) => c.name)]);
+  return [...clients.filter((c) => !gone.has(c.name)), ...delta.clients.added];
+}
+
+export function applyRoutesDelta(routes: RoutesMap, delta: StateDelta): RoutesMap {
+  if (!delta.routes) return routes;
+  const next = { ...routes };
+  for (const pub of delta.routes.removed) delete next[pub];
+  for (const route of delta.routes.added) next[route.pub] = route.sub;
+  return next;
+}
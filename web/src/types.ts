@@ -3,11 +3,15 @@ export interface Client {
   description: string;
   publishers: string[]; // "name:type" entries
   subscribers: string[]; // "name:type" entries
+  presumed?: boolean; // Restored from the last run and not yet seen again
 }
 
 // Publisher topic -> subscriber topic
 export type RoutesMap = Record<string, string>;
 
+// Publisher topic -> route condition (only for conditional routes)
+export type RouteConditionsMap = Record<string, string>;
+
 export interface StatusResponse {
   connected: boolean;
   broker: string;
@@ -25,4 +29,45 @@ export interface TopicMessageEvent {
   message: string;
 }
 
-export type WsEvent = Partial<RouteActivityEvent> & Partial<TopicMessageEvent>;
+export interface RouteEntry {
+  pub: string;
+  sub: string;
+  condition: string | null;
+}
+
+// Net client/route changes since a state version. `reset` means the server
+// no longer has changes that far back and the tables must be refetched.
+export interface StateDelta {
+  since?: number; // The delta covers changes after this version...
+  version: number; // ...up to and including this one
+  reset?: boolean;
+  clients?: { added: Client[]; removed: string[] };
+  routes?: { added: RouteEntry[]; removed: string[] };
+}
+
+export interface DeltaEvent {
+  delta: StateDelta;
+}
+
+// Last value cached for a topic; ts is in seconds since the epoch.
+export interface TopicSnapshotEntry {
+  topic: string;
+  message: string;
+  ts: number;
+  client: string | null;
+}
+
+export interface SnapshotEvent {
+  snapshot: TopicSnapshotEntry[];
+}
+
+// Pushed when the set of clients over their traffic quota changes
+export interface TrafficEvent {
+  traffic: { violators: string[] };
+}
+
+export type WsEvent = Partial<RouteActivityEvent> &
+  Partial<TopicMessageEvent> &
+  Partial<SnapshotEvent> &
+  Partial<DeltaEvent> &
+  Partial<TrafficEvent>;
@@ -1,55 +1,99 @@
-from fastapi import FastAPI, Request, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Request, HTTPException, WebSocket, WebSocketDisconnect, Query
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from typing import List, Optional
 import uvicorn
 import asyncio
 import os
 import sys
+from mqtt_service import valid_subscription, valid_topic
+from paho.mqtt.client import topic_matches_sub
+from ws_codec import EncodedEvent, TopicIds, choose_subprotocol, receive_event
+import profiler
 
 # Models
 class RouteModel(BaseModel):
     pub: str
     sub: str
+    condition: Optional[str] = None
 
 class PublishModel(BaseModel):
     topic: str
     message: str
 
+class QuotaModel(BaseModel):
+    name: str
+    # None (or left out) for no limit
+    messages: Optional[float] = Field(None, gt=0)
+    bytes: Optional[float] = Field(None, gt=0)
+
+class SpoolPolicyModel(BaseModel):
+    pub: str
+    policy: str
+
 # WebSocket Managers
+# Broadcasts wrap each event in an EncodedEvent, so it is serialized once per
+# wire format (JSON text, or MessagePack for sockets that negotiated the
+# binary subprotocol) and the same frame is sent to every recipient.
 class ConnectionManager:
-    def __init__(self):
+    def __init__(self, topic_ids=None, loss=None):
         self.active_connections: list[WebSocket] = []
+        # Binary sockets -> topic ID -> the topic it was last defined as there
+        self.binary_connections: dict[WebSocket, dict[int, str]] = {}
+        self.topic_ids = topic_ids or TopicIds()
+        # Failed sends are counted here (a LossTracker), if given
+        self.loss = loss
 
     async def connect(self, websocket: WebSocket):
-        await websocket.accept()
+        subprotocol = choose_subprotocol(websocket)
+        await websocket.accept(subprotocol=subprotocol)
         self.active_connections.append(websocket)
+        if subprotocol:
+            self.binary_connections[websocket] = {}
 
     def disconnect(self, websocket: WebSocket):
         self.active_connections.remove(websocket)
+        self.binary_connections.pop(websocket, None)
+
+    async def send(self, websocket: WebSocket, message: dict):
+        await EncodedEvent(message, self.topic_ids).send(websocket, self.binary_connections.get(websocket))
 
     async def broadcast(self, message: dict):
-        for connection in self.active_connections:
+        event = EncodedEvent(message, self.topic_ids)
+        for connection in list(self.active_connections):
             try:
-                await connection.send_json(message)
+                await event.send(connection, self.binary_connections.get(connection))
             except Exception:
-                pass
+                if self.loss:
+                    self.loss.dropped("websocket", "send_failed", message.get("topic") or message.get("sub"))
 
 class WebClientManager:
-    def __init__(self):
+    def __init__(self, topic_ids=None, loss=None):
         self.active_connections: dict[WebSocket, set[str]] = {}
+        # Subscriptions with + or # wildcards, checked per message only for
+        # the sockets that have any
+        self.wildcard_subscriptions: dict[WebSocket, list[str]] = {}
         self.client_names: dict[WebSocket, str] = {}
+        self.binary_connections: dict[WebSocket, dict[int, str]] = {}
+        self.topic_ids = topic_ids or TopicIds()
+        self.loss = loss
 
     async def connect(self, websocket: WebSocket):
-        await websocket.accept()
+        subprotocol = choose_subprotocol(websocket)
+        await websocket.accept(subprotocol=subprotocol)
         self.active_connections[websocket] = set()
+        if subprotocol:
+            self.binary_connections[websocket] = {}
 
     def disconnect(self, websocket: WebSocket):
         if websocket in self.active_connections:
             del self.active_connections[websocket]
+        self.wildcard_subscriptions.pop(websocket, None)
         self.client_names.pop(websocket, None)
+        self.binary_connections.pop(websocket, None)
 
     def register(self, websocket: WebSocket, name: str):
         self.client_names[websocket] = name
@@ -58,16 +102,28 @@ class WebClientManager:
         return self.client_names.get(websocket)
 
     def subscribe(self, websocket: WebSocket, topic: str):
-        if websocket in self.active_connections:
+        if websocket not in self.active_connections:
+            return
+        if '+' in topic or '#' in topic:
+            filters = self.wildcard_subscriptions.setdefault(websocket, [])
+            if topic not in filters:
+                filters.append(topic)
+        else:
             self.active_connections[websocket].add(topic)
 
+    async def send(self, websocket: WebSocket, message: dict):
+        await EncodedEvent(message, self.topic_ids).send(websocket, self.binary_connections.get(websocket))
+
     async def broadcast(self, topic: str, message: str):
-        for ws, subs in self.active_connections.items():
-            if topic in subs:
+        event = EncodedEvent({"topic": topic, "message": message}, self.topic_ids)
+        wildcards = self.wildcard_subscriptions
+        for ws, subs in list(self.active_connections.items()):
+            if topic in subs or (ws in wildcards and any(topic_matches_sub(f, topic) for f in wildcards[ws])):
                 try:
-                    await ws.send_json({"topic": topic, "message": message})
+                    await event.send(ws, self.binary_connections.get(ws))
                 except Exception:
-                    pass
+                    if self.loss:
+                        self.loss.dropped("websocket", "send_failed", topic)
 
 class SpacebrewWebServer:
     def __init__(self, router, mqtt_service, host="0.0.0.0", port=8088):
@@ -86,13 +142,27 @@ class SpacebrewWebServer:
             allow_headers=["*"],
         )
         self.templates = Jinja2Templates(directory="templates")
-        self.manager = ConnectionManager()
-        self.web_client_manager = WebClientManager()
+        topic_ids = TopicIds()
+        self.manager = ConnectionManager(topic_ids, router.loss)
+        self.web_client_manager = WebClientManager(topic_ids, router.loss)
         self.loop = None # Will capture loop on startup
+        # Clients currently flagged as over quota, as last sent to dashboards
+        self.violators = []
+        # Space name -> the SpacebrewWebServer serving it under /spaces/<name>/
+        self.spaces = {}
 
         self.setup_routes()
         self.setup_callbacks()
 
+    async def watch_traffic(self):
+        # Tell dashboards which clients are over quota whenever that changes
+        while True:
+            await asyncio.sleep(1)
+            violators = self.router.traffic.violators()
+            if violators != self.violators:
+                self.violators = violators
+                await self.manager.broadcast({"traffic": {"violators": violators}})
+
     def setup_callbacks(self):
         # Register callbacks with MQTT service
         # Note: These callbacks will be called from MQTT thread, so we need threadsafe execution
@@ -117,35 +187,127 @@ class SpacebrewWebServer:
                     self.loop
                 )
 
-        self.mqtt_service.on_route_activity = on_route_activity
-        self.mqtt_service.on_client_message = on_client_message
+        def on_change(delta):
+            if self.loop:
+                asyncio.run_coroutine_threadsafe(
+                    self.manager.broadcast({"delta": delta}),
+                    self.loop
+                )
 
-    def setup_routes(self):
+        for service in self.mqtt_service.brokers():
+            service.on_route_activity = on_route_activity
+            service.on_client_message = on_client_message
+        self.router.on_change = on_change
+
+    def versioned_response(self, request: Request, get_data):
+        # Tag full-table responses with the router's state version so
+        # unchanged tables cost a 304 instead of a full body. The version is
+        # read before the data, so a concurrent change can only make the tag
+        # stale (forcing a refetch next time), never skip one.
+        etag = f'"{self.router.version}"'
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        return JSONResponse(get_data(), headers=headers)
+
+    async def handle_client_frame(self, websocket: WebSocket, data):
+        """
+        Handle one /ws/client frame: a single command, or a list of commands
+        (e.g. a burst of sensor publishes). Publishes from the whole frame are
+        handed to the MQTT side as one batch, and commands carrying an "id"
+        are acknowledged together in one "acks" frame, so clients can keep
+        sending without waiting on each reply.
+        """
+        commands = data if isinstance(data, list) else [data]
+        publishes = []
+        subscribed = []
+        acks = []
+
+        for command in commands:
+            error = self.handle_client_command(websocket, command, publishes, subscribed)
+            if isinstance(command, dict) and "id" in command:
+                ack = {"id": command["id"], "ok": error is None}
+                if error:
+                    ack["error"] = error
+                acks.append(ack)
+
+        if publishes:
+            self.mqtt_service.publish_batch(publishes)
+        if subscribed:
+            filters = [topic for topic in subscribed if '+' in topic or '#' in topic]
+            snapshot = self.router.last_values.snapshot(subscribed)
+            if filters:
+                snapshot += [entry for entry in self.router.last_values.snapshot()
+                             if any(topic_matches_sub(f, entry["topic"]) for f in filters)]
+            if snapshot:
+                await self.web_client_manager.send(websocket, {"snapshot": snapshot})
+        if acks:
+            await self.web_client_manager.send(websocket, {"acks": acks})
+
+    def handle_client_command(self, websocket: WebSocket, data, publishes, subscribed):
+        """Apply one /ws/client command, returning an error message or None."""
+        if not isinstance(data, dict):
+            return "Commands must be objects"
+        cmd = data.get("cmd")
+
+        if cmd == "register":
+            msg = data.get("message")
+            if not msg:
+                return "Missing message"
+            if not isinstance(msg, str):
+                return "Registration message must be a string"
+            self.web_client_manager.register(websocket, msg.split(",")[0].strip())
+            publishes.append(("YuxiSpace", msg))
+
+        elif cmd == "publish":
+            topic = data.get("topic")
+            payload = data.get("message")
+            if not (topic and payload):
+                return "Missing topic or message"
+            # Payloads go to the broker and caches as they are, so JSON
+            # numbers or objects have to be sent as strings
+            if not isinstance(payload, (str, bytes)):
+                return "Message must be a string"
+            if not valid_topic(topic):
+                return f"Invalid topic: {topic}"
+            publishes.append((topic, payload))
+
+        elif cmd == "subscribe":
+            # Either a single "topic" or a list of "topics"
+            topics = data.get("topics") or ([data["topic"]] if data.get("topic") else [])
+            if not topics:
+                return "Missing topic"
+            if not isinstance(topics, list):
+                return "topics must be a list"
+            for topic in topics:
+                if not valid_subscription(topic):
+                    return f"Invalid topic: {topic}"
+            for topic in topics:
+                self.web_client_manager.subscribe(websocket, topic)
+            subscribed.extend(topics)
+
+        else:
+            return f"Unknown command: {cmd}"
+        return None
+
+    def setup_websockets(self):
+        """The dashboard (/ws) and web client (/ws/client) endpoints."""
         app = self.app
 
-        @app.on_event("startup")
-        async def startup_event():
-            self.loop = asyncio.get_running_loop()
-
-        @app.get("/")
-        async def read_root(request: Request):
-            return self.templates.TemplateResponse("index.html", {
-                "request": request,
-                "broker": self.mqtt_service.broker,
-                "port": self.mqtt_service.port
-            })
-
-        @app.get("/webclient")
-        async def web_client_page(request: Request):
-            return self.templates.TemplateResponse("web_client.html", {"request": request})
-
         @app.websocket("/ws")
         async def websocket_endpoint(websocket: WebSocket):
             await self.manager.connect(websocket)
             try:
+                # Bring the dashboard up to date in one frame instead of
+                # waiting for the next publish on every topic.
+                await self.manager.send(websocket, {"snapshot": self.router.last_values.snapshot()})
+                if self.violators:
+                    await self.manager.send(websocket, {"traffic": {"violators": self.violators}})
                 while True:
                     await websocket.receive_text()
             except WebSocketDisconnect:
+                pass
+            finally:
                 self.manager.disconnect(websocket)
 
         @app.websocket("/ws/client")
@@ -153,35 +315,64 @@ class SpacebrewWebServer:
             await self.web_client_manager.connect(websocket)
             try:
                 while True:
-                    data = await websocket.receive_json()
-                    cmd = data.get("cmd")
-                    
-                    if cmd == "register":
-                        msg = data.get("message")
-                        if msg:
-                            self.web_client_manager.register(websocket, msg.split(",")[0].strip())
-                            self.mqtt_service.publish("YuxiSpace", msg)
-
-                    elif cmd == "publish":
-                        topic = data.get("topic")
-                        payload = data.get("message")
-                        if topic and payload:
-                            self.mqtt_service.publish(topic, payload)
-
-                    elif cmd == "subscribe":
-                        topic = data.get("topic")
-                        if topic:
-                            self.web_client_manager.subscribe(websocket, topic)
+                    data = await receive_event(websocket)
+                    await self.handle_client_frame(websocket, data)
 
             except WebSocketDisconnect:
+                pass
+            finally:
                 # A web client's browser tab closing/navigating away is the
                 # equivalent of an MQTT client dropping its connection, so
                 # deregister it from the router the same way a Last Will would.
+                # (Also when a bad frame ends the connection with an error.)
                 name = self.web_client_manager.get_name(websocket)
                 self.web_client_manager.disconnect(websocket)
                 if name:
                     self.router.remove_client(name)
 
+    def setup_routes(self):
+        app = self.app
+
+        @app.on_event("startup")
+        async def startup_event():
+            self.loop = asyncio.get_running_loop()
+            self.loop.create_task(self.watch_traffic())
+            if self.router.health:
+                self.router.health.watch_loop(self.loop)
+            # Mounted apps don't get startup events of their own
+            for space in self.spaces.values():
+                space.loop = self.loop
+                self.loop.create_task(space.watch_traffic())
+
+        self.setup_websockets()
+
+        @app.get("/")
+        async def read_root(request: Request):
+            # base is the path a space's pages are mounted under ("" for
+            # the default space), for their API and WebSocket URLs
+            return self.templates.TemplateResponse("index.html", {
+                "request": request,
+                "broker": self.mqtt_service.broker,
+                "port": self.mqtt_service.port,
+                "base": request.scope.get("root_path", ""),
+            })
+
+        @app.get("/webclient")
+        async def web_client_page(request: Request):
+            return self.templates.TemplateResponse("web_client.html", {
+                "request": request,
+                "base": request.scope.get("root_path", ""),
+            })
+
+        @app.get("/api/spaces")
+        async def get_spaces():
+            # The default space ("") and any others hosted alongside it
+            return [
+                {"name": name, "path": f"/spaces/{name}/" if name else "/",
+                 "clients": len(service.router.clients), "routes": len(service.router.routes)}
+                for name, service in [("", self), *sorted(self.spaces.items())]
+            ]
+
         @app.get("/api/status")
         async def get_status():
             # Check MQTT connection
@@ -190,19 +381,125 @@ class SpacebrewWebServer:
                 "connected": connected,
                 "broker": self.mqtt_service.broker,
                 "port": self.mqtt_service.port,
+                "reconnects": self.mqtt_service.reconnects,
+                "spooled": len(self.mqtt_service.spool),
+                "bridges": [
+                    {
+                        "name": bridge.name,
+                        "broker": bridge.broker,
+                        "port": bridge.port,
+                        "connected": bridge.client.is_connected(),
+                    }
+                    for bridge in self.mqtt_service.bridges
+                ],
+            }
+
+        @app.get("/api/metrics")
+        async def get_metrics():
+            return {
+                "mqtt": self.mqtt_service.metrics(),
+                "loops": self.router.loop_stats(),
+                "last_values": self.router.last_values.stats(),
+                "history": self.router.history.stats(),
+                "health": self.router.health.report() if self.router.health else None,
             }
 
+        @app.get("/api/loss")
+        async def get_loss(limit: Optional[int] = Query(20, gt=0)):
+            # Where messages were dropped: per stage, per route, and the
+            # topics losing the most
+            return self.router.loss.report(self.router.routes, limit)
+
+        @app.get("/api/traffic")
+        async def get_traffic(limit: Optional[int] = Query(None, gt=0)):
+            traffic = self.router.traffic
+            return {
+                "mode": traffic.mode,
+                "message_quota": traffic.message_quota,
+                "byte_quota": traffic.byte_quota,
+                "clients": traffic.top(limit),
+            }
+
+        @app.post("/api/traffic/quota")
+        async def set_quota(data: QuotaModel):
+            self.router.traffic.set_quota(data.name, data.messages, data.bytes)
+            return {"message": f"Quota for {data.name}: {f'{data.messages:g}' if data.messages else 'unlimited'} messages/s,"
+                               f" {f'{data.bytes:g}' if data.bytes else 'unlimited'} bytes/s"}
+
+        @app.get("/api/debug/profile")
+        async def get_profile(seconds: float = Query(10, gt=0, le=300), rate: int = Query(100, gt=0, le=1000),
+                              format: str = "collapsed"):
+            # Sampling runs in a worker thread so the event loop (which is
+            # one of the threads being sampled) keeps serving meanwhile.
+            if format not in ("collapsed", "speedscope"):
+                raise HTTPException(status_code=400, detail="format must be 'collapsed' or 'speedscope'")
+            try:
+                profile = await asyncio.to_thread(profiler.sample, seconds, rate)
+            except RuntimeError as e:
+                raise HTTPException(status_code=409, detail=str(e))
+            headers = {"X-Profile-Overhead": f"{profile.overhead:.4f}"}
+            if format == "speedscope":
+                return JSONResponse(profile.speedscope(), headers=headers)
+            return Response(profile.collapsed(), media_type="text/plain", headers=headers)
+
         @app.get("/api/clients")
-        async def get_clients():
-            return self.router.get_clients_data()
+        async def get_clients(request: Request, limit: Optional[int] = Query(None, gt=0, le=1000),
+                              cursor: Optional[str] = None, prefix: Optional[str] = None,
+                              search: Optional[str] = None, type: Optional[str] = None,
+                              role: Optional[str] = Query(None, pattern="^(pub|sub)$")):
+            # With no query parameters this is the whole table, as before;
+            # with any, one page of {"items", "next_cursor", "version"}.
+            if all(value is None for value in (limit, cursor, prefix, search, type, role)):
+                return self.versioned_response(request, self.router.get_clients_data)
+            return self.versioned_response(request, lambda: self.router.query_clients(
+                prefix, search, type, role, cursor, limit or 100))
+
+        @app.get("/api/snapshot")
+        async def get_snapshot(topic: Optional[List[str]] = Query(None)):
+            return self.router.last_values.snapshot(topic)
+
+        @app.get("/api/history")
+        async def get_history(topic: str, since: Optional[float] = None,
+                              until: Optional[float] = None, limit: Optional[int] = None):
+            return self.router.history.query(topic, since, until, limit)
 
         @app.get("/api/routes")
-        async def get_routes():
-            return self.router.routes
+        async def get_routes(request: Request, limit: Optional[int] = Query(None, gt=0, le=1000),
+                             cursor: Optional[str] = None, prefix: Optional[str] = None,
+                             search: Optional[str] = None, type: Optional[str] = None):
+            if all(value is None for value in (limit, cursor, prefix, search, type)):
+                return self.versioned_response(request, lambda: dict(self.router.routes))
+            return self.versioned_response(request, lambda: self.router.query_routes(
+                prefix, search, type, cursor, limit or 100))
+
+        @app.get("/api/changes")
+        async def get_changes(since: int):
+            delta = self.router.changes_since(since)
+            if delta is None:
+                # Too far behind (or from before a restart): refetch in full.
+                return {"version": self.router.version, "reset": True}
+            return delta
+
+        @app.get("/api/routes/conditions")
+        async def get_route_conditions():
+            return self.router.route_conditions
+
+        @app.get("/api/routes/spool-policies")
+        async def get_spool_policies():
+            return self.router.spool_policies
+
+        @app.post("/api/routes/spool-policies")
+        async def set_spool_policy(data: SpoolPolicyModel):
+            success, msg = self.router.set_spool_policy(data.pub, data.policy)
+            if success:
+                return {"message": msg}
+            raise HTTPException(status_code=400, detail=msg)
 
         @app.post("/api/routes")
         async def add_route(route: RouteModel):
-            success, msg = self.router.add_route(route.pub, route.sub)
+            success, msg = self.router.add_route(route.pub, route.sub, route.condition)
+            if not success:
+                raise HTTPException(status_code=400, detail=msg)
             return {"message": msg}
 
         @app.delete("/api/routes")
@@ -214,7 +511,8 @@ class SpacebrewWebServer:
 
         @app.post("/api/publish")
         async def publish_message(data: PublishModel):
-            self.mqtt_service.publish(data.topic, data.message)
+            if self.mqtt_service.publish(data.topic, data.message) is None:
+                return {"message": "Spooled until the broker reconnects"}
             return {"message": "Published"}
 
         @app.post("/api/save")
@@ -241,6 +539,11 @@ class SpacebrewWebServer:
         if os.path.isdir(spa_dist):
             app.mount("/app", StaticFiles(directory=spa_dist, html=True), name="spa")
 
+    def add_space(self, name, web_service):
+        """Serve another space's dashboard, API and WebSockets under /spaces/<name>/."""
+        self.spaces[name] = web_service
+        self.app.mount(f"/spaces/{name}", web_service.app)
+
     def start(self):
         print(f"🚀 Starting Web Interface at http://{self.host}:{self.port}")
         uvicorn.run(self.app, host=self.host, port=self.port, log_level="error")
@@ -0,0 +1,133 @@
+import json
+from collections import OrderedDict
+
+from starlette.websockets import WebSocketDisconnect
+
+# MessagePack is optional: without it the binary subprotocol simply isn't
+# offered and every socket gets JSON text frames.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_SUBPROTOCOL = "spacebrew.msgpack"
+
+# Binary frame layouts. Topics are sent as small integer IDs; the first time
+# a socket needs an ID, a TOPIC_DEF naming it is prepended to the same frame
+# (so a binary frame holds one or more concatenated MessagePack objects, and
+# a definition always arrives before its first use). Events without a
+# compact layout (snapshots, deltas) are sent as packed maps.
+TOPIC_DEF = 0       # [0, topic_id, topic]
+TOPIC_MESSAGE = 1   # [1, topic_id, message]
+ROUTE_ACTIVITY = 2  # [2, pub_id, sub_id, message]
+
+
+def choose_subprotocol(websocket):
+    """The subprotocol to accept for this socket, or None for plain JSON."""
+    if msgpack is not None and MSGPACK_SUBPROTOCOL in websocket.scope.get("subprotocols", []):
+        return MSGPACK_SUBPROTOCOL
+    return None
+
+
+def dumps(event):
+    # Same compact encoding starlette's send_json uses.
+    return json.dumps(event, separators=(",", ":"), ensure_ascii=False)
+
+
+class TopicIds:
+    """
+    Process-wide topic -> ID table shared by all binary sockets, holding
+    the `max_topics` most recently sent topics. When it's full, the least
+    recently used topic's ID is reissued to the new one; sockets that knew
+    the old meaning get the new definition ahead of the ID's next use.
+    """
+
+    def __init__(self, max_topics=4096):
+        self.max_topics = max_topics
+        # Topic -> (ID, packed TOPIC_DEF), least recently used first
+        self.ids = OrderedDict()
+
+    def get(self, topic):
+        """(ID, packed definition) for a topic."""
+        entry = self.ids.get(topic)
+        if entry is not None:
+            self.ids.move_to_end(topic)
+            return entry
+        if len(self.ids) < self.max_topics:
+            topic_id = len(self.ids)
+        else:
+            topic_id = self.ids.popitem(last=False)[1][0]
+        entry = self.ids[topic] = (topic_id, msgpack.packb([TOPIC_DEF, topic_id, topic]))
+        return entry
+
+
+class EncodedEvent:
+    """
+    One outgoing event, serialized at most once per wire format however many
+    sockets it goes to.
+    """
+
+    __slots__ = ("event", "topic_ids", "_text", "_binary", "_binary_topics")
+
+    def __init__(self, event, topic_ids):
+        self.event = event
+        self.topic_ids = topic_ids
+        self._text = None
+        self._binary = None
+        self._binary_topics = ()
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = dumps(self.event)
+        return self._text
+
+    def _encode_binary(self):
+        event = self.event
+        ids = self.topic_ids
+        # The definitions are kept with the frame: by the time it reaches
+        # some socket, an ID may already have been reissued to another topic.
+        if "pub" in event and "sub" in event:
+            pub, sub = event["pub"], event["sub"]
+            (pub_id, pub_def), (sub_id, sub_def) = ids.get(pub), ids.get(sub)
+            self._binary = msgpack.packb([ROUTE_ACTIVITY, pub_id, sub_id, event.get("message")])
+            self._binary_topics = ((pub_id, pub, pub_def), (sub_id, sub, sub_def))
+        elif "topic" in event:
+            topic = event["topic"]
+            topic_id, definition = ids.get(topic)
+            self._binary = msgpack.packb([TOPIC_MESSAGE, topic_id, event.get("message")])
+            self._binary_topics = ((topic_id, topic, definition),)
+        else:
+            self._binary = msgpack.packb(event)
+
+    async def send(self, websocket, known_topics=None):
+        """
+        Send to one socket. known_topics maps the topic IDs a binary socket
+        has been told about to their topics, or is None for a JSON socket.
+        """
+        if known_topics is None:
+            await websocket.send_text(self.text)
+            return
+        if self._binary is None:
+            self._encode_binary()
+        definitions = []
+        for topic_id, topic, definition in self._binary_topics:
+            if known_topics.get(topic_id) != topic:
+                definitions.append(definition)
+                known_topics[topic_id] = topic
+        if definitions:
+            await websocket.send_bytes(b"".join(definitions) + self._binary)
+        else:
+            await websocket.send_bytes(self._binary)
+
+
+async def receive_event(websocket):
+    """Receive one JSON (text) or MessagePack (binary) frame from a socket."""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    if message.get("bytes") is not None:
+        if msgpack is None:
+            raise ValueError("Binary frames need the msgpack package")
+        return msgpack.unpackb(message["bytes"])
+    return json.loads(message["text"])